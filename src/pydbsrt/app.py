@@ -1,24 +1,35 @@
 """
 
 """
-import binascii
-import bitstring
-from collections import defaultdict
-from hashlib import md5
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import imageio
 from itertools import islice
 from math import log, e
 import numpy as np
+import os
 from pathlib import Path
 from tqdm import tqdm
+from typing import Tuple
 #
 from pydbsrt.tools.videoreader import VideoReader
 from pydbsrt.tools.videofingerprint import VideoFingerprint
 from pydbsrt.tools.subreader import SubReader
 from pydbsrt.tools.subfingerprint import SubFingerprints
-from pydbsrt.tools.importantframefingerprint import ImportantFrameFingerprints
-from pydbsrt.tools.ffmpeg_tools.ffmeg_extract_frame import ffmpeg_imghash_generator
-from pydbsrt.tools.imghash import imghash_to_bitarray, imghash_to_64bits, imghash_hexstr_to_binstr
+from pydbsrt.tools.importantframefingerprint import important_frames_images_generator
+from pydbsrt.tools.ffmpeg_tools.ffmeg_extract_frame import (
+    ffmpeg_imghash_generator,
+    ffmpeg_imghash_block_generator,
+    ffmpeg_imghash_sampled_generator,
+)
+from pydbsrt.tools.ffmpeg_tools.ffmpeg_cut import get_video_frame_rate
+from pydbsrt.tools.ffmpeg_wrapper import FFException
+from pydbsrt.tools.fingerprintcache import FingerprintCache, export_cache_key, media_content_id
+from pydbsrt.tools.fingerprintfile import FingerprintHeader, FingerprintWriter, atomic_tmp_path, read_fingerprints
+from pydbsrt.tools.imghash import (
+    imghash_to_uint64,
+    imghashes_statistics,
+)
 
 
 def show_fingerprints(vreader):
@@ -37,6 +48,8 @@ def show_subtitles_fingerprints(vreader, srt_path):
     for index_subtitle, id_frame, fp in SubFingerprints(
             subreader=SubReader(srt_path),
             vfp=VideoFingerprint(vreader),
+            # only the frames under the subtitles are decoded
+            seek=True,
     ):
         if map_index_subtitles[index_subtitle] == 0:
             print(f"\nindex subtitle: {index_subtitle} - first frame: {id_frame}", end='')
@@ -74,49 +87,86 @@ def entropy2(labels, base=None):
 
 def show_important_frames_fingerprints(
     vreader,
-    threshold_distance: int=32,
-    threshold_nonzero: int=16,
+    threshold_distance: int = 32,
+    threshold_nonzero: int = 16,
+    nb_writers: int = 4,
 ):
     """
     Compute Important Frames (from fingerprint analyze) and extract frames images from them.
 
+    The media is decoded once (see `important_frames_images_generator`): the images of the important
+    frames come from the same decoding pass as their fingerprints (no random access re-decoding),
+    and are written (jpeg encoding) by a pool of `nb_writers` background writers.
+
     :param vreader:
     :param threshold_distance:
     :param threshold_nonzero:
+    :param nb_writers:
     :return:
     """
-    gen_if_fingerprint = ImportantFrameFingerprints(
-        VideoFingerprint(vreader),
+    gen_if_images = important_frames_images_generator(
+        str(vreader.media_path),
         threshold_distance=threshold_distance,
         threshold_nonzero=threshold_nonzero,   # for removing blank (black) frames
+        media_size=vreader.metadatas['size'],
     )
 
-    # try:
-    #     for i, (fp, id_frame) in enumerate(islice(gen_if_fingerprint, 16)):
-    #         print(
-    #             f"import frame #{i}"
-    #             f" - id_frame: {id_frame}"
-    #             f" - fingerprint: {fp}"
-    #             f" - Shannon's entropy: {entropy2(list(str(fp)))}"
-    #         )
-    # except:
-    #     pass
     export_path = Path('/tmp/important_frames_fingerprints')
     export_path.mkdir(exist_ok=True)
-    for fp, id_frame in gen_if_fingerprint:
-        print(
-            f" - id_frame: {id_frame}"
-            f" - fingerprint: {fp}"
-            f" - Shannon's entropy: {entropy2(list(str(fp)))}"
-        )
-        frame = vreader.reader.get_data(id_frame)
-        imageio.imwrite(export_path.joinpath(f'{id_frame}.jpg'), frame)
+    with ThreadPoolExecutor(max_workers=nb_writers) as writers:
+        # bounded number of pending writes: full resolution frames are waiting in memory
+        pending_writes = deque()
+        for fp, id_frame, frame in gen_if_images:
+            print(
+                f" - id_frame: {id_frame}"
+                f" - fingerprint: {fp:016x}"
+                f" - Shannon's entropy: {entropy2(list(f'{fp:016x}'))}"
+            )
+            pending_writes.append(writers.submit(imageio.imwrite, export_path.joinpath(f'{id_frame}.jpg'), frame))
+            if len(pending_writes) > 2 * nb_writers:
+                pending_writes.popleft().result()
+        for pending_write in pending_writes:
+            pending_write.result()
+
+
+def export_fingerprints(
+        input_media_path: Path,
+        batch_size: int = None,
+        stride: int = None,
+        fps: float = None,
+        keyframes: bool = False,
+        frame_rate: float = None,
+        cache: FingerprintCache = None,
+        checkpoint_every: int = 10000,
+        hash_algos: Tuple[str, ...] = ('phash',),
+) -> Path:
+    """
+    Export the imghashes of a media in a (self-describing) fingerprints file,
+    see `pydbsrt.tools.fingerprintfile`.
 
+    Exported files are entries of a content-addressed cache (see `pydbsrt.tools.fingerprintcache`):
+    on a cache hit, the media is not decoded at all.
 
-def export_fingerprints(input_media_path: Path) -> Path:
-    """
+    Full (not sampled) exports are resumable: the imghashes are written in a partial file, committed
+    every `checkpoint_every` frames. If the export is interrupted, the next call seeks ffmpeg to the
+    last committed frame and appends to the partial file.
+
+    Nothing is committed in the cache if ffmpeg fails (`FFException.BinaryCallFailed`) or decodes
+    no frame (`FFException.InvalidMedia`).
 
     :param input_media_path:
+    :param batch_size: if set, use the vectorized pHash engine (hashing `batch_size` frames at once)
+    :param stride: sparse sampling, one frame every `stride` frames
+    :param fps: sparse sampling, `fps` frames per second
+    :param keyframes: sparse sampling, keyframes only
+        With a sparse sampling mode, the source frames indices of the imghashes are exported
+        (big-endian int64) next to the imghashes, in a '.ids' file.
+    :param frame_rate: frame rate of the media, stored in the header. Default to ffprobe value (if available)
+    :param cache: fingerprints cache. Default to a cache in '/tmp/imghash'
+    :param checkpoint_every: number of frames between two checkpoints (full export)
+    :param hash_algos: hash algorithms (see `imghashes_compute`), computed in the same decoding pass
+        and exported as parallel columns of the fingerprints file. Other algorithms than pHash alone
+        use the vectorized engine.
     :return:
 
     {'plugin': 'ffmpeg', 'nframes': 189292, 'ffmpeg_version': '4.0.2-1 built with gcc 7 (Debian 7.3.0-26)',
@@ -125,37 +175,143 @@ def export_fingerprints(input_media_path: Path) -> Path:
     => ~ x25.675
 
     """
-    export_path = Path('/tmp/imghash')
-    export_path.mkdir(exist_ok=True)
-    # https://stackoverflow.com/questions/38175170/python-md5-cracker-typeerror-object-supporting-the-buffer-api-required
-    export_fp = export_path.joinpath(f"{md5(str(input_media_path).encode()).hexdigest()}.ba")
-    with open(export_fp, 'wb') as fp:
-        for imghash in tqdm(ffmpeg_imghash_generator(str(input_media_path))):
-            ba_imghash = imghash_to_bitarray(imghash)
-            fp.write(ba_imghash.bytes)
+    cache = cache or FingerprintCache()
+    sampled = bool(stride or fps or keyframes)
+    content_id = media_content_id(input_media_path)
+    cache_key = export_cache_key(content_id, hash_algos, stride, fps, keyframes)
+    export_fp = cache.get(cache_key, suffixes=('.ba', '.ids') if sampled else ('.ba',))
+    if export_fp:
+        return export_fp
+    export_fp = cache.path(cache_key)
+
+    if frame_rate is None:
+        try:
+            frame_rate = get_video_frame_rate(str(input_media_path))
+        except (FFException.BinaryNotFound, FFException.BinaryCallFailed, FFException.InvalidMedia, ValueError):
+            frame_rate = 0.0
+    header = FingerprintHeader(fps=frame_rate, hash_algos=hash_algos, source_id=bytes.fromhex(content_id))
+
+    if sampled:
+        _export_sampled_fingerprints(input_media_path, export_fp, header, batch_size, stride, fps, keyframes)
+    else:
+        _export_resumable_fingerprints(
+            input_media_path, export_fp, cache.partial_path(cache_key), header, batch_size, checkpoint_every
+        )
+
+    cache.evict(keep=cache_key)
     return export_fp
 
 
+def _export_sampled_fingerprints(
+        input_media_path: Path,
+        export_fp: Path,
+        header: FingerprintHeader,
+        batch_size: int = None,
+        stride: int = None,
+        fps: float = None,
+        keyframes: bool = False,
+):
+    frame_rate = header.fps
+    hash_algos = None if header.hash_algos == ('phash',) else header.hash_algos
+    # atomic writes: concurrent workers never see half-written entries
+    with FingerprintWriter(export_fp, header, atomic=True) as writer:
+        ids_fp = export_fp.with_suffix('.ids')
+        ids_tmp_fp = atomic_tmp_path(ids_fp)
+        try:
+            with open(ids_tmp_fp, 'wb') as fp_ids, tqdm() as pbar:
+                for frames_ids, imghashes in ffmpeg_imghash_sampled_generator(
+                        str(input_media_path), batch_size=batch_size or 256,
+                        frame_rate=frame_rate or None, stride=stride, fps=fps, keyframes=keyframes,
+                        hash_algos=hash_algos,
+                ):
+                    writer.write(imghashes)
+                    fp_ids.write(frames_ids.astype('>i8').tobytes())
+                    pbar.update(len(imghashes))
+            # a failed ffmpeg run raises (see `ffmpeg_imghash_sampled_generator`), an empty one too
+            if not writer.header.nb_frames:
+                raise FFException.InvalidMedia(str(input_media_path))
+            os.replace(ids_tmp_fp, ids_fp)
+        finally:
+            if ids_tmp_fp.exists():
+                ids_tmp_fp.unlink()
+
+
+def _export_resumable_fingerprints(
+        input_media_path: Path,
+        export_fp: Path,
+        partial_fp: Path,
+        header: FingerprintHeader,
+        batch_size: int = None,
+        checkpoint_every: int = 10000,
+):
+    frame_rate = header.fps
+    hash_algos = None if header.hash_algos == ('phash',) else header.hash_algos
+    # (locked) partial file: a concurrent worker exporting the same entry waits here
+    writer = FingerprintWriter(partial_fp, header, resume=True).open()
+    try:
+        if export_fp.exists():
+            # exported by a concurrent worker: its partial file (recreated by this open) is dropped
+            try:
+                partial_fp.unlink()
+            except FileNotFoundError:
+                pass
+            return
+        start_frame = writer.nb_committed_frames or None
+        if start_frame:
+            print(f"Resume fingerprints export at frame: {start_frame}")
+        # input seeking needs the frame rate, otherwise frames are selected (decoded) from the beginning
+        seek = bool(frame_rate)
+        if batch_size or hash_algos:
+            gen_imghashes = ffmpeg_imghash_block_generator(
+                str(input_media_path), start_frame, batch_size=batch_size or 256, seek=seek,
+                frame_rate=frame_rate or None, hash_algos=hash_algos,
+            )
+        else:
+            gen_imghashes = (
+                [imghash_to_uint64(imghash)]
+                for imghash in ffmpeg_imghash_generator(
+                    str(input_media_path), start_frame, seek=seek, frame_rate=frame_rate or None
+                )
+            )
+        with tqdm(initial=writer.nb_committed_frames) as pbar:
+            for imghashes in gen_imghashes:
+                writer.write(imghashes)
+                pbar.update(len(imghashes))
+                if writer.nb_uncommitted_frames >= checkpoint_every:
+                    writer.flush()
+        writer.flush()
+        # a failed ffmpeg run raises (the committed frames are kept for a resume), an empty one too
+        if not writer.nb_committed_frames:
+            raise FFException.InvalidMedia(str(input_media_path))
+        os.replace(partial_fp, export_fp)
+    finally:
+        writer.close(commit=False)
+
+
+def import_fingerprints_array(input_fingerprints_path: Path) -> np.ndarray:
+    """
+    Bulk read of a fingerprints file (versioned or legacy format).
+
+    :param input_fingerprints_path:
+    :return: uint64 imghashes
+    """
+    print(f"Reading imghash file: {input_fingerprints_path} ...")
+    return read_fingerprints(input_fingerprints_path)
+
+
 def import_fingerprints(input_fingerprints_path: Path) -> hex:
     """
+    Read a fingerprints file (versioned or legacy format), imghash by imghash (as hex strings).
+    Compatibility layer over `import_fingerprints_array`.
 
     :param input_fingerprints_path:
     :return:
     """
     chunk_nb_frames = 2048  # for 8k of fingerprints
-    chunk_nb_bytes_to_read = chunk_nb_frames << 3   # * 8
-    # https://stackoverflow.com/questions/1035340/reading-binary-file-and-looping-over-each-byte
-    print(f"Reading imghash file: {input_fingerprints_path} ...")
-    with open(input_fingerprints_path, "rb") as f:
-        while True:
-            chunk = f.read(chunk_nb_bytes_to_read)
-            chunk_nb_imghash = len(chunk) >> 3  # // 8
-            if chunk_nb_imghash:
-                # https://pythonhosted.org/bitstring/packing.html#compact-format
-                for int64_imghash in bitstring.BitArray(chunk).unpack(fmt=f'>{chunk_nb_imghash}Q'):
-                    yield hex(int64_imghash)
-            else:
-                break
+    imghashes = import_fingerprints_array(input_fingerprints_path)
+    for id_chunk in range(0, len(imghashes), chunk_nb_frames):
+        for int64_imghash in imghashes[id_chunk:id_chunk + chunk_nb_frames].tolist():
+            yield hex(int64_imghash)
 
 
 def main():
@@ -167,7 +323,8 @@ def main():
     media_path = root_path.joinpath("Mission.Impossible.Rogue.Nation.2015.1080p.BluRay.x264.YIFY.[YTS.AG].mp4")
     st_path = root_path.joinpath('Mission.Impossible.Rogue.Nation.2015.1080p.BluRay.x264.YIFY.[YTS.AG].srt')
 
-    vreader = VideoReader(media_path)
+    # frames scaled (32x32) and converted (gray) inside ffmpeg: vectorized fingerprints
+    vreader = VideoReader(media_path, frame_size=(32, 32), pix_fmt='gray')
     print(vreader.metadatas)
 
     # show_fingerprints(vreader)
@@ -181,12 +338,8 @@ def main():
 
     fp_exported = Path("/tmp/imghash/2cf8d538818fef16a65925ad55d0b1bf.ba")
 
-    map_imghash_occurency = defaultdict(int)
-    for i, imghash in tqdm(enumerate(import_fingerprints(fp_exported))):
-        # print(f"#{i} - {imghash}")
-        map_imghash_occurency[imghash] += 1
-    # print(pformat(map_imghash_occurency))
-    print(f"Nb distinct imghash: {len(list(map_imghash_occurency.keys()))}")
+    imghashes_stats = imghashes_statistics(import_fingerprints_array(fp_exported))
+    print(f"Nb distinct imghash: {imghashes_stats['nb_distinct']}")
 
     # instance.opt
     # nb_fingerprints = 25 * 2   # 1 minute
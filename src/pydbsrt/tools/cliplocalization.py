@@ -0,0 +1,123 @@
+"""
+Clip localization: find where a query clip (sequence of imghashes) sits inside a reference
+(imghashes of a whole media).
+
+Every offset of the reference is scored by the summed hamming distance between the query and the
+reference frames under it (vectorized popcount, one pass on the reference per query frame).
+A coarse pass only uses one query frame every `coarse_step` frames, then the best offsets are
+re-scored with all the query frames.
+"""
+import attr
+import numpy as np
+from typing import List
+#
+from pydbsrt.tools.imghash import imghashes_popcount
+
+# expected hamming distance between (64 bits) imghashes of unrelated frames
+UNRELATED_DISTANCE = 32.0
+
+
+@attr.s()
+class ClipMatch:
+    # offset (frame index) of the clip in the reference
+    offset = attr.ib(type=int)
+    # mean hamming distance per frame (0: exact match, ~32: unrelated frames)
+    distance = attr.ib(type=float)
+    # 1 - distance / UNRELATED_DISTANCE, clipped to [0, 1]
+    confidence = attr.ib(type=float)
+
+
+def sliding_distances(query: np.ndarray, reference: np.ndarray, query_step: int = 1) -> np.ndarray:
+    """
+    Summed hamming distances between the query and the reference at every offset.
+
+    :param query: uint64 imghashes of the clip
+    :param reference: uint64 imghashes of the media
+    :param query_step: use one query frame every `query_step` frames
+    :return: uint32 distances, one per offset (len(reference) - len(query) + 1)
+
+    >>> reference = np.array([0, 1, 3, 7, 15, 31], dtype=np.uint64)
+    >>> sliding_distances(np.array([3, 7], dtype=np.uint64), reference).tolist()
+    [4, 2, 0, 2, 4]
+    """
+    query = np.asarray(query, dtype=np.uint64)
+    reference = np.asarray(reference, dtype=np.uint64)
+    nb_offsets = len(reference) - len(query) + 1
+    distances = np.zeros(max(nb_offsets, 0), dtype=np.uint32)
+    if nb_offsets <= 0:
+        return distances
+    for id_frame in range(0, len(query), query_step):
+        distances += imghashes_popcount(reference[id_frame:id_frame + nb_offsets] ^ query[id_frame])
+    return distances
+
+
+def offsets_distances(query: np.ndarray, reference: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Summed hamming distances between the query and the reference at some offsets.
+
+    :param query: uint64 imghashes of the clip
+    :param reference: uint64 imghashes of the media
+    :param offsets: offsets (<= len(reference) - len(query))
+    :return: uint32 distances, one per offset
+    """
+    query = np.asarray(query, dtype=np.uint64)
+    windows = np.asarray(reference, dtype=np.uint64)[np.asarray(offsets)[:, np.newaxis] + np.arange(len(query))]
+    return imghashes_popcount(windows ^ query).sum(axis=1, dtype=np.uint32)
+
+
+def locate_clip(
+        query: np.ndarray,
+        reference: np.ndarray,
+        k: int = 5,
+        coarse_step: int = 8,
+        nb_candidates: int = None,
+        min_separation: int = None,
+) -> List[ClipMatch]:
+    """
+    Top-k offsets of a query clip in a reference.
+
+    :param query: uint64 imghashes of the clip
+    :param reference: uint64 imghashes of the media (array or memmap)
+    :param k: number of matches
+    :param coarse_step: coarse pass on one query frame every `coarse_step` frames (1: no coarse pass)
+    :param nb_candidates: number of offsets (best coarse ones) re-scored with all the query frames.
+        Default to max(256, 64 * k)
+    :param min_separation: minimum distance (in frames) between two returned offsets: the neighbours
+        of a match (ex: static scene) are not returned as other matches. Default to len(query) // 2
+    :return: matches, best first
+
+    >>> rng = np.random.RandomState(0)
+    >>> reference = rng.randint(0, 2**63, 10000, dtype=np.int64).astype(np.uint64)
+    >>> query = reference[4242:4242 + 250] ^ np.uint64(0b1011)  # 3 bits of noise per frame
+    >>> best = locate_clip(query, reference, k=2)[0]
+    >>> best.offset, best.distance, round(best.confidence, 3)
+    (4242, 3.0, 0.906)
+    """
+    query = np.asarray(query, dtype=np.uint64)
+    nb_offsets = len(reference) - len(query) + 1
+    if not len(query) or nb_offsets <= 0:
+        return []
+    nb_candidates = min(nb_offsets, nb_candidates or max(256, 64 * k))
+    min_separation = max(min_separation if min_separation is not None else len(query) // 2, 1)
+
+    if coarse_step > 1 and len(query) >= 2 * coarse_step:
+        coarse_distances = sliding_distances(query, reference, coarse_step)
+        if nb_candidates < nb_offsets:
+            candidates = np.argpartition(coarse_distances, nb_candidates - 1)[:nb_candidates]
+        else:
+            candidates = np.arange(nb_offsets)
+        distances = offsets_distances(query, reference, candidates)
+    else:
+        candidates = np.arange(nb_offsets)
+        distances = sliding_distances(query, reference)
+
+    matches = []
+    for id_candidate in np.argsort(distances, kind='stable').tolist():
+        offset = int(candidates[id_candidate])
+        if any(abs(offset - match.offset) < min_separation for match in matches):
+            continue
+        distance = float(distances[id_candidate]) / len(query)
+        matches.append(ClipMatch(offset, distance, max(0.0, 1.0 - distance / UNRELATED_DISTANCE)))
+        if len(matches) == k:
+            break
+    return matches
@@ -1,52 +1,100 @@
 """
 
 """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 import imagehash
 import logging
+from multiprocessing import Pool
 import numpy as np
+import os
 from PIL import Image
+import queue
+import re
 import subprocess
+import threading
 import time
-from typing import Generator
+from typing import Callable, Generator, Iterable, List, Tuple
 
 # from holimetrix.protos.crawler import Frame_pb2
-from pydbsrt.tools.ffmpeg_tools.ffmpeg_cut import set_select_expression
+from pydbsrt.tools.ffmpeg_tools.ffmpeg_cut import calculate_frame_seek_time, get_video_frame_rate, set_select_expression
+from pydbsrt.tools.ffmpeg_wrapper import FFException
+from pydbsrt.tools.ffmpeg_wrapper import FFMedia
 from pydbsrt.tools.ffmpeg_wrapper import FFmpeg
+from pydbsrt.tools.ffmpeg_wrapper import FFprobe
 from pydbsrt.tools.ffmpeg_wrapper import FFmpegFilter
+from pydbsrt.tools.imghash import imghashes_compute, imghashes_phash
 
+# number of channels (bytes per pixel) of the supported raw output pixel formats
+PIX_FMT_CHANNELS = {
+    'gray': 1,
+    'rgb24': 3,
+}
 
-def ffmpeg_frame_generator(
+
+def build_ffmpeg_frame_extractor(
         input: str,
         start_frame: int = None,
         stop_frame: int = None,
         frame_width: int = 32,
         frame_height: int = 32,
-) -> Generator[bytes, None, None]:
-
+        seek: bool = False,
+        frame_rate: float = None,
+        stride: int = None,
+        fps: float = None,
+        keyframes: bool = False,
+        pix_fmt: str = 'gray',
+) -> FFmpeg.FFmpeg:
     """
+    FFmpeg command decoding (and selecting) the frames of a media as raw (gray by default) frames on stdout.
 
-    :param input: path or url of the media to read frames from
-    :type input: str
+    With `seek`, the start frame is reached with an input side seeking (`-ss` on the timestamp of
+    the frame, computed with the frame rate) instead of a select filter decoding every previous
+    frames: ffmpeg only decodes (and trims) the frames after the nearest keyframe, so the cost
+    depends on the length of the range, not on its position (constant frame rate is assumed).
 
-    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
-    :type start_frame: int
+    Sparse sampling modes (mutually exclusive) only output:
+    - `stride`: one frame every `stride` frames (of the selected range),
+    - `fps`: the first frame of each 1/`fps` seconds time slot. Same sampling as the ffmpeg fps filter
+      (without duplicated frames), but the selected frames keep their own timestamps,
+    - `keyframes`: the keyframes (I-frames), the others are not even decoded (`-skip_frame nokey`).
+      This mode can't be used with a frames range.
+    With `fps` and `keyframes`, the timestamps of the output frames are logged on stderr (showinfo filter).
 
+    :param input: path or url of the media to read frames from
+    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
     :param stop_frame: Index of the ending frame. Use None to stop at the ending of the media
-    :type stop_frame: int
-
     :param frame_width: Width of the result frame. Default to 32
-    :type frame_width: int
-
     :param frame_height: Height of the result frame. Default to 32
-    :type frame_height: int
-
+    :param seek: Use input seeking to reach start_frame. Default to False
+    :param frame_rate: Frame rate used by seek. Default to ffprobe value
+    :param stride: Sample one frame every `stride` frames. Default to None
+    :param fps: Sample the frames at `fps` frames per second. Default to None
+    :param keyframes: Sample (decode) only the keyframes. Default to False
+    :param pix_fmt: Pixel format of the result frame (see `PIX_FMT_CHANNELS`). Default to 'gray'
     :return:
-    :rtype: collections.Iterable[bytes]
     """
-
-    frame_size = frame_width * frame_height
+    if pix_fmt not in PIX_FMT_CHANNELS:
+        raise ValueError('Unsupported pixel format [{0}].'.format(pix_fmt))
+    if sum((bool(stride), bool(fps), keyframes)) > 1:
+        raise ValueError('Sampling modes (stride, fps, keyframes) are mutually exclusive.')
+    if keyframes and (start_frame is not None or stop_frame is not None):
+        raise ValueError('Keyframes sampling can\'t be used with a frames range.')
 
     ffmpeg = FFmpeg.FFmpeg()
+    # stderr is a pipe: no progress stats, only errors (showinfo logs the timestamps at info level)
+    ffmpeg.set_stats(False)
+    ffmpeg.set_log_level('info' if fps or keyframes else 'error')
+    if keyframes:
+        ffmpeg.set_skip_frame('nokey')
+    if seek and start_frame:
+        if frame_rate is None:
+            frame_rate = get_video_frame_rate(input)
+        ffmpeg.set_input_seek(calculate_frame_seek_time(start_frame, frame_rate))
+        # frames are counted from the seeking position
+        if stop_frame is not None:
+            stop_frame -= start_frame
+        start_frame = None
     ffmpeg.add_input_file(input)
     ffmpeg.set_output_file('-')
     ffmpeg.set_output_format('image2pipe')
@@ -57,6 +105,19 @@ def ffmpeg_frame_generator(
     f_scale.set_option('height', frame_height)
     ffmpeg.add_video_filter(f_scale)
 
+    # The select filter only drops frames: without an output bound, ffmpeg decodes until the end of
+    # the media. The number of output frames (or their duration) of the range is bounded instead,
+    # ffmpeg stops decoding once they are written.
+    if stop_frame is not None:
+        nb_range_frames = max(stop_frame - (start_frame or 0) + 1, 0)
+        if fps:
+            # the number of sampled frames depends on the timestamps: bound the duration
+            if frame_rate is None:
+                frame_rate = get_video_frame_rate(input)
+            ffmpeg.set_output_duration(nb_range_frames / frame_rate)
+        else:
+            ffmpeg.set_output_frames(-(-nb_range_frames // int(stride)) if stride else nb_range_frames)
+
     # Frame selections, based on
     # https://github.com/Holimetrix/hmx-ffmpeg-tools/blob/master/src/holimetrix/ffmpeg_tools/ffmpeg_cut.py#L208-L222
 
@@ -76,11 +137,81 @@ def ffmpeg_frame_generator(
     f_setpts.set_option('expr', 'PTS-STARTPTS')
     ffmpeg.add_video_filter(f_setpts)
 
-    ffmpeg.set_pixel_format('gray')
+    # Sparse sampling
+    if stride:
+        f_stride = FFmpegFilter.FFmpegFilter('select')
+        f_stride.set_option('expr', 'not(mod(n\\,{0}))'.format(int(stride)))
+        ffmpeg.add_video_filter(f_stride)
+    if fps:
+        f_fps = FFmpegFilter.FFmpegFilter('select')
+        f_fps.set_option('expr', 'isnan(prev_t)+gt(floor(t*{0})\\,floor(prev_t*{0}))'.format(fps))
+        ffmpeg.add_video_filter(f_fps)
+    if fps or keyframes:
+        ffmpeg.add_video_filter(FFmpegFilter.FFmpegFilter('showinfo'))
+
+    ffmpeg.set_pixel_format(pix_fmt)
+    # one output frame per selected frame (no duplicated/dropped frames to fit the muxer frame rate)
+    ffmpeg.set_vsync('passthrough')
+    return ffmpeg
+
+
+def drain_stream(stream):
+    """
+    Read (and drop) `stream` until its end, in a daemon thread: a process writing on an unread
+    pipe (ex: ffmpeg stderr) blocks once the pipe buffer (64 KiB) is full.
+    """
+    def _drain():
+        for _ in iter(lambda: stream.read(1 << 16), b''):
+            pass
+    threading.Thread(target=_drain, daemon=True).start()
+
+
+def ffmpeg_frame_generator(
+        input: str,
+        start_frame: int = None,
+        stop_frame: int = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        seek: bool = False,
+        frame_rate: float = None,
+) -> Generator[bytes, None, None]:
+
+    """
+
+    :param input: path or url of the media to read frames from
+    :type input: str
+
+    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
+    :type start_frame: int
+
+    :param stop_frame: Index of the ending frame. Use None to stop at the ending of the media
+    :type stop_frame: int
+
+    :param frame_width: Width of the result frame. Default to 32
+    :type frame_width: int
+
+    :param frame_height: Height of the result frame. Default to 32
+    :type frame_height: int
+
+    :param seek: Use input seeking to reach start_frame (see `build_ffmpeg_frame_extractor`). Default to False
+    :type seek: bool
+
+    :param frame_rate: Frame rate used by seek. Default to ffprobe value
+    :type frame_rate: float
+
+    :return:
+    :rtype: collections.Iterable[bytes]
+    """
+
+    frame_size = frame_width * frame_height
+
+    ffmpeg = build_ffmpeg_frame_extractor(input, start_frame, stop_frame, frame_width, frame_height,
+                                          seek, frame_rate)
     try:
         nb_frames = 0
 
         proc = ffmpeg.build().run()
+        drain_stream(proc.stderr)
 
         frame_data = proc.stdout.read(frame_size)
         while len(frame_data) > 0:
@@ -91,17 +222,131 @@ def ffmpeg_frame_generator(
 
         proc.wait()
         proc.stdout.close()
-
-        return nb_frames
     except subprocess.CalledProcessError:
         logging.error('FFmpeg failed.')
         return -1
+    if proc.returncode != 0:
+        raise FFException.BinaryCallFailed()
+    return nb_frames
+
+
+def readinto_full(stream, buffer: memoryview) -> int:
+    """
+    Fill `buffer` from `stream` (looping on short reads of the pipe) until it is full or EOF is reached.
+
+    :param stream: binary stream supporting `readinto`
+    :param buffer: writable bytes memoryview
+    :return: number of bytes read
+
+    >>> import io
+    >>> buffer = bytearray(4)
+    >>> readinto_full(io.BytesIO(b'abcdef'), memoryview(buffer)), bytes(buffer)
+    (4, b'abcd')
+    >>> readinto_full(io.BytesIO(b'ab'), memoryview(buffer)), bytes(buffer)
+    (2, b'abcd')
+    """
+    nb_bytes_read = 0
+    nb_bytes_to_read = len(buffer)
+    while nb_bytes_read < nb_bytes_to_read:
+        nb_bytes = stream.readinto(buffer[nb_bytes_read:])
+        if not nb_bytes:
+            break
+        nb_bytes_read += nb_bytes
+    return nb_bytes_read
+
+
+def read_frame_blocks(
+        stream,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        block_size: int = 512,
+        nb_blocks: int = 2,
+) -> Generator[np.ndarray, None, None]:
+    """
+    Read raw gray frames from `stream` into a preallocated ring buffer, see `ffmpeg_frame_block_generator`.
+
+    :param stream: binary stream supporting `readinto`
+    :param frame_width:
+    :param frame_height:
+    :param block_size:
+    :param nb_blocks:
+    :return:
+
+    >>> import io
+    >>> [block.shape for block in read_frame_blocks(io.BytesIO(bytes(5 * 4)), 2, 2, block_size=2)]
+    [(2, 2, 2), (2, 2, 2), (1, 2, 2)]
+    """
+    frame_size = frame_width * frame_height
+    ring_buffer = np.empty((nb_blocks, block_size, frame_height, frame_width), dtype=np.uint8)
+
+    id_block = 0
+    while True:
+        block = ring_buffer[id_block]
+        nb_bytes_read = readinto_full(stream, memoryview(block).cast('B'))
+        nb_frames_read = nb_bytes_read // frame_size
+        if nb_frames_read:
+            yield block[:nb_frames_read]
+        if nb_bytes_read < block.nbytes:
+            break
+        id_block = (id_block + 1) % nb_blocks
+
+
+def ffmpeg_frame_block_generator(
+        input: str,
+        start_frame: int = None,
+        stop_frame: int = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        block_size: int = 512,
+        nb_blocks: int = 2,
+        seek: bool = False,
+        frame_rate: float = None,
+        pix_fmt: str = 'gray',
+) -> Generator[np.ndarray, None, None]:
+    """
+    Block reading version of `ffmpeg_frame_generator`.
+
+    Frames are read with `readinto` directly into a preallocated ring buffer of `nb_blocks` blocks
+    of `block_size` frames, and yielded as zero-copy (k, frame_height, frame_width) uint8 views
+    ((k, frame_height, frame_width, 3) for rgb24 frames, k <= block_size).
+    Peak memory is bounded by nb_blocks * block_size * frame_width * frame_height * bytes per pixel.
+
+    A yielded view is only valid until the ring buffer wraps around (`nb_blocks - 1` blocks later):
+    copy it if it has to be kept longer.
+
+    :param input: path or url of the media to read frames from
+    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
+    :param stop_frame: Index of the ending frame. Use None to stop at the ending of the media
+    :param frame_width: Width of the result frame. Default to 32
+    :param frame_height: Height of the result frame. Default to 32
+    :param block_size: Number of frames read at once. Default to 512
+    :param nb_blocks: Number of blocks of the ring buffer. Default to 2
+    :param seek: Use input seeking to reach start_frame (see `build_ffmpeg_frame_extractor`). Default to False
+    :param frame_rate: Frame rate used by seek. Default to ffprobe value
+    :param pix_fmt: Pixel format of the result frame (see `PIX_FMT_CHANNELS`). Default to 'gray'
+    :return:
+    """
+    ffmpeg = build_ffmpeg_frame_extractor(input, start_frame, stop_frame, frame_width, frame_height,
+                                          seek, frame_rate, pix_fmt=pix_fmt)
+    nb_channels = PIX_FMT_CHANNELS[pix_fmt]
+    proc = ffmpeg.build().run()
+    drain_stream(proc.stderr)
+    try:
+        # a frame of nb_channels bytes per pixel has the size of a gray frame nb_channels times wider
+        for frames in read_frame_blocks(proc.stdout, frame_width * nb_channels, frame_height, block_size, nb_blocks):
+            yield frames if nb_channels == 1 else frames.reshape(len(frames), frame_height, frame_width, nb_channels)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    # frames read to the end (not an early close of the generator): a truncated decode is an error
+    if proc.returncode != 0:
+        raise FFException.BinaryCallFailed()
 
 
 def rawframe_to_imghash(
         raw_frame: bytes,
-        frame_width: int=32,
-        frame_height: int=32,
+        frame_width: int = 32,
+        frame_height: int = 32,
 ) -> imagehash.ImageHash:
     return imagehash.phash(
         Image.fromarray(
@@ -113,17 +358,579 @@ def rawframe_to_imghash(
     )
 
 
+def rawframes_to_imghashes(
+        raw_frames: bytes,
+        frame_width: int = 32,
+        frame_height: int = 32,
+) -> np.ndarray:
+    """
+    Batch version of `rawframe_to_imghash`: hash a block of concatenated raw gray frames.
+
+    :param raw_frames: concatenation of N raw frames (frame_width * frame_height bytes each)
+    :param frame_width:
+    :param frame_height:
+    :return: N uint64 imghashes (bit-identical to `rawframe_to_imghash`)
+    """
+    frames = np.frombuffer(raw_frames, dtype=np.uint8).reshape(-1, frame_height, frame_width)
+    return imghashes_phash(frames)
+
+
+def ffmpeg_imghash_block_generator(
+        input: str,
+        start_frame: int = None,
+        stop_frame: int = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        batch_size: int = 256,
+        seek: bool = False,
+        frame_rate: float = None,
+        hash_algos: Tuple[str, ...] = None,
+) -> Generator[np.ndarray, None, None]:
+    """
+    With `hash_algos`, all the hash algorithms are computed on the same decoded frames block:
+    decoding (the main cost) is done once whatever the number of algorithms.
+
+    :param input: path or url of the media to read frames from
+    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
+    :param stop_frame: Index of the ending frame. Use None to stop at the ending of the media
+    :param frame_width: Width of the result frame. Default to 32
+    :param frame_height: Height of the result frame. Default to 32
+    :param batch_size: Number of frames hashed together. Default to 256
+    :param seek: Use input seeking to reach start_frame (see `build_ffmpeg_frame_extractor`). Default to False
+    :param frame_rate: Frame rate used by seek. Default to ffprobe value
+    :param hash_algos: Names of the hash algorithms (see `imghashes_compute`). Default to None: pHash only
+    :return: blocks (of at most batch_size) of uint64 imghashes, (k,) pHash imghashes or,
+        with `hash_algos`, (k, len(hash_algos)) imghashes (one column per algorithm)
+    """
+    for frames in ffmpeg_frame_block_generator(input, start_frame, stop_frame, frame_width, frame_height,
+                                               block_size=batch_size, seek=seek, frame_rate=frame_rate):
+        yield _frames_block_to_imghashes(frames, hash_algos)
+
+
+def _frames_block_to_imghashes(frames: np.ndarray, hash_algos: Tuple[str, ...] = None) -> np.ndarray:
+    """ (k,) pHash imghashes of a frames block or, with `hash_algos`, (k, len(hash_algos)) imghashes """
+    if hash_algos is None:
+        return imghashes_phash(frames)
+    return imghashes_compute(frames, hash_algos)
+
+
+def pipelined_imghashes_blocks(
+        frames_blocks: Iterable[np.ndarray],
+        hash_func: Callable[[np.ndarray], np.ndarray] = imghashes_phash,
+        nb_workers: int = None,
+        queue_size: int = 8,
+        processes: bool = False,
+) -> Generator[np.ndarray, None, None]:
+    """
+    Pipelined hashing of frames blocks: a reader thread pulls the blocks (ex: ffmpeg decoding, see
+    `ffmpeg_frame_block_generator`) and submits their hashing to a pool of workers, while the caller
+    consumes the results. Decoding and hashing overlap: the throughput is bounded by the slower stage
+    instead of the sum of both.
+
+    The pending blocks are in a bounded queue (`queue_size`): when the hashing (or the caller) lags,
+    the reader blocks, and so does ffmpeg on its pipe. The results are yielded in the blocks order.
+
+    :param frames_blocks: blocks of frames (copied by the reader: they may be ring buffer views)
+    :param hash_func: vectorized hash function of a block (must be picklable with `processes`)
+    :param nb_workers: Number of hashing workers. Default to os.cpu_count()
+    :param queue_size: Maximum number of blocks read but not consumed yet. Default to 8
+    :param processes: Hash in worker processes instead of threads (NumPy/SciPy mostly release the GIL).
+        Default to False
+    :return: hash_func results, in the blocks order
+
+    >>> blocks = (np.full((2, 32, 32), i, dtype=np.uint8) for i in range(0, 256, 8))
+    >>> imghashes = list(pipelined_imghashes_blocks(blocks, lambda frames: frames[:, 0, 0], nb_workers=4))
+    >>> np.concatenate(imghashes).tolist() == [i for i in range(0, 256, 8) for _ in range(2)]
+    True
+    """
+    nb_workers = nb_workers or os.cpu_count() or 1
+    pending = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    end_of_blocks = object()
+
+    def _put(item) -> bool:
+        # give up if the consumer is gone
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(executor):
+        try:
+            for frames in frames_blocks:
+                if not _put(executor.submit(hash_func, np.array(frames))):
+                    break
+        except Exception as e:
+            _put(e)
+        finally:
+            if hasattr(frames_blocks, 'close'):
+                # stop the decoder (ex: generator closing the ffmpeg pipe)
+                frames_blocks.close()
+            _put(end_of_blocks)
+
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=nb_workers) as executor:
+        reader = threading.Thread(target=_read, args=(executor,), daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is end_of_blocks:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item.result()
+        finally:
+            stop.set()
+            reader.join()
+
+
+def ffmpeg_imghash_pipelined_generator(
+        input: str,
+        start_frame: int = None,
+        stop_frame: int = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        batch_size: int = 256,
+        seek: bool = False,
+        frame_rate: float = None,
+        hash_algos: Tuple[str, ...] = None,
+        nb_workers: int = None,
+        queue_size: int = 8,
+        processes: bool = False,
+) -> Generator[np.ndarray, None, None]:
+    """
+    Pipelined (decoding and hashing overlap) version of `ffmpeg_imghash_block_generator`,
+    see `pipelined_imghashes_blocks`.
+
+    :param input: path or url of the media to read frames from
+    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
+    :param stop_frame: Index of the ending frame. Use None to stop at the ending of the media
+    :param frame_width: Width of the result frame. Default to 32
+    :param frame_height: Height of the result frame. Default to 32
+    :param batch_size: Number of frames hashed together. Default to 256
+    :param seek: Use input seeking to reach start_frame (see `build_ffmpeg_frame_extractor`). Default to False
+    :param frame_rate: Frame rate used by seek. Default to ffprobe value
+    :param hash_algos: Names of the hash algorithms (see `imghashes_compute`). Default to None: pHash only
+    :param nb_workers: Number of hashing workers. Default to os.cpu_count()
+    :param queue_size: Maximum number of blocks read but not consumed yet. Default to 8
+    :param processes: Hash in worker processes instead of threads. Default to False
+    :return: blocks (of at most batch_size) of uint64 imghashes (see `ffmpeg_imghash_block_generator`)
+    """
+    frames_blocks = ffmpeg_frame_block_generator(input, start_frame, stop_frame, frame_width, frame_height,
+                                                 block_size=batch_size, seek=seek, frame_rate=frame_rate)
+    yield from pipelined_imghashes_blocks(frames_blocks, partial(_frames_block_to_imghashes, hash_algos=hash_algos),
+                                          nb_workers, queue_size, processes)
+
+
+def build_ffmpeg_frame_branches_extractor(
+        input: str,
+        media_width: int,
+        media_height: int,
+        frame_width: int = 32,
+        frame_height: int = 32,
+) -> FFmpeg.FFmpeg:
+    """
+    FFmpeg command decoding the frames of a media once, in two branches:
+    - a full resolution rgb24 branch,
+    - a hash branch, scaled to (frame_width, frame_height) gray frames (same pixels as
+      `build_ffmpeg_frame_extractor`), converted back to rgb24 (R=G=B=gray) and padded to the media width.
+    Both branches are stacked: each raw rgb24 output frame is (media_height + frame_height, media_width),
+    the gray frame is in the top left corner of the bottom strip. A single pipe carries both branches
+    frame by frame: no cross-pipe deadlock, no re-decoding to get back a full resolution frame.
+
+    :param input: path or url of the media to read frames from
+    :param media_width: Width of the media frames
+    :param media_height: Height of the media frames
+    :param frame_width: Width of the hash branch frame. Default to 32
+    :param frame_height: Height of the hash branch frame. Default to 32
+    :return:
+    """
+    if media_width < frame_width:
+        raise ValueError('Media width must be at least the hash frame width.')
+
+    ffmpeg = FFmpeg.FFmpeg()
+    # stderr is a pipe: no progress stats, only errors
+    ffmpeg.set_stats(False)
+    ffmpeg.set_log_level('error')
+    ffmpeg.add_input_file(input)
+    ffmpeg.set_output_file('-')
+    ffmpeg.set_output_format('image2pipe')
+    ffmpeg.set_video_encoder('rawvideo')
+
+    f_format_rgb = FFmpegFilter.FFmpegFilter('format')
+    f_format_rgb.set_option('pix_fmts', 'rgb24')
+    f_format_gray = FFmpegFilter.FFmpegFilter('format')
+    f_format_gray.set_option('pix_fmts', 'gray')
+    f_scale = FFmpegFilter.FFmpegFilter('scale')
+    f_scale.set_option('width', frame_width)
+    f_scale.set_option('height', frame_height)
+    f_pad = FFmpegFilter.FFmpegFilter('pad')
+    f_pad.set_option('width', media_width)
+    f_pad.set_option('height', frame_height)
+
+    filter_graph = FFmpegFilter.FFmpegFilterGraph()
+    filter_graph.add_chain(
+        FFmpegFilter.FFmpegFilterChain(outputs=('full', 'hash'))
+        .add_filter(FFmpegFilter.FFmpegFilter('split'))
+    )
+    filter_graph.add_chain(
+        FFmpegFilter.FFmpegFilterChain(inputs=('hash',), outputs=('strip',))
+        .add_filter(f_scale).add_filter(f_format_gray).add_filter(f_format_rgb).add_filter(f_pad)
+    )
+    # explicit rgb24 on the full branch: otherwise vstack negotiates a yuv format
+    # and the gray pixels of the strip are altered by the round trip
+    filter_graph.add_chain(
+        FFmpegFilter.FFmpegFilterChain(inputs=('full',), outputs=('rgb',))
+        .add_filter(f_format_rgb)
+    )
+    filter_graph.add_chain(
+        FFmpegFilter.FFmpegFilterChain(inputs=('rgb', 'strip'))
+        .add_filter(FFmpegFilter.FFmpegFilter('vstack'))
+    )
+    ffmpeg.add_video_filter(filter_graph)
+
+    ffmpeg.set_pixel_format('rgb24')
+    ffmpeg.set_vsync('passthrough')
+    return ffmpeg
+
+
+def ffmpeg_frame_branches_generator(
+        input: str,
+        media_size: Tuple[int, int] = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        block_size: int = 16,
+        nb_blocks: int = 2,
+) -> Generator[Tuple[np.ndarray, np.ndarray], None, None]:
+    """
+    Single decoding pass yielding, for each block of frames, the hash branch gray frames and the full
+    resolution frames (see `build_ffmpeg_frame_branches_extractor`).
+
+    Blocks are zero-copy views on a ring buffer (see `ffmpeg_frame_block_generator`): copy the full
+    resolution frames which have to be kept. Mind the memory: a block holds `block_size` full
+    resolution rgb24 frames.
+
+    :param input: path or url of the media to read frames from
+    :param media_size: (width, height) of the media frames. Default to ffprobe values
+    :param frame_width: Width of the hash branch frame. Default to 32
+    :param frame_height: Height of the hash branch frame. Default to 32
+    :param block_size: Number of frames read at once. Default to 16
+    :param nb_blocks: Number of blocks of the ring buffer. Default to 2
+    :return: blocks of ((k, frame_height, frame_width) uint8 gray frames, (k, height, width, 3) uint8 rgb frames)
+    """
+    media_width, media_height = media_size or get_video_frame_size(input)
+    ffmpeg = build_ffmpeg_frame_branches_extractor(input, media_width, media_height, frame_width, frame_height)
+    proc = ffmpeg.build().run()
+    drain_stream(proc.stderr)
+    try:
+        # a stacked rgb24 frame has the size of a gray frame 3 times wider
+        for stacked_frames in read_frame_blocks(proc.stdout, media_width * 3, media_height + frame_height,
+                                                block_size, nb_blocks):
+            stacked_frames = stacked_frames.reshape(len(stacked_frames), media_height + frame_height, media_width, 3)
+            yield (
+                stacked_frames[:, media_height:, :frame_width, 0],
+                stacked_frames[:, :media_height],
+            )
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
 def ffmpeg_imghash_generator(
         input: str,
         start_frame: int = None,
         stop_frame: int = None,
         frame_width: int = 32,
         frame_height: int = 32,
+        batch_size: int = None,
+        seek: bool = False,
+        frame_rate: float = None,
+        stride: int = None,
+        fps: float = None,
+        keyframes: bool = False,
+        nb_workers: int = None,
 ) -> Generator[imagehash.ImageHash, None, None]:
-    for raw_frame in ffmpeg_frame_generator(input, start_frame, stop_frame, frame_width, frame_height):
+    """
+
+    :param input: path or url of the media to read frames from
+    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
+    :param stop_frame: Index of the ending frame. Use None to stop at the ending of the media
+    :param frame_width: Width of the result frame. Default to 32
+    :param frame_height: Height of the result frame. Default to 32
+    :param batch_size: Use the vectorized (batch) pHash engine, hashing `batch_size` frames at once.
+        In this mode, imghashes are yielded as `np.uint64` (instead of `imagehash.ImageHash`).
+        Default to None (one `imagehash.phash` call per frame).
+    :param seek: Use input seeking to reach start_frame (see `build_ffmpeg_frame_extractor`). Default to False
+    :param frame_rate: Frame rate used by seek. Default to ffprobe value
+    :param stride: Sample one frame every `stride` frames. Default to None
+    :param fps: Sample the frames at `fps` frames per second. Default to None
+    :param keyframes: Sample (decode) only the keyframes. Default to False
+        With a sampling mode (stride, fps or keyframes), the vectorized engine is used and
+        (source frame index, `np.uint64` imghash) tuples are yielded (see `ffmpeg_imghash_sampled_generator`).
+    :param nb_workers: Pipelined decoding/hashing with `nb_workers` hashing workers
+        (see `ffmpeg_imghash_pipelined_generator`), with the vectorized engine. Default to None
+    :return:
+    """
+    if stride or fps or keyframes:
+        for frames_ids, imghashes in ffmpeg_imghash_sampled_generator(input, start_frame, stop_frame,
+                                                                      frame_width, frame_height,
+                                                                      batch_size or 256, seek, frame_rate,
+                                                                      stride, fps, keyframes):
+            yield from zip(frames_ids, imghashes)
+        return
+
+    if nb_workers:
+        for imghashes in ffmpeg_imghash_pipelined_generator(input, start_frame, stop_frame,
+                                                            frame_width, frame_height, batch_size or 256,
+                                                            seek, frame_rate, nb_workers=nb_workers):
+            yield from imghashes
+        return
+
+    if batch_size:
+        for imghashes in ffmpeg_imghash_block_generator(input, start_frame, stop_frame,
+                                                        frame_width, frame_height, batch_size,
+                                                        seek, frame_rate):
+            yield from imghashes
+        return
+
+    for raw_frame in ffmpeg_frame_generator(input, start_frame, stop_frame, frame_width, frame_height,
+                                            seek, frame_rate):
         yield rawframe_to_imghash(raw_frame)
 
 
+def _read_showinfo_pts_times(stream, pts_times: queue.Queue):
+    """
+    Push the timestamps (in seconds) logged by the ffmpeg showinfo filter into `pts_times`.
+    None is pushed at the end of the stream.
+    """
+    regex = re.compile(r'\bpts_time:\s*(\S+)')
+    for line in iter(stream.readline, b''):
+        match = regex.search(line.decode('utf-8', errors='replace'))
+        if match:
+            try:
+                pts_times.put(float(match.group(1)))
+            except ValueError:
+                pts_times.put(float('nan'))
+    pts_times.put(None)
+
+
+def ffmpeg_imghash_sampled_generator(
+        input: str,
+        start_frame: int = None,
+        stop_frame: int = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        batch_size: int = 256,
+        seek: bool = False,
+        frame_rate: float = None,
+        stride: int = None,
+        fps: float = None,
+        keyframes: bool = False,
+        hash_algos: Tuple[str, ...] = None,
+) -> Generator[Tuple[np.ndarray, np.ndarray], None, None]:
+    """
+    Sparse sampling version of `ffmpeg_imghash_block_generator` (see `build_ffmpeg_frame_extractor`
+    for the sampling modes), recording the source frame index of each imghash.
+
+    - `stride`: indices are exact (start_frame + k * stride),
+    - `fps` and `keyframes`: indices are computed from the timestamps of the sampled frames (logged by
+      ffmpeg) and the frame rate. A frame without a (valid) timestamp raises a ValueError.
+
+    :param input: path or url of the media to read frames from
+    :param start_frame: Index of the starting frame. Use None to start at the beginning of the media
+    :param stop_frame: Index of the ending frame. Use None to stop at the ending of the media
+    :param frame_width: Width of the result frame. Default to 32
+    :param frame_height: Height of the result frame. Default to 32
+    :param batch_size: Number of frames hashed together. Default to 256
+    :param seek: Use input seeking to reach start_frame (see `build_ffmpeg_frame_extractor`). Default to False
+    :param frame_rate: Frame rate of the media (seek, fps and keyframes modes). Default to ffprobe value
+    :param stride: Sample one frame every `stride` frames. Default to None
+    :param fps: Sample the frames at `fps` frames per second. Default to None
+    :param keyframes: Sample (decode) only the keyframes. Default to False
+    :param hash_algos: Names of the hash algorithms (see `imghashes_compute`). Default to None: pHash only
+    :return: blocks of (source frames indices (int64), uint64 imghashes (see `ffmpeg_imghash_block_generator`))
+    """
+    if frame_rate is None and (fps or keyframes or (seek and start_frame)):
+        frame_rate = get_video_frame_rate(input)
+    first_frame = start_frame or 0
+
+    ffmpeg = build_ffmpeg_frame_extractor(input, start_frame, stop_frame, frame_width, frame_height,
+                                          seek, frame_rate, stride, fps, keyframes)
+    proc = ffmpeg.build().run()
+
+    pts_times = queue.Queue()
+    if fps or keyframes:
+        threading.Thread(target=_read_showinfo_pts_times, args=(proc.stderr, pts_times), daemon=True).start()
+    else:
+        drain_stream(proc.stderr)
+
+    try:
+        nb_frames = 0
+        for frames in read_frame_blocks(proc.stdout, frame_width, frame_height, block_size=batch_size):
+            ids = np.arange(nb_frames, nb_frames + len(frames))
+            if stride:
+                frames_ids = first_frame + ids * int(stride)
+            elif fps or keyframes:
+                frames_pts_times = np.empty(len(frames), dtype=np.float64)
+                for id_frame in range(len(frames)):
+                    pts_time = pts_times.get()
+                    # None: end of the showinfo log (nothing more will be pushed), nan: unparsable
+                    if pts_time is None or not np.isfinite(pts_time):
+                        raise ValueError('Missing or invalid timestamp (ffmpeg showinfo) of the sampled '
+                                         'frame [{0}].'.format(nb_frames + id_frame))
+                    frames_pts_times[id_frame] = pts_time
+                frames_ids = first_frame + np.rint(frames_pts_times * frame_rate).astype(np.int64)
+            else:
+                frames_ids = first_frame + ids
+            nb_frames += len(frames)
+            yield frames_ids, _frames_block_to_imghashes(frames, hash_algos)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise FFException.BinaryCallFailed()
+
+
+def get_video_nb_frames(media_fp: str) -> int:
+    """
+    Number of frames of the first video stream, from ffprobe.
+    Fallback on duration * frame rate if the container does not store it.
+
+    :param media_fp:
+    :return:
+    """
+    if FFprobe.binary_path is None:
+        FFprobe.initialize()
+    media = FFMedia.FFMedia(media_fp)
+    try:
+        return int(media.stream_entry("v:0", "nb_frames"))
+    except (FFException.StreamEntryNotFound, ValueError):
+        pass
+    try:
+        return int(float(media.stream_entry("v:0", "duration")) * get_video_frame_rate(media_fp))
+    except ValueError as e:
+        logging.error('FFprobe \'duration\' entry does not seem valid')
+        raise e
+
+
+def get_video_frame_size(media_fp: str) -> Tuple[int, int]:
+    """
+    (width, height) of the frames of the first video stream, from ffprobe.
+
+    :param media_fp:
+    :return:
+    """
+    if FFprobe.binary_path is None:
+        FFprobe.initialize()
+    media = FFMedia.FFMedia(media_fp)
+    return int(media.stream_entry("v:0", "width")), int(media.stream_entry("v:0", "height"))
+
+
+def split_frames_ranges(nb_frames: int, nb_shards: int) -> List[Tuple[int, int]]:
+    """
+    Split [0, nb_frames[ in (at most) nb_shards contiguous (start_frame, stop_frame) ranges.
+    The last range is left open (stop_frame=None), so an approximate nb_frames is enough
+    to cover the whole media.
+
+    :param nb_frames:
+    :param nb_shards:
+    :return:
+
+    >>> split_frames_ranges(10, 3)
+    [(0, 2), (3, 5), (6, None)]
+    >>> split_frames_ranges(2, 4)
+    [(0, 0), (1, None)]
+    >>> split_frames_ranges(0, 4)
+    [(0, None)]
+    """
+    nb_shards = max(1, min(nb_shards, nb_frames))
+    bounds = [(nb_frames * i_shard) // nb_shards for i_shard in range(nb_shards)]
+    return list(zip(bounds, [bound - 1 for bound in bounds[1:]] + [None]))
+
+
+def _ffmpeg_imghash_shard(
+        args: Tuple[str, int, int, int, int, int, bool, float, Tuple[str, ...]],
+) -> np.ndarray:
+    input, start_frame, stop_frame, frame_width, frame_height, batch_size, seek, frame_rate, hash_algos = args
+    imghashes = list(ffmpeg_imghash_block_generator(input, start_frame, stop_frame,
+                                                    frame_width, frame_height, batch_size,
+                                                    seek, frame_rate, hash_algos))
+    if not imghashes:
+        return np.empty(0 if hash_algos is None else (0, len(hash_algos)), dtype=np.uint64)
+    return np.concatenate(imghashes)
+
+
+def ffmpeg_imghash_parallel_generator(
+        input: str,
+        nb_workers: int = None,
+        nb_frames: int = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        batch_size: int = 256,
+        seek: bool = True,
+        frame_rate: float = None,
+        hash_algos: Tuple[str, ...] = None,
+) -> Generator[np.ndarray, None, None]:
+    """
+    Split the media in frames ranges and compute the imghashes of each range in its own process
+    (one ffmpeg decoder + one hashing worker per range).
+    Ranges are selected with the same `start_frame`/`stop_frame` plumbing as a single-pass run,
+    so frames indices and imghashes on shards boundaries are identical.
+    Each decoder stops after the last frame of its range (`-frames:v`), and with `seek` (default)
+    starts at its range (input seeking, from the keyframe at or before it) instead of decoding (and
+    dropping) all the frames before it: the shards decode about one media in total. Without `seek`,
+    the last shard decodes the whole media, no faster than a single pass.
+
+    :param input: path or url of the media to read frames from
+    :param nb_workers: Number of worker processes. Default to os.cpu_count()
+    :param nb_frames: (Approximate) number of frames of the media. Default to ffprobe value
+    :param frame_width: Width of the result frame. Default to 32
+    :param frame_height: Height of the result frame. Default to 32
+    :param batch_size: Number of frames hashed together. Default to 256
+    :param seek: Use input seeking to reach the start of each range. Default to True
+    :param frame_rate: Frame rate used by seek. Default to ffprobe value
+    :param hash_algos: Names of the hash algorithms (see `imghashes_compute`). Default to None: pHash only
+    :return: uint64 imghashes blocks (one per shard), in frames order
+    """
+    nb_workers = nb_workers or os.cpu_count() or 1
+    if nb_frames is None:
+        nb_frames = get_video_nb_frames(input)
+    if seek and frame_rate is None:
+        frame_rate = get_video_frame_rate(input)
+    shards = [
+        (input, start_frame, stop_frame, frame_width, frame_height, batch_size, seek, frame_rate, hash_algos)
+        for start_frame, stop_frame in split_frames_ranges(nb_frames, nb_workers)
+    ]
+    with Pool(processes=min(nb_workers, len(shards))) as pool:
+        # imap keeps the shards order
+        yield from pool.imap(_ffmpeg_imghash_shard, shards)
+
+
+def ffmpeg_imghash_parallel(
+        input: str,
+        nb_workers: int = None,
+        nb_frames: int = None,
+        frame_width: int = 32,
+        frame_height: int = 32,
+        batch_size: int = 256,
+        seek: bool = True,
+        frame_rate: float = None,
+        hash_algos: Tuple[str, ...] = None,
+) -> np.ndarray:
+    """
+    Stitched (frames ordered) result of `ffmpeg_imghash_parallel_generator`.
+
+    :return: uint64 imghashes of all the frames of the media
+    """
+    return np.concatenate(list(ffmpeg_imghash_parallel_generator(
+        input, nb_workers, nb_frames, frame_width, frame_height, batch_size, seek, frame_rate, hash_algos
+    )))
+
+
 if __name__ == '__main__':
     from pathlib import Path
     # root_path = Path('data/')
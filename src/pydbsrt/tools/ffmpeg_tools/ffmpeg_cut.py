@@ -9,6 +9,8 @@ import subprocess
 import re
 import sys
 import json
+from fractions import Fraction
+from math import floor
 
 from pydbsrt.tools.ffmpeg_wrapper import FFException
 from pydbsrt.tools.ffmpeg_wrapper import FFmpeg
@@ -32,15 +34,19 @@ def set_select_expression(
     Returns:
         select_expression (str):
 
+    The select filter only drops the frames out of the range: with a stop frame, the caller
+    bounds the number of output frames (`FFmpeg.set_output_frames`), otherwise ffmpeg decodes
+    until the end of the media.
+
     Examples:
         >>> set_select_expression('BEGIN', 'END')
-        'gte(n\\\,0)'
+        'gte(n\\\\,0)'
         >>> set_select_expression('BEGIN', 500)
-        'gte(n\\\,0)*lte(n\\\,500)'
+        'gte(n\\\\,0)*lte(n\\\\,500)'
         >>> set_select_expression(50, 500)
-        'gte(n\\\,50)*lte(n\\\,500)'
+        'gte(n\\\\,50)*lte(n\\\\,500)'
         >>> set_select_expression(200, 50)
-        'gte(n\\\,200)*lte(n\\\,50)'
+        'gte(n\\\\,200)*lte(n\\\\,50)'
 
         # Tests TODO:
         # - Specify BEGIN
@@ -61,7 +67,7 @@ def set_select_expression(
     else:
         if int(frame_start) < 0:
             raise ValueError('Invalid start frame [{0}].'.format(frame_start))
-        select_expression += 'gte(n\,{0})'.format(i_frame_start)
+        select_expression += r'gte(n\,{0})'.format(i_frame_start)
 
     if frame_stop != 'END':
         try:
@@ -72,7 +78,7 @@ def set_select_expression(
         else:
             if i_frame_stop < 0:
                 raise ValueError('Invalid stop frame [{0}].'.format(frame_stop))
-            select_expression += '*lte(n\,{0})'.format(i_frame_stop)
+            select_expression += r'*lte(n\,{0})'.format(i_frame_stop)
 
     return select_expression
 
@@ -94,7 +100,7 @@ def set_aselect_expression(
 
     Examples:
         >>> set_aselect_expression('BEGIN', 'END', '')
-        'gte(t\\\,0)'
+        'gte(t\\\\,0)'
 
         # Tests TODO:
         # - Specify BEGIN
@@ -107,7 +113,7 @@ def set_aselect_expression(
     aselect_expression = ""
 
     if frame_start == 'BEGIN':
-        aselect_expression += 'gte(t\,0)'
+        aselect_expression += r'gte(t\,0)'
     else:
         try:
             i_frame_start = int(frame_start)
@@ -117,7 +123,7 @@ def set_aselect_expression(
         else:
             if int(frame_start) < 0:
                 raise ValueError('Invalid start frame [{0}].'.format(frame_start))
-            aselect_expression += 'gte(t\,{0})'.format(calculate_frame_pts_time(i_frame_start, input_file))
+            aselect_expression += r'gte(t\,{0})'.format(calculate_frame_pts_time(i_frame_start, input_file))
 
     if frame_stop != 'END':
         try:
@@ -128,11 +134,81 @@ def set_aselect_expression(
         else:
             if i_frame_stop < 0:
                 raise ValueError('Invalid stop frame [{0}].'.format(frame_stop))
-            aselect_expression += '*lte(t\,{0})'.format(calculate_frame_pts_time(i_frame_stop, input_file))
+            aselect_expression += r'*lte(t\,{0})'.format(calculate_frame_pts_time(i_frame_stop, input_file))
 
     return aselect_expression
 
 
+def get_video_frame_rate(
+        media_fp
+):
+    """
+
+        Args:
+            media_fp (str): Media file path
+
+        Returns:
+            frame_rate(float): Frame rate (from 'r_frame_rate' ffprobe entry) of the first video stream
+    """
+    regex = re.compile(r'(\d+)/(\d+)')
+
+    try:
+        if FFprobe.binary_path is None:
+            FFprobe.initialize()
+        m = FFMedia.FFMedia(media_fp)
+        frame_rate_entry = m.stream_entry("v:0", "r_frame_rate")
+        match = regex.match(frame_rate_entry)
+        if not match:
+            raise ValueError('Invalid frame rate [{0}].'.format(frame_rate_entry))
+        return int(match.group(1)) / int(match.group(2))
+    except FFException.InvalidMedia as e:
+        logger.error("Invalid media [{}].".format(e.media_path))
+        raise e
+    except subprocess.CalledProcessError as e:
+        logger.error('FFprobe failed.')
+        raise e
+    except json.JSONDecodeError as e:
+        logger.error('Unable to decode json from FFprobe output.')
+        raise e
+    except ValueError as e:
+        logger.error('FFprobe \'r_frame_rate\' entry does not seem valid')
+        raise e
+
+
+def calculate_frame_seek_time(
+        n,
+        frame_rate
+):
+    """
+    Input seeking position for a frame index.
+
+    The position is the exact timestamp of the frame (rational frame rate, floored to the
+    microsecond precision of ffmpeg positions): ffmpeg (accurate seek) decodes from the keyframe at
+    or before the frame and only trims the frames before `n`. A position before the frame timestamp
+    would make ffmpeg decode from the previous keyframe when `n` is itself a keyframe (a whole extra
+    GOP for ranges starting on keyframes). Constant frame rate is assumed.
+
+        Args:
+            n (int): Frame indice
+            frame_rate (float): Frame rate of the media
+
+        Returns:
+            seek_time(float): Input seeking position in seconds
+
+        Examples:
+            >>> calculate_frame_seek_time(0, 25)
+            0
+            >>> calculate_frame_seek_time(250, 25)
+            10.0
+            >>> calculate_frame_seek_time(100000, 24000 / 1001)
+            4170.833333
+    """
+    if n <= 0:
+        return 0
+    frame_rate = Fraction(frame_rate).limit_denominator(100000)
+    return floor(n * 1000000 / frame_rate) / 1000000
+
+
 def calculate_frame_pts_time(
         n,
         media_fp
@@ -146,7 +222,7 @@ def calculate_frame_pts_time(
         Returns:
             pts_time(float): Presentation Time Stamp in seconds
     """
-    regex = re.compile('(\d+)/(\d+)')
+    regex = re.compile(r'(\d+)/(\d+)')
 
     try:
         m = FFMedia.FFMedia(media_fp)
@@ -177,6 +253,7 @@ def cut(
         frame_stop="END",
         decoder="",
         encoder="",
+        seek=False,
 ):
     """
 
@@ -187,12 +264,22 @@ def cut(
         encoder(str):
         frame_start(str):
         frame_stop(str):
+        seek(bool): Use input seeking (instead of decoding every frame before frame_start)
 
     Returns:
         return_code(int): FFmpeg return code
     """
 
     try:
+        seek_time = None
+        if seek and frame_start != 'BEGIN' and int(frame_start) > 0:
+            i_frame_start = int(frame_start)
+            seek_time = calculate_frame_seek_time(i_frame_start, get_video_frame_rate(input_file))
+            # frames (and audio timestamps) are counted from the seeking position
+            frame_start = 'BEGIN'
+            if frame_stop != 'END':
+                frame_stop = int(frame_stop) - i_frame_start
+
         select_expression = set_select_expression(frame_start, frame_stop)
         aselect_expression = set_aselect_expression(frame_start, frame_stop, input_file)
 
@@ -200,8 +287,13 @@ def cut(
         logger.info("Audio Select Expression [{0}]".format(aselect_expression))
 
         ffmpeg = FFmpeg.FFmpeg()
+        ffmpeg.set_input_seek(seek_time)
         ffmpeg.add_input_file(input_file)
         ffmpeg.set_output_file(output_file)
+        if frame_stop != 'END':
+            # the select filter only drops frames: stop decoding after the last frame of the range
+            i_frame_start = 0 if frame_start == 'BEGIN' else int(frame_start)
+            ffmpeg.set_output_frames(max(int(frame_stop) - i_frame_start + 1, 0))
         ffmpeg.set_video_decoder(decoder)
         ffmpeg.set_video_encoder(encoder)
 
@@ -257,6 +349,7 @@ def process(args):
             args.frame_stop,
             args.decoder,
             args.encoder,
+            args.seek,
         )
 
 
@@ -305,6 +398,10 @@ def build_parser(parser=None, **argparse_options):
                         default="",
                         required=False,
                         help="")
+    parser.add_argument("-s", '--seek', dest="seek",
+                        action="store_true",
+                        default=False,
+                        help="use input seeking to reach the start frame")
     #
     parser.add_argument("-v", "--verbose", action="store_true", default=False,
                         help="increase output verbosity")
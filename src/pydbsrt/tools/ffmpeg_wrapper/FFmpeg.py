@@ -36,6 +36,8 @@ class FFmpeg(object):
     def __init__(self):
         self.input_file = list()
         self.input_format = None
+        self.input_seek = None
+        self.skip_frame = None
 
         self.output_file = None
         self.output_format = None
@@ -55,8 +57,16 @@ class FFmpeg(object):
 
         self.pixel_format = None
 
+        self.vsync = None
+
+        self.output_frames = None
+        self.output_duration = None
+
         self.safe = None
 
+        self.log_level = None
+        self.stats = True
+
         self.built_cmd = None
 
     def set_safe(self, safe):
@@ -82,6 +92,20 @@ class FFmpeg(object):
         self.input_format = fmt
         return self
 
+    def set_input_seek(self, position):
+        """
+        Setter (input side seeking, in seconds)
+        """
+        self.input_seek = position
+        return self
+
+    def set_skip_frame(self, skip_frame):
+        """
+        Setter (decoder frames skipping, ex: 'nokey' to decode only keyframes)
+        """
+        self.skip_frame = skip_frame
+        return self
+
     def set_output_file(self, outfile):
         """
         Setter
@@ -171,11 +195,52 @@ class FFmpeg(object):
         """
         self.pixel_format = pixel_format
 
+    def set_vsync(self, vsync):
+        """
+        Setter
+        :param vsync:
+        :return:
+        """
+        self.vsync = vsync
+        return self
+
+    def set_log_level(self, log_level):
+        """
+        Setter (ex: 'error', 'info')
+        """
+        self.log_level = log_level
+        return self
+
+    def set_stats(self, stats):
+        """
+        Setter (periodic progress stats on stderr, on by default)
+        """
+        self.stats = stats
+        return self
+
+    def set_output_frames(self, nb_frames):
+        """
+        Setter (maximum number of output video frames: ffmpeg stops decoding once they are written)
+        """
+        self.output_frames = nb_frames
+        return self
+
+    def set_output_duration(self, duration):
+        """
+        Setter (maximum output duration, in seconds: ffmpeg stops decoding after it)
+        """
+        self.output_duration = duration
+        return self
+
     def build(self):
         """
         Builder
         """
         cmd = ['ffmpeg', '-y', '-hide_banner']
+        if not self.stats:
+            cmd += ['-nostats']
+        if self.log_level:
+            cmd += ['-loglevel', self.log_level]
 
         # Hardware Acceleration
         if self.hw_acceleration:
@@ -186,6 +251,10 @@ class FFmpeg(object):
             cmd += ['-safe', str(self.safe)]
 
         # Input
+        if self.input_seek is not None:
+            cmd += ['-ss', str(self.input_seek)]
+        if self.skip_frame:
+            cmd += ['-skip_frame', self.skip_frame]
         if self.input_format:
             cmd += ['-f', self.input_format]
         if self.input_file:
@@ -219,6 +288,14 @@ class FFmpeg(object):
         if self.pixel_format:
             cmd += ['-pix_fmt', self.pixel_format]
 
+        if self.vsync:
+            cmd += ['-vsync', self.vsync]
+
+        if self.output_frames is not None:
+            cmd += ['-frames:v', str(self.output_frames)]
+        if self.output_duration is not None:
+            cmd += ['-t', str(self.output_duration)]
+
         # Output
         if self.output_format:
             cmd += ['-f', self.output_format]
@@ -39,3 +39,56 @@ class FFmpegFilter(object):
             built_string += '='
             built_string += ':'.join('{0}={1}'.format(opt, val) for opt, val in self.opts.items())
         return built_string
+
+
+class FFmpegFilterChain(object):
+    """A simple builder of a ffmpeg filter chain, with (optional) input and output link labels"""
+
+    def __init__(self, inputs=(), outputs=()):
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.filters = list()
+
+    def add_filter(self, ffmpeg_filter):
+        """
+        Append a filter (FFmpegFilter) to the chain.
+        """
+        self.filters.append(ffmpeg_filter)
+        return self
+
+    def build(self):
+        """
+        Build a valid ffmpeg filter chain string.
+
+        Example: "[full][strip]vstack[out]"
+        """
+        return (
+            ''.join('[{0}]'.format(label) for label in self.inputs) +
+            ','.join(f.build() for f in self.filters) +
+            ''.join('[{0}]'.format(label) for label in self.outputs)
+        )
+
+
+class FFmpegFilterGraph(object):
+    """
+    A simple builder of a ffmpeg filter graph (filter chains separated by ';').
+
+    A graph with a single (unlabeled) input and a single (unlabeled) output is a valid
+    video filter (`-vf`), ex: to split the decoded frames in branches and merge them back.
+    """
+
+    def __init__(self):
+        self.chains = list()
+
+    def add_chain(self, chain):
+        """
+        Append a filter chain (FFmpegFilterChain) to the graph.
+        """
+        self.chains.append(chain)
+        return self
+
+    def build(self):
+        """
+        Build a valid ffmpeg filter graph string.
+        """
+        return ';'.join(chain.build() for chain in self.chains)
@@ -61,6 +61,19 @@ def stream(media, index):
         return None
 
 
+def probe(url):
+    """
+    JSON streams and format of a media, in a single FFprobe call
+    :param url:
+    :return:
+    """
+    output = run(['-i', url,
+                  '-print_format', 'json',
+                  '-show_streams',
+                  '-show_format'])
+    return json.loads(output)
+
+
 def run(opts):
     """
 
@@ -0,0 +1,222 @@
+"""
+Content-addressed fingerprints cache.
+
+Entries are keyed on a cheap content identity of the media (size, mtime and a hash of a few
+sampled byte ranges) and on the extraction parameters: renaming/moving a media keeps its entry,
+replacing it at the same path invalidates it.
+The cache size is capped, least recently used entries are evicted first.
+Partial (resumable) and temporary files left by interrupted exports are evicted once abandoned.
+"""
+import attr
+import fcntl
+from hashlib import md5
+from itertools import chain
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENTRY_SUFFIX = '.ba'
+
+
+def media_content_id(
+        media_path: Path,
+        nb_samples: int = 5,
+        sample_size: int = 1 << 16,
+) -> str:
+    """
+    Cheap content identity of a media: size, mtime and md5 of `nb_samples` byte ranges
+    (of `sample_size` bytes) evenly spread over the file.
+
+    :param media_path:
+    :param nb_samples:
+    :param sample_size:
+    :return:
+
+    >>> import tempfile
+    >>> media_fp = Path(tempfile.mkdtemp()).joinpath('media.mp4')
+    >>> _ = media_fp.write_bytes(bytes(range(256)) * 1024)
+    >>> content_id = media_content_id(media_fp)
+    >>> moved_fp = media_fp.rename(media_fp.with_name('moved.mp4'))
+    >>> media_content_id(moved_fp) == content_id
+    True
+    """
+    media_path = Path(media_path)
+    stat = media_path.stat()
+    content_id = md5(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    with open(str(media_path), 'rb') as f:
+        if stat.st_size <= nb_samples * sample_size:
+            content_id.update(f.read())
+        else:
+            step = (stat.st_size - sample_size) // (nb_samples - 1) if nb_samples > 1 else 0
+            for id_sample in range(nb_samples):
+                f.seek(id_sample * step)
+                content_id.update(f.read(sample_size))
+    return content_id.hexdigest()
+
+
+def extraction_params_key(**extraction_params) -> str:
+    """
+    Canonical representation of extraction parameters (None values are ignored).
+
+    >>> extraction_params_key(stride=None, keyframes=False, fps=2)
+    'fps=2,keyframes=False'
+    """
+    return ','.join(
+        f'{name}={value}'
+        for name, value in sorted(extraction_params.items())
+        if value is not None
+    )
+
+
+def fingerprint_cache_key(content_id: str, **extraction_params) -> str:
+    return md5(f'{content_id}|{extraction_params_key(**extraction_params)}'.encode()).hexdigest()
+
+
+def export_cache_key(
+        content_id: str,
+        hash_algos: Tuple[str, ...] = ('phash',),
+        stride: int = None,
+        fps: float = None,
+        keyframes: bool = False,
+) -> str:
+    """
+    Cache key of the fingerprints (of 32x32 gray frames) exported by `pydbsrt.app.export_fingerprints`.
+    The vectorized and per frame engines are bit-identical: the engine is not part of the key.
+    """
+    return fingerprint_cache_key(
+        content_id, hash_algo=','.join(hash_algos), frame_size=(32, 32), stride=stride, fps=fps,
+        keyframes=keyframes or None,
+    )
+
+
+@attr.s()
+class FingerprintCache:
+    """
+    Fingerprints files cache, in `root` directory, capped to `max_size` bytes.
+
+    The (hidden) partial and temporary files of the exports count in the cache size once they are
+    older than `partial_max_age` seconds: an export still writing (or locking) them keeps them,
+    otherwise they are abandoned (interrupted export never resumed) and evicted first.
+    """
+    root = attr.ib(type=Path, default=Path('/tmp/imghash'), converter=Path)
+    max_size = attr.ib(type=int, default=16 << 30)
+    partial_max_age = attr.ib(type=float, default=24 * 3600)
+
+    def __attrs_post_init__(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def key(self, media_path: Path, **extraction_params) -> str:
+        return fingerprint_cache_key(media_content_id(media_path), **extraction_params)
+
+    def path(self, key: str, suffix: str = CACHE_ENTRY_SUFFIX) -> Path:
+        return self.root.joinpath(f'{key}{suffix}')
+
+    def partial_path(self, key: str, suffix: str = CACHE_ENTRY_SUFFIX) -> Path:
+        """ Path of the (hidden, ie not an entry) partial file of an export in progress """
+        return self.root.joinpath(f'.{key}{suffix}.partial')
+
+    def get(self, key: str, suffixes=(CACHE_ENTRY_SUFFIX,)) -> Optional[Path]:
+        """
+        Path of the cached entry (all the `suffixes` files must exist), None on cache miss.
+        A hit refreshes the entry recency (mtime, for LRU eviction).
+        """
+        paths = [self.path(key, suffix) for suffix in suffixes]
+        try:
+            for path in paths:
+                os.utime(str(path))
+        except FileNotFoundError:
+            return None
+        return paths[0]
+
+    def entries(self) -> Iterator[Path]:
+        # temporary files (atomic writes in progress) are hidden, ie not matched
+        return self.root.glob('[!.]*')
+
+    def abandoned_files(self) -> Iterator[Path]:
+        """ Partial and temporary files not modified for `partial_max_age` seconds """
+        max_mtime = time.time() - self.partial_max_age
+        for path in self.root.glob('.*'):
+            if not path.name.endswith(('.partial', '.tmp')):
+                continue
+            try:
+                if path.stat().st_mtime < max_mtime:
+                    yield path
+            except FileNotFoundError:
+                pass
+
+    def size(self) -> int:
+        size = 0
+        for path in chain(self.entries(), self.abandoned_files()):
+            try:
+                size += path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _evict_abandoned_file(self, path: Path):
+        """ Remove an abandoned file, unless an export holds its lock """
+        try:
+            with open(str(path), 'rb') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # a (slow) export resumes it
+                    return
+                path.unlink()
+        except FileNotFoundError:
+            return
+        logger.info("Evict abandoned fingerprints cache file [{}].".format(path.name))
+
+    def evict(self, keep: str = None):
+        """
+        Remove the abandoned partial and temporary files (see `abandoned_files`), then the least
+        recently used entries until the cache size is under `max_size`.
+        The files of an entry (ex: '.ba' and '.ids' of a sampled export) are evicted together.
+
+        :param keep: key of an entry which must not be evicted (ex: the one just written)
+
+        >>> import tempfile
+        >>> cache = FingerprintCache(tempfile.mkdtemp(), max_size=10)
+        >>> for mtime, key in enumerate(('old', 'new')):
+        ...     for suffix in ('.ba', '.ids'):
+        ...         _ = cache.path(key, suffix).write_bytes(bytes(4))
+        ...         os.utime(str(cache.path(key, suffix)), (mtime, mtime))
+        >>> cache.evict()
+        >>> sorted(path.name for path in cache.entries())
+        ['new.ba', 'new.ids']
+        >>> _ = cache.partial_path('old').write_bytes(bytes(4))
+        >>> os.utime(str(cache.partial_path('old')), (0, 0))
+        >>> cache.size()
+        12
+        >>> cache.evict()
+        >>> cache.partial_path('old').exists(), cache.size()
+        (False, 8)
+        """
+        for path in list(self.abandoned_files()):
+            self._evict_abandoned_file(path)
+        entries = {}
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            key = entry.name.split('.', 1)[0]
+            mtime, size, paths = entries.get(key, (0.0, 0, []))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [entry])
+        cache_size = sum(size for _, size, _ in entries.values())
+        for key, (_, size, paths) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if cache_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            for path in paths:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            logger.info("Evict fingerprints cache entry [{}].".format(key))
+            cache_size -= size
@@ -0,0 +1,338 @@
+"""
+Self-describing fingerprints file format.
+
+Layout (little-endian):
+- a fixed size header (`HEADER_SIZE` bytes, see `HEADER_STRUCT`):
+  magic, version, header size, frame width, frame height, fps, number of frames,
+  hash algorithms (comma separated), source identity,
+- an aligned payload of uint64 imghashes, one row (one column per hash algorithm) per frame.
+
+Legacy files (headerless stream of big-endian uint64, as written by the first versions
+of `export_fingerprints`) are still readable.
+"""
+import attr
+import fcntl
+import numpy as np
+import os
+from pathlib import Path
+import struct
+from typing import Optional, Tuple
+import uuid
+
+FINGERPRINT_MAGIC = b'PYDBSRTF'
+FINGERPRINT_VERSION = 1
+# magic, version, header_size, frame_width, frame_height, fps, nb_frames, hash_algos, source_id
+# size of the hash algorithms field (comma separated ascii names)
+HASH_ALGOS_SIZE = 32
+HEADER_STRUCT = struct.Struct(f'<8sHHHHdQ{HASH_ALGOS_SIZE}s16s')
+# payload aligned on 64 bytes
+HEADER_SIZE = 128
+PAYLOAD_DTYPE = np.dtype('<u8')
+LEGACY_PAYLOAD_DTYPE = np.dtype('>u8')
+# source frames indices of a sampled export ('.ids' file next to the fingerprints file)
+FRAMES_IDS_DTYPE = np.dtype('>i8')
+
+
+class InvalidFingerprintFile(Exception):
+    def __init__(self, path):
+        Exception.__init__(self)
+        self.path = path
+
+
+@attr.s()
+class FingerprintHeader:
+    frame_width = attr.ib(type=int, default=32)
+    frame_height = attr.ib(type=int, default=32)
+    fps = attr.ib(type=float, default=0.0)
+    nb_frames = attr.ib(type=int, default=0)
+    hash_algos = attr.ib(type=Tuple[str, ...], default=('phash',), converter=tuple)
+    source_id = attr.ib(type=bytes, default=bytes(16))
+    version = attr.ib(type=int, default=FINGERPRINT_VERSION)
+
+    def __attrs_post_init__(self):
+        """
+        The hash algorithms names must fit the header field (they would be silently truncated).
+
+        >>> FingerprintHeader(hash_algos=('phash', 'dhash', 'whash', 'colorhash', 'average_hash'))
+        Traceback (most recent call last):
+        ...
+        ValueError: Hash algorithms [phash,dhash,whash,colorhash,average_hash] don't fit the 32 bytes of the header.
+        """
+        hash_algos = ','.join(self.hash_algos)
+        try:
+            encoded_hash_algos = hash_algos.encode('ascii')
+        except UnicodeEncodeError:
+            encoded_hash_algos = None
+        if encoded_hash_algos is None or len(encoded_hash_algos) > HASH_ALGOS_SIZE:
+            raise ValueError("Hash algorithms [{0}] don't fit the {1} bytes of the header.".format(
+                hash_algos, HASH_ALGOS_SIZE))
+
+    @property
+    def nb_columns(self) -> int:
+        return len(self.hash_algos)
+
+    def pack(self) -> bytes:
+        """
+
+        :return:
+
+        >>> header = FingerprintHeader(fps=23.976, nb_frames=42, hash_algos=('phash', 'dhash'))
+        >>> packed = header.pack()
+        >>> len(packed)
+        128
+        >>> FingerprintHeader.unpack(packed) == header
+        True
+        """
+        packed = HEADER_STRUCT.pack(
+            FINGERPRINT_MAGIC,
+            self.version,
+            HEADER_SIZE,
+            self.frame_width,
+            self.frame_height,
+            self.fps,
+            self.nb_frames,
+            ','.join(self.hash_algos).encode('ascii'),
+            self.source_id,
+        )
+        return packed.ljust(HEADER_SIZE, b'\x00')
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'FingerprintHeader':
+        (magic, version, header_size, frame_width, frame_height,
+         fps, nb_frames, hash_algos, source_id) = HEADER_STRUCT.unpack_from(data)
+        if magic != FINGERPRINT_MAGIC or header_size != HEADER_SIZE:
+            raise ValueError('Not a fingerprints file header.')
+        if version > FINGERPRINT_VERSION:
+            raise ValueError('Unsupported fingerprints file version [{0}].'.format(version))
+        return cls(
+            frame_width=frame_width,
+            frame_height=frame_height,
+            fps=fps,
+            nb_frames=nb_frames,
+            hash_algos=hash_algos.rstrip(b'\x00').decode('ascii').split(','),
+            source_id=source_id,
+            version=version,
+        )
+
+
+def is_legacy_fingerprint_file(path: Path) -> bool:
+    with open(str(path), 'rb') as f:
+        return f.read(len(FINGERPRINT_MAGIC)) != FINGERPRINT_MAGIC
+
+
+@attr.s()
+class Fingerprints:
+    """
+    Fingerprints loaded from a file.
+
+    `data` is a read-only `np.memmap` (nb_frames, nb_columns) of uint64 imghashes: opening a file
+    only maps it, pages are read when they are touched.
+    """
+    path = attr.ib(type=Path)
+    header = attr.ib(type=FingerprintHeader)
+    data = attr.ib(type=np.ndarray)
+    legacy = attr.ib(type=bool, default=False)
+
+    @property
+    def imghashes(self) -> np.ndarray:
+        """ imghashes of the first hash algorithm (zero-copy view) """
+        return self.data[:, 0]
+
+    def column(self, hash_algo: str) -> np.ndarray:
+        """ imghashes of `hash_algo` (zero-copy view) """
+        try:
+            return self.data[:, self.header.hash_algos.index(hash_algo)]
+        except ValueError:
+            raise KeyError(hash_algo)
+
+    @property
+    def frames_ids(self) -> Optional[np.ndarray]:
+        """
+        Source frames indices of the rows of a sampled export (stride, fps, keyframes: '.ids' file
+        next to the fingerprints file), None if the file has no '.ids' (row = frame index).
+        """
+        ids_path = self.path.with_suffix('.ids')
+        if not ids_path.exists():
+            return None
+        nb_frames = ids_path.stat().st_size // FRAMES_IDS_DTYPE.itemsize
+        if nb_frames != len(self):
+            raise ValueError('Frames indices file [{}] does not match the fingerprints file.'.format(ids_path))
+        return _memmap(ids_path, FRAMES_IDS_DTYPE, 0, (nb_frames,))
+
+    def __len__(self):
+        return len(self.data)
+
+
+def load_fingerprints(path: Path) -> Fingerprints:
+    """
+    Memory-map a fingerprints file (versioned or legacy format).
+
+    :param path:
+    :return:
+
+    >>> import tempfile
+    >>> tmp_dir = Path(tempfile.mkdtemp())
+    >>> with FingerprintWriter(tmp_dir.joinpath('v1.ba'), FingerprintHeader(fps=25.0)) as writer:
+    ...     writer.write(np.arange(3, dtype=np.uint64))
+    >>> fingerprints = load_fingerprints(tmp_dir.joinpath('v1.ba'))
+    >>> fingerprints.header.nb_frames, fingerprints.header.fps, fingerprints.imghashes.tolist()
+    (3, 25.0, [0, 1, 2])
+    >>> _ = tmp_dir.joinpath('legacy.ba').write_bytes(np.arange(3, dtype='>u8').tobytes())
+    >>> fingerprints = load_fingerprints(tmp_dir.joinpath('legacy.ba'))
+    >>> fingerprints.legacy, fingerprints.header.nb_frames, fingerprints.imghashes.tolist()
+    (True, 3, [0, 1, 2])
+    """
+    path = Path(path)
+    file_size = path.stat().st_size
+
+    if is_legacy_fingerprint_file(path):
+        nb_frames = file_size // LEGACY_PAYLOAD_DTYPE.itemsize
+        header = FingerprintHeader(nb_frames=nb_frames)
+        return Fingerprints(path, header, _memmap(path, LEGACY_PAYLOAD_DTYPE, 0, (nb_frames, 1)), legacy=True)
+
+    with open(str(path), 'rb') as f:
+        try:
+            header = FingerprintHeader.unpack(f.read(HEADER_SIZE))
+        except (ValueError, struct.error):
+            raise InvalidFingerprintFile(path)
+    # the payload is authoritative (ex: partially written file)
+    row_size = PAYLOAD_DTYPE.itemsize * header.nb_columns
+    nb_frames = min(header.nb_frames, (file_size - HEADER_SIZE) // row_size)
+    return Fingerprints(path, header, _memmap(path, PAYLOAD_DTYPE, HEADER_SIZE, (nb_frames, header.nb_columns)))
+
+
+def read_fingerprints(path: Path) -> np.ndarray:
+    """
+    Bulk (in memory) read of the imghashes (first hash algorithm) of a fingerprints file,
+    as a native uint64 array.
+
+    :param path:
+    :return:
+
+    >>> import tempfile
+    >>> legacy_fp = Path(tempfile.mkdtemp()).joinpath('legacy.ba')
+    >>> _ = legacy_fp.write_bytes(np.array([1, 2**63], dtype='>u8').tobytes())
+    >>> read_fingerprints(legacy_fp)
+    array([                  1, 9223372036854775808], dtype=uint64)
+    """
+    path = Path(path)
+    if is_legacy_fingerprint_file(path):
+        data = path.read_bytes()
+        nb_frames = len(data) // LEGACY_PAYLOAD_DTYPE.itemsize
+        return np.frombuffer(data, dtype=LEGACY_PAYLOAD_DTYPE, count=nb_frames).astype(np.uint64)
+    return np.array(load_fingerprints(path).imghashes, dtype=np.uint64)
+
+
+def _memmap(path: Path, dtype: np.dtype, offset: int, shape: Tuple[int, int]) -> np.ndarray:
+    if not shape[0]:
+        # mmap can't map an empty payload
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(str(path), dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+@attr.s()
+class FingerprintWriter:
+    """
+    Streaming writer of a (versioned) fingerprints file.
+    The number of frames of the header is updated on close.
+
+    With `atomic`, the file is written in a temporary file (in the same directory) which is renamed
+    on a successful close: concurrent readers never see a half-written file.
+
+    With `resume`, an existing (partial) file is reopened (and exclusively locked) and the writing
+    continues after its last committed frame (see `flush`): `header.nb_frames` is the number of
+    frames already committed.
+    """
+    path = attr.ib(type=Path, converter=Path)
+    header = attr.ib(type=FingerprintHeader, default=attr.Factory(FingerprintHeader))
+    atomic = attr.ib(type=bool, default=False)
+    resume = attr.ib(type=bool, default=False)
+
+    file = attr.ib(init=False, default=None)
+    tmp_path = attr.ib(init=False, default=None)
+    nb_committed_frames = attr.ib(init=False, default=0)
+
+    def open(self) -> 'FingerprintWriter':
+        self.header.nb_frames = 0
+        if self.resume:
+            return self._open_for_resume()
+        self.tmp_path = atomic_tmp_path(self.path) if self.atomic else None
+        self.file = open(str(self.tmp_path or self.path), 'wb')
+        self.file.write(self.header.pack())
+        self.nb_committed_frames = 0
+        return self
+
+    def _open_for_resume(self) -> 'FingerprintWriter':
+        self.file = os.fdopen(os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        # one writer at a time (concurrent workers wait here)
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        row_size = PAYLOAD_DTYPE.itemsize * self.header.nb_columns
+        try:
+            committed_header = FingerprintHeader.unpack(self.file.read(HEADER_SIZE))
+        except (ValueError, struct.error):
+            committed_header = None
+        if committed_header is not None and committed_header.hash_algos == self.header.hash_algos:
+            file_size = os.fstat(self.file.fileno()).st_size
+            self.header.nb_frames = min(committed_header.nb_frames, (file_size - HEADER_SIZE) // row_size)
+        # drop the frames written after the last commit
+        self.file.truncate(HEADER_SIZE + self.header.nb_frames * row_size)
+        self.file.seek(0)
+        self.file.write(self.header.pack())
+        self.file.seek(0, os.SEEK_END)
+        self.nb_committed_frames = self.header.nb_frames
+        return self
+
+    @property
+    def nb_uncommitted_frames(self) -> int:
+        return self.header.nb_frames - self.nb_committed_frames
+
+    def write(self, imghashes: np.ndarray):
+        """
+
+        :param imghashes: (N,) or (N, nb_columns) uint64 imghashes
+        :return:
+        """
+        imghashes = np.asarray(imghashes, dtype=PAYLOAD_DTYPE).reshape(-1, self.header.nb_columns)
+        self.file.write(imghashes.tobytes())
+        self.header.nb_frames += len(imghashes)
+
+    def flush(self):
+        """ Flush the payload and commit (checkpoint) the number of frames in the header """
+        self.file.flush()
+        # the payload is on disk before the header references it
+        os.fsync(self.file.fileno())
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(self.header.pack())
+        self.file.seek(position)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.nb_committed_frames = self.header.nb_frames
+
+    def close(self, commit: bool = True):
+        """
+        :param commit: flush (atomic mode: rename) the file. Otherwise the uncommitted frames are
+            dropped (atomic mode: the temporary file is removed, resume mode: the partial file is kept)
+        """
+        if self.file is not None:
+            if commit:
+                self.flush()
+            self.file.close()
+            self.file = None
+        if self.tmp_path is not None:
+            if commit:
+                os.replace(str(self.tmp_path), str(self.path))
+            else:
+                self.tmp_path.unlink()
+            self.tmp_path = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(commit=exc_type is None)
+
+
+def atomic_tmp_path(path: Path) -> Path:
+    """ Unique temporary (hidden) path, in the directory of `path`, for an atomic write of `path` """
+    return path.parent.joinpath(f'.{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp')
@@ -3,9 +3,11 @@
 """
 # import binascii
 from bitstring import BitArray
-import distance
 from imagehash import ImageHash
 import numpy as np
+import pywt
+import scipy.fftpack
+from typing import Tuple
 
 
 def imghash_to_bitarray(imghash: ImageHash) -> BitArray:
@@ -37,12 +39,14 @@ def imghash_to_64bits(imghash: ImageHash) -> str:
 def imghash_distance(
         imghash0: ImageHash,
         imghash1: ImageHash,
-        distance_func=distance.hamming
+        distance_func=None
 ) -> int:
     """
 
     :param imghash0:
     :param imghash1:
+    :param distance_func: distance on the 64 bits strings of the imghashes (ex: `distance.hamming`).
+        Default to None: hamming distance on the uint64 imghashes (xor + popcount)
     :return:
 
     >>> ih0 = ImageHash(np.array([\
@@ -65,7 +69,12 @@ def imghash_distance(
         np.array([False, False, False, False, False, False, False, False])]))
     >>> imghash_distance(ih0, ih1)
     1
+    >>> import distance
+    >>> imghash_distance(ih0, ih1, distance_func=distance.hamming)
+    1
     """
+    if distance_func is None:
+        return uint64_distance(imghash_to_uint64(imghash0), imghash_to_uint64(imghash1))
     return distance_func(imghash_to_64bits(imghash0), imghash_to_64bits(imghash1))
 
 
@@ -86,7 +95,7 @@ def imghash_count_nonzero(imghash: ImageHash) -> int:
         np.array([False, False, False, False, False, False, False, False])])))
     5
     """
-    return np.count_nonzero(imghash.hash.flatten())
+    return uint64_popcount(imghash_to_uint64(imghash))
 
 
 def imghash_hexstr_to_binstr(imghash_hex: hex) -> str:
@@ -101,3 +110,381 @@ def imghash_hexstr_to_binstr(imghash_hex: hex) -> str:
 
     """
     return bin(int(imghash_hex, 16))[2:]
+
+
+def imghash_to_uint64(imghash: ImageHash) -> int:
+    """
+
+    :param imghash:
+    :return:
+
+    >>> hex(imghash_to_uint64(ImageHash(np.array([\
+        np.array([ True,  True, False,  True, False,  True, False,  True]), \
+        np.array([False, False, False, False, False, False, False, False]), \
+        np.array([False, False, False, False, False, False, False, False]), \
+        np.array([False, False, False, False, False, False, False, False]), \
+        np.array([False, False, False, False, False, False, False, False]), \
+        np.array([False, False, False, False, False, False, False, False]), \
+        np.array([False, False, False, False, False, False, False, False]), \
+        np.array([False, False, False, False, False, False, False, False])]))))
+    '0xd500000000000000'
+    """
+    return int.from_bytes(np.packbits(imghash.hash).tobytes(), 'big')
+
+
+def uint64_to_imghash(int64_imghash: int) -> ImageHash:
+    """
+
+    :param int64_imghash:
+    :return:
+
+    >>> str(uint64_to_imghash(0xc165924de35876d9))
+    'c165924de35876d9'
+    """
+    bits = np.unpackbits(np.array([int64_imghash], dtype='>u8').view(np.uint8))
+    return ImageHash(bits.reshape(8, 8).astype(bool))
+
+
+def imghashes_pack_bits(bits: np.ndarray) -> np.ndarray:
+    """
+    Pack a (N, 8, 8) block of boolean hashes into N uint64 (first bit is the most significant one,
+    like `ImageHash.__str__`).
+
+    :param bits:
+    :return:
+
+    >>> imghashes_pack_bits(np.eye(8, dtype=bool)[np.newaxis])
+    array([9241421688590303745], dtype=uint64)
+    """
+    nb_hashes = len(bits)
+    packed = np.packbits(np.asarray(bits, dtype=bool).reshape(nb_hashes, -1), axis=1)
+    return packed.view('>u8').reshape(nb_hashes).astype(np.uint64)
+
+
+def imghashes_phash(
+        frames: np.ndarray,
+        hash_size: int = 8,
+        highfreq_factor: int = 4,
+) -> np.ndarray:
+    """
+    Vectorized version of `imagehash.phash` for a block of (already resized) gray frames.
+
+    The DCTs, the medians and the bits packing are computed on the whole stack of frames,
+    and the result is bit-identical to `imagehash.phash` applied on each frame.
+
+    :param frames: (N, hash_size * highfreq_factor, hash_size * highfreq_factor) uint8 frames
+    :param hash_size:
+    :param highfreq_factor:
+    :return: N uint64 imghashes
+
+    >>> import imagehash
+    >>> from PIL import Image
+    >>> frames = np.random.RandomState(0).randint(0, 256, (64, 32, 32), dtype=np.uint8)
+    >>> imghashes = imghashes_phash(frames)
+    >>> imghashes.dtype, imghashes.shape
+    (dtype('uint64'), (64,))
+    >>> all(imghash_to_uint64(imagehash.phash(Image.fromarray(frame))) == imghash
+    ...     for frame, imghash in zip(frames, imghashes))
+    True
+    """
+    img_size = hash_size * highfreq_factor
+    pixels = np.asarray(frames)
+    if pixels.ndim != 3 or pixels.shape[1:] != (img_size, img_size):
+        raise ValueError(f'Invalid frames shape {pixels.shape}, expected (N, {img_size}, {img_size}).')
+    nb_frames = len(pixels)
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    dctlowfreq = dct[:, :hash_size, :hash_size].reshape(nb_frames, -1)
+    med = np.median(dctlowfreq, axis=1)
+    diff = dctlowfreq > med[:, np.newaxis]
+    return imghashes_pack_bits(diff)
+
+
+# fixed point precision of the Pillow 8 bits resampling
+PILLOW_PRECISION_BITS = 32 - 8 - 2
+
+
+def _pillow_lanczos_coefficients(in_size: int, out_size: int) -> np.ndarray:
+    """
+    Fixed point (Pillow 8 bits) lanczos resampling coefficients, as a dense (out_size, in_size) matrix.
+    Same computation as Pillow `precompute_coeffs`/`normalize_coeffs_8bpc`.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 3.0 * filterscale
+    coefficients = np.zeros((out_size, in_size), dtype=np.int64)
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        x = (np.arange(xmin, xmax) - center + 0.5) / filterscale
+        w = np.where((-3.0 <= x) & (x < 3.0), np.sinc(x) * np.sinc(x / 3), 0.0)
+        if w.sum() != 0.0:
+            w /= w.sum()
+        coefficients[xx, xmin:xmax] = np.where(w < 0, -0.5, 0.5) + w * (1 << PILLOW_PRECISION_BITS)
+    return coefficients
+
+
+def imghashes_resize(frames: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    Vectorized lanczos (`Image.LANCZOS`, aka `ANTIALIAS`) resize of a stack of gray frames,
+    bit-identical to Pillow (same fixed point coefficients, horizontal pass first).
+
+    :param frames: (N, H, W) uint8 frames
+    :param width:
+    :param height:
+    :return: (N, height, width) uint8 frames
+
+    >>> from PIL import Image
+    >>> frames = np.random.RandomState(0).randint(0, 256, (16, 32, 32), dtype=np.uint8)
+    >>> all((np.asarray(Image.fromarray(frame).resize((9, 8), Image.LANCZOS)) == resized).all()
+    ...     for frame, resized in zip(frames, imghashes_resize(frames, 9, 8)))
+    True
+    """
+    pixels = np.asarray(frames)
+    half = 1 << (PILLOW_PRECISION_BITS - 1)
+    if pixels.shape[2] != width:
+        coefficients = _pillow_lanczos_coefficients(pixels.shape[2], width)
+        pixels = np.clip((pixels.astype(np.int64) @ coefficients.T + half) >> PILLOW_PRECISION_BITS, 0, 255)
+    if pixels.shape[1] != height:
+        coefficients = _pillow_lanczos_coefficients(pixels.shape[1], height)
+        pixels = np.clip((coefficients @ pixels.astype(np.int64) + half) >> PILLOW_PRECISION_BITS, 0, 255)
+    return pixels.astype(np.uint8)
+
+
+def imghashes_ahash(frames: np.ndarray, hash_size: int = 8) -> np.ndarray:
+    """
+    Vectorized version of `imagehash.average_hash` for a block of gray frames.
+
+    :param frames: (N, H, W) uint8 frames
+    :param hash_size:
+    :return: N uint64 imghashes (bit-identical to `imagehash.average_hash`)
+
+    >>> import imagehash
+    >>> from PIL import Image
+    >>> frames = np.random.RandomState(0).randint(0, 256, (64, 32, 32), dtype=np.uint8)
+    >>> all(imghash_to_uint64(imagehash.average_hash(Image.fromarray(frame))) == imghash
+    ...     for frame, imghash in zip(frames, imghashes_ahash(frames)))
+    True
+    """
+    pixels = imghashes_resize(frames, hash_size, hash_size).reshape(len(frames), -1)
+    return imghashes_pack_bits(pixels > pixels.mean(axis=1)[:, np.newaxis])
+
+
+def imghashes_dhash(frames: np.ndarray, hash_size: int = 8) -> np.ndarray:
+    """
+    Vectorized version of `imagehash.dhash` (horizontal differences) for a block of gray frames.
+
+    :param frames: (N, H, W) uint8 frames
+    :param hash_size:
+    :return: N uint64 imghashes (bit-identical to `imagehash.dhash`)
+
+    >>> import imagehash
+    >>> from PIL import Image
+    >>> frames = np.random.RandomState(0).randint(0, 256, (64, 32, 32), dtype=np.uint8)
+    >>> all(imghash_to_uint64(imagehash.dhash(Image.fromarray(frame))) == imghash
+    ...     for frame, imghash in zip(frames, imghashes_dhash(frames)))
+    True
+    """
+    pixels = imghashes_resize(frames, hash_size + 1, hash_size)
+    return imghashes_pack_bits(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+
+def imghashes_whash(frames: np.ndarray, hash_size: int = 8) -> np.ndarray:
+    """
+    Vectorized version of `imagehash.whash` (haar mode, max level LL removed) for a block of
+    (N, S, S) gray frames, S a power of 2: the wavelet decompositions are computed on the whole stack.
+
+    :param frames: (N, S, S) uint8 frames
+    :param hash_size:
+    :return: N uint64 imghashes (bit-identical to `imagehash.whash`)
+
+    >>> import imagehash
+    >>> from PIL import Image
+    >>> frames = np.random.RandomState(0).randint(0, 256, (64, 32, 32), dtype=np.uint8)
+    >>> all(imghash_to_uint64(imagehash.whash(Image.fromarray(frame))) == imghash
+    ...     for frame, imghash in zip(frames, imghashes_whash(frames)))
+    True
+    """
+    pixels = np.asarray(frames)
+    image_scale = max(2 ** int(np.log2(min(pixels.shape[1:]))), hash_size)
+    if pixels.shape[1:] != (image_scale, image_scale):
+        raise ValueError(f'Invalid frames shape {pixels.shape}, expected (N, {image_scale}, {image_scale}).')
+    ll_max_level = int(np.log2(image_scale))
+    dwt_level = ll_max_level - int(np.log2(hash_size))
+    pixels = pixels / 255.
+    coeffs = list(pywt.wavedec2(pixels, 'haar', level=ll_max_level, axes=(1, 2)))
+    coeffs[0] *= 0
+    pixels = pywt.waverec2(coeffs, 'haar', axes=(1, 2))
+    dwt_low = pywt.wavedec2(pixels, 'haar', level=dwt_level, axes=(1, 2))[0].reshape(len(pixels), -1)
+    med = np.median(dwt_low, axis=1)
+    return imghashes_pack_bits(dwt_low > med[:, np.newaxis])
+
+
+# vectorized hash algorithms, by name (fingerprints files columns names)
+IMGHASHES_ALGOS = {
+    'phash': imghashes_phash,
+    'dhash': imghashes_dhash,
+    'ahash': imghashes_ahash,
+    'whash': imghashes_whash,
+}
+
+
+def imghashes_compute(frames: np.ndarray, hash_algos: Tuple[str, ...] = ('phash',)) -> np.ndarray:
+    """
+    All the `hash_algos` imghashes of a block of (32x32) gray frames, computed on the same
+    (decoded once) frames.
+
+    :param frames: (N, 32, 32) uint8 frames
+    :param hash_algos: names of the hash algorithms, see `IMGHASHES_ALGOS`
+    :return: (N, len(hash_algos)) uint64 imghashes, one column per hash algorithm
+
+    >>> frames = np.random.RandomState(0).randint(0, 256, (4, 32, 32), dtype=np.uint8)
+    >>> imghashes = imghashes_compute(frames, ('phash', 'dhash'))
+    >>> imghashes.shape, bool((imghashes[:, 0] == imghashes_phash(frames)).all())
+    ((4, 2), True)
+    >>> imghashes_compute(frames, ('md5',))
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown hash algorithm [md5].
+    """
+    for hash_algo in hash_algos:
+        if hash_algo not in IMGHASHES_ALGOS:
+            raise ValueError(f'Unknown hash algorithm [{hash_algo}].')
+    imghashes = np.empty((len(frames), len(hash_algos)), dtype=np.uint64)
+    for id_column, hash_algo in enumerate(hash_algos):
+        imghashes[:, id_column] = IMGHASHES_ALGOS[hash_algo](frames)
+    return imghashes
+
+
+def imghashes_occurrences(imghashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Distinct imghashes (sorted) and their number of occurrences.
+
+    :param imghashes: uint64 imghashes
+    :return:
+
+    >>> imghashes_occurrences(np.array([3, 1, 3, 3], dtype=np.uint64))
+    (array([1, 3], dtype=uint64), array([1, 3]))
+    """
+    return np.unique(np.asarray(imghashes, dtype=np.uint64), return_counts=True)
+
+
+def imghashes_statistics(imghashes: np.ndarray) -> dict:
+    """
+    Distinct imghashes statistics.
+
+    :param imghashes: uint64 imghashes
+    :return:
+
+    >>> stats = imghashes_statistics(np.array([3, 1, 3, 3], dtype=np.uint64))
+    >>> [(k, int(v)) for k, v in sorted(stats.items()) if k != 'entropy']
+    [('max_occurrences', 3), ('most_common', 3), ('nb_distinct', 2), ('nb_imghashes', 4), ('nb_singletons', 1)]
+    >>> round(stats['entropy'], 6)
+    0.811278
+    """
+    values, counts = imghashes_occurrences(imghashes)
+    if not len(values):
+        return dict(nb_imghashes=0, nb_distinct=0, nb_singletons=0, max_occurrences=0, most_common=None, entropy=0.0)
+    probs = counts / counts.sum()
+    return dict(
+        nb_imghashes=int(counts.sum()),
+        nb_distinct=len(values),
+        nb_singletons=int(np.count_nonzero(counts == 1)),
+        max_occurrences=int(counts.max()),
+        most_common=values[np.argmax(counts)],
+        entropy=float(-(probs * np.log2(probs)).sum()),
+    )
+
+
+# Hamming distances on uint64 imghashes
+POPCOUNT_M1 = np.uint64(0x5555555555555555)
+POPCOUNT_M2 = np.uint64(0x3333333333333333)
+POPCOUNT_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+POPCOUNT_H01 = np.uint64(0x0101010101010101)
+
+
+def uint64_popcount(int64_imghash: int) -> int:
+    """
+
+    >>> uint64_popcount(0xd500000000000000)
+    5
+    """
+    return bin(int64_imghash).count('1')
+
+
+def uint64_distance(int64_imghash0: int, int64_imghash1: int) -> int:
+    """
+    Hamming distance between two uint64 imghashes.
+
+    >>> uint64_distance(0xd500000000000000, 0xd500200000000000)
+    1
+    """
+    return bin(int64_imghash0 ^ int64_imghash1).count('1')
+
+
+def _imghashes_popcount_swar(imghashes: np.ndarray) -> np.ndarray:
+    # https://en.wikipedia.org/wiki/Hamming_weight (popcount64c)
+    x = imghashes - ((imghashes >> np.uint64(1)) & POPCOUNT_M1)
+    x = (x & POPCOUNT_M2) + ((x >> np.uint64(2)) & POPCOUNT_M2)
+    x = (x + (x >> np.uint64(4))) & POPCOUNT_M4
+    return ((x * POPCOUNT_H01) >> np.uint64(56)).astype(np.uint8)
+
+
+def imghashes_popcount(imghashes: np.ndarray) -> np.ndarray:
+    """
+    Number of bits set of each uint64 imghash (hardware popcount with numpy >= 2.0, SWAR otherwise).
+
+    :param imghashes: uint64 imghashes
+    :return: uint8 popcounts
+
+    >>> imghashes_popcount(np.array([0, 0xd500000000000000, 2**64 - 1], dtype=np.uint64))
+    array([ 0,  5, 64], dtype=uint8)
+    >>> _imghashes_popcount_swar(np.array([0, 0xd500000000000000, 2**64 - 1], dtype=np.uint64))
+    array([ 0,  5, 64], dtype=uint8)
+    """
+    imghashes = np.asarray(imghashes, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(imghashes)
+    return _imghashes_popcount_swar(imghashes)
+
+
+def imghashes_distances(int64_imghash: int, imghashes: np.ndarray) -> np.ndarray:
+    """
+    One-to-many hamming distances.
+
+    :param int64_imghash: uint64 imghash
+    :param imghashes: uint64 imghashes
+    :return: uint8 distances
+
+    >>> imghashes_distances(0xd500000000000000, np.array([0xd500000000000000, 0xd500200000000000, 0], dtype=np.uint64))
+    array([0, 1, 5], dtype=uint8)
+    """
+    return imghashes_popcount(np.asarray(imghashes, dtype=np.uint64) ^ np.uint64(int64_imghash))
+
+
+def imghashes_distance_matrix(
+        imghashes0: np.ndarray,
+        imghashes1: np.ndarray,
+        chunk_size: int = 1 << 22,
+) -> np.ndarray:
+    """
+    Many-to-many hamming distances, computed by chunks of (about) `chunk_size` distances
+    to bound the temporary memory.
+
+    :param imghashes0: M uint64 imghashes
+    :param imghashes1: N uint64 imghashes
+    :param chunk_size:
+    :return: (M, N) uint8 distances matrix
+
+    >>> imghashes_distance_matrix(np.array([0, 3], dtype=np.uint64), np.array([1, 2, 3], dtype=np.uint64))
+    array([[1, 1, 2],
+           [1, 1, 0]], dtype=uint8)
+    """
+    imghashes0 = np.asarray(imghashes0, dtype=np.uint64)
+    imghashes1 = np.asarray(imghashes1, dtype=np.uint64)
+    distances = np.empty((len(imghashes0), len(imghashes1)), dtype=np.uint8)
+    chunk_nb_rows = max(1, chunk_size // max(1, len(imghashes1)))
+    for id_row in range(0, len(imghashes0), chunk_nb_rows):
+        rows = slice(id_row, id_row + chunk_nb_rows)
+        distances[rows] = imghashes_popcount(imghashes0[rows, np.newaxis] ^ imghashes1[np.newaxis, :])
+    return distances
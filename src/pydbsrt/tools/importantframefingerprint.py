@@ -2,9 +2,12 @@
 
 """
 import attr
+import numpy as np
+from typing import Generator, Iterable, Optional, Tuple
 #
+from pydbsrt.tools.ffmpeg_tools.ffmeg_extract_frame import ffmpeg_frame_branches_generator
 from pydbsrt.tools.videofingerprint import VideoFingerprint
-from pydbsrt.tools.imghash import imghash_distance, imghash_count_nonzero
+from pydbsrt.tools.imghash import imghash_distance, imghash_count_nonzero, imghashes_phash, imghashes_popcount
 
 
 @attr.s()
@@ -29,30 +32,148 @@ class ImportantFrameFingerprints:
         return self
 
     def __next__(self):
-        try:
+        self.cur_vfp = next(self.vfp_iterator)
+        self.id_frame += 1
+
+        while self.last_vfp is None:
+            if imghash_count_nonzero(self.cur_vfp) >= self.threshold_nonzero:
+                self.last_vfp = self.cur_vfp
+                return self.cur_vfp, self.id_frame
+            # next frame
+            self.cur_vfp = next(self.vfp_iterator)
+            self.id_frame += 1
+
+        while True:
+            # tests on thresholds
+            thresholds_pass_for_exit = True
+            thresholds_pass_for_exit &= imghash_distance(self.last_vfp, self.cur_vfp) >= self.threshold_distance
+            thresholds_pass_for_exit &= imghash_count_nonzero(self.cur_vfp) >= self.threshold_nonzero
+            if thresholds_pass_for_exit:
+                break
+            # next frame
             self.cur_vfp = next(self.vfp_iterator)
             self.id_frame += 1
 
-            while self.last_vfp is None:
-                if imghash_count_nonzero(self.cur_vfp) >= self.threshold_nonzero:
-                    self.last_vfp = self.cur_vfp
-                    return self.cur_vfp, self.id_frame
-                # next frame
-                self.cur_vfp = next(self.vfp_iterator)
-                self.id_frame += 1
-
-            while True:
-                # tests on thresholds
-                thresholds_pass_for_exit = True
-                thresholds_pass_for_exit &= imghash_distance(self.last_vfp, self.cur_vfp) >= self.threshold_distance
-                thresholds_pass_for_exit &= imghash_count_nonzero(self.cur_vfp) >= self.threshold_nonzero
-                if thresholds_pass_for_exit:
-                    break
-                # next frame
-                self.cur_vfp = next(self.vfp_iterator)
-                self.id_frame += 1
-
-            self.last_vfp = self.cur_vfp
-            return self.cur_vfp, self.id_frame
-        except (StopIteration, Exception):
-            raise StopIteration
+        self.last_vfp = self.cur_vfp
+        return self.cur_vfp, self.id_frame
+
+
+def important_frames_indices(
+        imghashes: np.ndarray,
+        threshold_distance: int = 8,
+        threshold_nonzero: int = 0,
+        last_imghash: Optional[int] = None,
+        window_size: int = 64,
+) -> Tuple[np.ndarray, Optional[int]]:
+    """
+    Important frames of a block of uint64 imghashes (same rules as `ImportantFrameFingerprints`):
+    frames with at least `threshold_nonzero` bits set and at (hamming) distance at least
+    `threshold_distance` of the last accepted frame.
+
+    The nonzero filter is vectorized. The scan for the next frame far enough from the last accepted
+    one is sequential by nature: it is done on windows (doubling while no frame is accepted) of
+    vectorized distances.
+
+    :param imghashes: uint64 imghashes
+    :param threshold_distance:
+    :param threshold_nonzero:
+    :param last_imghash: last accepted imghash (previous block), None at the beginning of the stream
+    :param window_size: initial size of the scan windows
+    :return: indices (in the block) of the important frames, last accepted imghash
+
+    >>> ids, last_imghash = important_frames_indices(np.array([0, 1, 3, 7, 15, 12], dtype=np.uint64), 2, 1)
+    >>> ids.tolist(), int(last_imghash)
+    ([1, 3, 5], 12)
+    """
+    imghashes = np.asarray(imghashes, dtype=np.uint64)
+    candidates_ids = np.flatnonzero(imghashes_popcount(imghashes) >= threshold_nonzero)
+    candidates = imghashes[candidates_ids]
+
+    accepted = []
+    id_candidate = 0
+    if last_imghash is None and len(candidates):
+        accepted.append(0)
+        last_imghash = candidates[0]
+        id_candidate = 1
+
+    window = window_size
+    while id_candidate < len(candidates):
+        far_enough = imghashes_popcount(
+            candidates[id_candidate:id_candidate + window] ^ np.uint64(last_imghash)
+        ) >= threshold_distance
+        id_first = np.argmax(far_enough)
+        if far_enough[id_first]:
+            id_candidate += id_first
+            accepted.append(id_candidate)
+            last_imghash = candidates[id_candidate]
+            id_candidate += 1
+            window = window_size
+        else:
+            id_candidate += window
+            window = min(window << 1, 1 << 16)
+
+    return candidates_ids[accepted], last_imghash
+
+
+def important_frames_generator(
+        imghashes_blocks: Iterable[np.ndarray],
+        threshold_distance: int = 8,
+        threshold_nonzero: int = 0,
+) -> Generator[Tuple[np.uint64, int], None, None]:
+    """
+    Chunk-streaming (vectorized) version of `ImportantFrameFingerprints`, on blocks of uint64 imghashes
+    (ex: `ffmpeg_imghash_block_generator` or a fingerprints file).
+
+    :param imghashes_blocks: blocks of uint64 imghashes
+    :param threshold_distance:
+    :param threshold_nonzero:
+    :return: (imghash, id_frame), with the same id_frame convention as `ImportantFrameFingerprints`
+
+    >>> from pydbsrt.tools.imghash import imghash_to_uint64, uint64_to_imghash
+    >>> imghashes = np.random.RandomState(0).randint(0, 1 << 16, 1000).astype(np.uint64) * np.uint64(0x1000100010001)
+    >>> expected = [
+    ...     (imghash_to_uint64(ih), id_frame)
+    ...     for ih, id_frame in ImportantFrameFingerprints(list(map(uint64_to_imghash, imghashes.tolist())), 24, 32)
+    ... ]
+    >>> blocks = np.array_split(imghashes, 7)
+    >>> list(important_frames_generator(blocks, 24, 32)) == expected, len(expected)
+    (True, 502)
+    """
+    nb_frames = 0
+    last_imghash = None
+    for imghashes in imghashes_blocks:
+        ids, last_imghash = important_frames_indices(imghashes, threshold_distance, threshold_nonzero, last_imghash)
+        for id_frame in ids.tolist():
+            # ImportantFrameFingerprints counts frames from 1
+            yield imghashes[id_frame], nb_frames + id_frame + 1
+        nb_frames += len(imghashes)
+
+
+def important_frames_images_generator(
+        input: str,
+        threshold_distance: int = 8,
+        threshold_nonzero: int = 0,
+        media_size: Tuple[int, int] = None,
+        block_size: int = 16,
+) -> Generator[Tuple[np.uint64, int, np.ndarray], None, None]:
+    """
+    Important frames of a media with their full resolution images, in a single decoding pass
+    (see `ffmpeg_frame_branches_generator`): the low resolution gray branch is hashed and scanned
+    (`important_frames_indices`), only the accepted full resolution frames are kept (copied).
+
+    :param input: path or url of the media
+    :param threshold_distance:
+    :param threshold_nonzero:
+    :param media_size: (width, height) of the media frames. Default to ffprobe values
+    :param block_size: Number of frames decoded/hashed at once. Default to 16
+    :return: (imghash, id_frame, (height, width, 3) uint8 rgb image of the frame), with the same id_frame
+        convention as `ImportantFrameFingerprints`
+    """
+    nb_frames = 0
+    last_imghash = None
+    for gray_frames, frames in ffmpeg_frame_branches_generator(input, media_size, block_size=block_size):
+        imghashes = imghashes_phash(gray_frames)
+        ids, last_imghash = important_frames_indices(imghashes, threshold_distance, threshold_nonzero, last_imghash)
+        for id_frame in ids.tolist():
+            yield imghashes[id_frame], nb_frames + id_frame + 1, frames[id_frame].copy()
+        nb_frames += len(imghashes)
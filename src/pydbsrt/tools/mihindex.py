@@ -0,0 +1,329 @@
+"""
+Multi-index hashing (MIH) index of imghashes: sub-linear lookup of the frames (of a library of
+medias) within a hamming radius of a query imghash.
+
+Each 64 bits imghash is split into `nb_substrings` substrings, with one table per substring.
+If two imghashes are within radius r, at least one of their substrings is within radius
+r // nb_substrings (pigeonhole): a query probes, in each table, the buckets of the substrings
+within this radius, then the candidates are checked with their full imghash.
+A good `nb_substrings` is ~ 64 / log2(number of imghashes) (ex: 3 for 200M imghashes).
+
+The tables are sorted arrays (keys, entries order): a bucket is a `searchsorted` range.
+An index is a list of immutable segments: a bulk build makes one segment, `add` appends a
+(small) segment, `compact` merges them.
+
+On disk layout (directory):
+- `index.json`: number of substrings, medias names (media id: position), segments directories,
+- one directory per segment, with `.npy` arrays loaded via mmap.
+"""
+import attr
+from itertools import combinations
+from functools import lru_cache
+import json
+import numpy as np
+import os
+from pathlib import Path
+import shutil
+from typing import Iterable, List, Tuple
+import uuid
+#
+from pydbsrt.tools.fingerprintfile import atomic_tmp_path, load_fingerprints
+from pydbsrt.tools.imghash import imghashes_popcount
+
+MIH_INDEX_VERSION = 1
+MIH_MANIFEST_NAME = 'index.json'
+SEGMENT_ARRAYS = ('imghashes', 'media_ids', 'frame_ids')
+# maximum number of probes (flip masks) per substring table
+MAX_FLIP_MASKS = 1 << 20
+
+
+def substrings_layout(nb_substrings: int) -> List[Tuple[int, int]]:
+    """
+    (shift, number of bits) of the substrings, from the most significant bits.
+
+    :param nb_substrings:
+    :return:
+
+    >>> substrings_layout(3)
+    [(42, 22), (21, 21), (0, 21)]
+    """
+    if not 1 <= nb_substrings <= 64:
+        raise ValueError('The number of substrings must be in [1, 64].')
+    layout, shift = [], 64
+    for id_substring in range(nb_substrings):
+        nb_bits = 64 // nb_substrings + (id_substring < 64 % nb_substrings)
+        shift -= nb_bits
+        layout.append((shift, nb_bits))
+    return layout
+
+
+def _key_dtype(nb_bits: int) -> np.dtype:
+    return np.dtype(np.uint16 if nb_bits <= 16 else np.uint32 if nb_bits <= 32 else np.uint64)
+
+
+def substrings_keys(imghashes: np.ndarray, shift: int, nb_bits: int) -> np.ndarray:
+    mask = np.uint64((1 << nb_bits) - 1)
+    return ((np.asarray(imghashes, dtype=np.uint64) >> np.uint64(shift)) & mask).astype(_key_dtype(nb_bits))
+
+
+@lru_cache(maxsize=64)
+def flip_masks(nb_bits: int, radius: int) -> np.ndarray:
+    """
+    Masks of all the flips of at most `radius` bits among `nb_bits` bits.
+
+    >>> flip_masks(4, 1).tolist()
+    [0, 1, 2, 4, 8]
+    >>> flip_masks(64, 11)
+    Traceback (most recent call last):
+    ...
+    ValueError: Radius 11 on 64 bits substrings needs 927740240713 probes per table (maximum 1048576): use more substrings.
+    """
+    # number of masks: sum of C(nb_bits, nb_flips)
+    nb_masks, nb_combinations = 1, 1
+    for nb_flips in range(1, min(radius, nb_bits) + 1):
+        nb_combinations = nb_combinations * (nb_bits - nb_flips + 1) // nb_flips
+        nb_masks += nb_combinations
+    if nb_masks > MAX_FLIP_MASKS:
+        raise ValueError('Radius {0} on {1} bits substrings needs {2} probes per table (maximum {3}): '
+                         'use more substrings.'.format(radius, nb_bits, nb_masks, MAX_FLIP_MASKS))
+    masks = [0]
+    for nb_flips in range(1, min(radius, nb_bits) + 1):
+        masks.extend(sum(1 << bit for bit in bits) for bits in combinations(range(nb_bits), nb_flips))
+    return np.array(masks, dtype=np.uint64)
+
+
+def _ranges_positions(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # concatenation of the ranges [starts[i], ends[i]), vectorized
+    counts = ends - starts
+    total = int(counts.sum())
+    return np.arange(total) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+
+
+@attr.s()
+class MIHSegment:
+    """
+    Immutable part of an index: the entries (imghash, media id, frame index) and, for each substring,
+    the sorted keys and the entries order.
+    """
+    imghashes = attr.ib(type=np.ndarray)
+    media_ids = attr.ib(type=np.ndarray)
+    frame_ids = attr.ib(type=np.ndarray)
+    keys = attr.ib(type=List[np.ndarray])
+    orders = attr.ib(type=List[np.ndarray])
+    # directory of the (saved) segment. Default to None: in memory
+    path = attr.ib(type=Path, default=None)
+
+    @classmethod
+    def build(cls, imghashes: np.ndarray, media_ids: np.ndarray, frame_ids: np.ndarray,
+              nb_substrings: int) -> 'MIHSegment':
+        order_dtype = np.uint32 if len(imghashes) < (1 << 32) else np.uint64
+        keys, orders = [], []
+        for shift, nb_bits in substrings_layout(nb_substrings):
+            substring_keys = substrings_keys(imghashes, shift, nb_bits)
+            order = np.argsort(substring_keys, kind='stable').astype(order_dtype)
+            keys.append(substring_keys[order])
+            orders.append(order)
+        return cls(imghashes, media_ids, frame_ids, keys, orders)
+
+    def __len__(self) -> int:
+        return len(self.imghashes)
+
+    def candidates(self, imghash: int, substring_radius: int) -> np.ndarray:
+        """ Entries (indices) with at least one substring within `substring_radius` of `imghash` """
+        entries = []
+        for (shift, nb_bits), keys, order in zip(substrings_layout(len(self.keys)), self.keys, self.orders):
+            key_dtype = _key_dtype(nb_bits)
+            neighbours = np.sort(
+                (substrings_keys(np.uint64(imghash), shift, nb_bits).astype(np.uint64) ^
+                 flip_masks(nb_bits, substring_radius)).astype(key_dtype)
+            )
+            starts = np.searchsorted(keys, neighbours, 'left')
+            ends = np.searchsorted(keys, neighbours, 'right')
+            entries.append(order[_ranges_positions(starts, ends)])
+        return np.unique(np.concatenate(entries)) if entries else np.empty(0, dtype=np.int64)
+
+    def save(self, path: Path):
+        path.mkdir(parents=True)
+        for name in SEGMENT_ARRAYS:
+            np.save(str(path.joinpath(f'{name}.npy')), getattr(self, name))
+        for id_substring, (keys, order) in enumerate(zip(self.keys, self.orders)):
+            np.save(str(path.joinpath(f'keys_{id_substring}.npy')), keys)
+            np.save(str(path.joinpath(f'order_{id_substring}.npy')), order)
+        self.path = path
+
+    @classmethod
+    def load(cls, path: Path, nb_substrings: int) -> 'MIHSegment':
+        def _load(name):
+            return np.load(str(path.joinpath(f'{name}.npy')), mmap_mode='r')
+
+        return cls(
+            *(_load(name) for name in SEGMENT_ARRAYS),
+            keys=[_load(f'keys_{id_substring}') for id_substring in range(nb_substrings)],
+            orders=[_load(f'order_{id_substring}') for id_substring in range(nb_substrings)],
+            path=path,
+        )
+
+
+@attr.s()
+class MIHIndex:
+    """
+    MIH index of the imghashes of a library of medias.
+
+    >>> rng = np.random.RandomState(0)
+    >>> imghashes = rng.randint(0, 2**63, 1000, dtype=np.int64).astype(np.uint64)
+    >>> index = MIHIndex(nb_substrings=4)
+    >>> index.add(imghashes[:600], 'first.mp4'), index.add(imghashes[600:], 'second.mp4')
+    (0, 1)
+    >>> media_ids, frame_ids, distances = index.search(imghashes[742] ^ np.uint64(0b10101), radius=5)
+    >>> [index.medias[media_id] for media_id in media_ids], frame_ids.tolist(), distances.tolist()
+    (['second.mp4'], [142], [3])
+    >>> import tempfile
+    >>> index_dir = Path(tempfile.mkdtemp()).joinpath('index')
+    >>> index.compact().save(index_dir)
+    >>> loaded = MIHIndex.load(index_dir)
+    >>> len(loaded), loaded.medias, loaded.search(imghashes[42], radius=0)[1].tolist()
+    (1000, ['first.mp4', 'second.mp4'], [42])
+    """
+    nb_substrings = attr.ib(type=int, default=4)
+    # names of the medias, a media id is a position in this list
+    medias = attr.ib(type=List[str], default=attr.Factory(list))
+    segments = attr.ib(type=List[MIHSegment], default=attr.Factory(list))
+
+    def __len__(self) -> int:
+        return sum(map(len, self.segments))
+
+    @classmethod
+    def build(cls, fingerprints_paths: Iterable[Path], nb_substrings: int = 4,
+              medias: Iterable[str] = None) -> 'MIHIndex':
+        """
+        Bulk build (one segment) from (memory-mapped) fingerprints files, see `export_fingerprints`.
+        The frame index of an entry is its row in the fingerprints file, or its source frame index
+        for a sampled export (see `Fingerprints.frames_ids`).
+
+        :param fingerprints_paths:
+        :param nb_substrings:
+        :param medias: names of the medias. Default to None: the fingerprints files paths
+        :return:
+        """
+        fingerprints_paths = list(map(Path, fingerprints_paths))
+        index = cls(nb_substrings, list(medias) if medias is not None else list(map(str, fingerprints_paths)))
+        fingerprints = [load_fingerprints(path) for path in fingerprints_paths]
+        nb_entries = sum(map(len, fingerprints))
+        imghashes = np.empty(nb_entries, dtype=np.uint64)
+        media_ids = np.empty(nb_entries, dtype=np.uint32)
+        frame_ids = np.empty(nb_entries, dtype=np.uint32)
+        position = 0
+        for media_id, media_fingerprints in enumerate(fingerprints):
+            column, media_frame_ids = media_fingerprints.imghashes, media_fingerprints.frames_ids
+            imghashes[position:position + len(column)] = column
+            media_ids[position:position + len(column)] = media_id
+            frame_ids[position:position + len(column)] = (
+                np.arange(len(column)) if media_frame_ids is None else media_frame_ids
+            )
+            position += len(column)
+        if nb_entries:
+            index.segments.append(MIHSegment.build(imghashes, media_ids, frame_ids, nb_substrings))
+        return index
+
+    def add(self, imghashes: np.ndarray, media: str, frame_ids: np.ndarray = None) -> int:
+        """
+        Add the imghashes of a media (incremental: a new segment).
+
+        :param imghashes: uint64 imghashes
+        :param media: name of the media
+        :param frame_ids: frames indices of the imghashes (ex: sampled export).
+            Default to None: positions in `imghashes`
+        :return: media id
+        """
+        imghashes = np.array(imghashes, dtype=np.uint64)
+        if frame_ids is None:
+            frame_ids = np.arange(len(imghashes), dtype=np.uint32)
+        elif len(frame_ids) != len(imghashes):
+            raise ValueError('One frame index per imghash expected.')
+        media_id = len(self.medias)
+        self.medias.append(media)
+        if not len(imghashes):
+            # mmap can't map empty arrays: no empty segment
+            return media_id
+        self.segments.append(MIHSegment.build(
+            imghashes,
+            np.full(len(imghashes), media_id, dtype=np.uint32),
+            np.asarray(frame_ids, dtype=np.uint32),
+            self.nb_substrings,
+        ))
+        return media_id
+
+    def add_fingerprints_file(self, fingerprints_path: Path, media: str = None) -> int:
+        """ Add the imghashes (and the frames indices of a sampled export) of a fingerprints file, see `add` """
+        fingerprints = load_fingerprints(fingerprints_path)
+        return self.add(fingerprints.imghashes, media or str(fingerprints_path), fingerprints.frames_ids)
+
+    def compact(self) -> 'MIHIndex':
+        """ Merge the segments into one """
+        if len(self.segments) > 1:
+            self.segments = [MIHSegment.build(
+                *(np.concatenate([getattr(segment, name) for segment in self.segments]) for name in SEGMENT_ARRAYS),
+                nb_substrings=self.nb_substrings,
+            )]
+        return self
+
+    def search(self, imghash: int, radius: int = 8) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Frames within `radius` of `imghash`.
+
+        :param imghash: uint64 imghash
+        :param radius: hamming radius
+        :return: media ids, frame indices and hamming distances of the frames (sorted by media, frame)
+        """
+        imghash = np.uint64(imghash)
+        media_ids, frame_ids, distances = [], [], []
+        for segment in self.segments:
+            entries = segment.candidates(imghash, radius // self.nb_substrings)
+            entries_distances = imghashes_popcount(np.asarray(segment.imghashes[entries]) ^ imghash)
+            entries = entries[entries_distances <= radius]
+            media_ids.append(np.asarray(segment.media_ids[entries]))
+            frame_ids.append(np.asarray(segment.frame_ids[entries]))
+            distances.append(entries_distances[entries_distances <= radius])
+        if not self.segments:
+            return np.empty(0, np.uint32), np.empty(0, np.uint32), np.empty(0, np.uint8)
+        media_ids, frame_ids, distances = map(np.concatenate, (media_ids, frame_ids, distances))
+        order = np.lexsort((frame_ids, media_ids))
+        return media_ids[order], frame_ids[order], distances[order]
+
+    def save(self, path: Path):
+        """
+        Save the index in directory `path`: only the segments not already saved in `path` are written,
+        the manifest is replaced atomically, then the unreferenced segments directories are removed.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for segment in self.segments:
+            if segment.path is None or segment.path.parent != path:
+                segment.save(path.joinpath(f'segment_{uuid.uuid4().hex}'))
+        manifest = {
+            'version': MIH_INDEX_VERSION,
+            'nb_substrings': self.nb_substrings,
+            'medias': self.medias,
+            'segments': [segment.path.name for segment in self.segments],
+        }
+        manifest_path = path.joinpath(MIH_MANIFEST_NAME)
+        tmp_path = atomic_tmp_path(manifest_path)
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(str(tmp_path), str(manifest_path))
+        for segment_dir in path.glob('segment_*'):
+            if segment_dir.name not in manifest['segments']:
+                shutil.rmtree(str(segment_dir), ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: Path) -> 'MIHIndex':
+        """ Load (mmap) an index saved in directory `path` """
+        path = Path(path)
+        manifest = json.loads(path.joinpath(MIH_MANIFEST_NAME).read_text())
+        if manifest['version'] > MIH_INDEX_VERSION:
+            raise ValueError('Unsupported MIH index version [{0}].'.format(manifest['version']))
+        nb_substrings = manifest['nb_substrings']
+        return cls(
+            nb_substrings,
+            manifest['medias'],
+            [MIHSegment.load(path.joinpath(name), nb_substrings) for name in manifest['segments']],
+        )
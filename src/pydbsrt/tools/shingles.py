@@ -0,0 +1,240 @@
+"""
+Temporal shingles: 64 bits keys of k consecutive imghashes, for exact-match candidate generation.
+
+Single frame imghashes collide a lot (black frames, static shots, credits), a sequence of k frames
+much less. A query clip finds its candidate offsets in a reference by exact lookups of its shingles
+keys, before any (hamming) verification (see `locate_clip_shingles`).
+
+With `quantize_bits`, only the most significant bits of the imghashes are kept before shingling
+(for pHash: the lowest frequencies), making the keys robust to small (re-encoding) bit flips.
+"""
+import attr
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+#
+from pydbsrt.tools.cliplocalization import ClipMatch, UNRELATED_DISTANCE, offsets_distances
+from pydbsrt.tools.fingerprintfile import load_fingerprints
+from pydbsrt.tools.imghash import imghash_to_uint64
+
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def splitmix64(values: np.ndarray) -> np.ndarray:
+    """ SplitMix64 finalizer: well mixed 64 bits (vectorized, wrapping uint64 arithmetic) """
+    values = np.array(values, dtype=np.uint64)
+    values ^= values >> np.uint64(30)
+    values *= np.uint64(0xBF58476D1CE4E5B9)
+    values ^= values >> np.uint64(27)
+    values *= np.uint64(0x94D049BB133111EB)
+    values ^= values >> np.uint64(31)
+    return values
+
+
+def quantize_imghashes(imghashes: np.ndarray, nb_bits: int) -> np.ndarray:
+    """
+    Keep the `nb_bits` most significant bits of the imghashes.
+
+    >>> quantize_imghashes(np.array([0xFFFF000000000001], dtype=np.uint64), 8).tolist()
+    [255]
+    """
+    return np.asarray(imghashes, dtype=np.uint64) >> np.uint64(64 - nb_bits)
+
+
+def shingle_keys(imghashes: np.ndarray, k: int = 4, quantize_bits: int = None) -> np.ndarray:
+    """
+    64 bits keys of the shingles (windows of `k` consecutive imghashes), order sensitive.
+
+    :param imghashes: uint64 imghashes
+    :param k: shingle length
+    :param quantize_bits: see `quantize_imghashes`. Default to None: full imghashes
+    :return: uint64 keys, one per window (len(imghashes) - k + 1)
+
+    >>> keys = shingle_keys(np.array([1, 2, 3, 1, 2, 3, 2, 1], dtype=np.uint64), k=3)
+    >>> len(keys), bool(keys[0] == keys[3]), bool(keys[0] == keys[4])
+    (6, True, False)
+    """
+    imghashes = np.asarray(imghashes, dtype=np.uint64)
+    if quantize_bits is not None:
+        imghashes = quantize_imghashes(imghashes, quantize_bits)
+    nb_shingles = len(imghashes) - k + 1
+    if nb_shingles <= 0:
+        return np.empty(0, dtype=np.uint64)
+    mixed = splitmix64(imghashes)
+    keys = np.zeros(nb_shingles, dtype=np.uint64)
+    for position in range(k):
+        keys *= SHINGLE_MULTIPLIER
+        keys += mixed[position:position + nb_shingles]
+    return splitmix64(keys)
+
+
+@attr.s()
+class ShingleIndex:
+    """
+    Sorted array of shingles keys (vectorized `searchsorted` lookups), with the frame index of the
+    first frame of each shingle. `to_dict` gives the same index as a plain dict.
+
+    >>> rng = np.random.RandomState(0)
+    >>> reference = rng.randint(0, 2**63, 5000, dtype=np.int64).astype(np.uint64)
+    >>> reference[1000:1100] = 0  # black frames
+    >>> index = ShingleIndex.from_imghashes(reference, k=4, max_occurrences=8)
+    >>> offsets, votes = index.candidate_offsets(reference[3000:3050])
+    >>> offsets[:1].tolist(), votes[:1].tolist()
+    ([3000], [47])
+    >>> index.lookup(shingle_keys(np.zeros(4, dtype=np.uint64))[0]).tolist()  # stop shingle
+    []
+    """
+    k = attr.ib(type=int)
+    quantize_bits = attr.ib(type=int)
+    # sorted keys, frame index of the first frame of the shingle of each key
+    keys = attr.ib(type=np.ndarray)
+    frame_ids = attr.ib(type=np.ndarray)
+
+    @classmethod
+    def from_imghashes(
+            cls,
+            imghashes: np.ndarray,
+            frame_ids: np.ndarray = None,
+            k: int = 4,
+            quantize_bits: int = None,
+            max_occurrences: int = None,
+    ) -> 'ShingleIndex':
+        """
+        :param imghashes: uint64 imghashes
+        :param frame_ids: frames indices of the imghashes. Default to None: positions in `imghashes`
+        :param k: see `shingle_keys`
+        :param quantize_bits: see `shingle_keys`
+        :param max_occurrences: keys occurring more often (ex: black frames, static shots) are dropped
+            (stop shingles). Default to None: all keys are kept
+        :return:
+        """
+        keys = shingle_keys(imghashes, k, quantize_bits)
+        if frame_ids is None:
+            frame_ids = np.arange(len(keys), dtype=np.int64)
+        else:
+            frame_ids = np.asarray(frame_ids, dtype=np.int64)[:len(keys)]
+        order = np.argsort(keys, kind='stable')
+        keys, frame_ids = keys[order], frame_ids[order]
+        if max_occurrences is not None and len(keys):
+            _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+            kept = counts[inverse] <= max_occurrences
+            keys, frame_ids = keys[kept], frame_ids[kept]
+        return cls(k, quantize_bits, keys, frame_ids)
+
+    @classmethod
+    def from_fingerprints_file(cls, fingerprints_path: Path, **kwargs) -> 'ShingleIndex':
+        """
+        Index of an exported fingerprints file (see `export_fingerprints`), frame index: row.
+
+        With a sampled export (stride, fps, keyframes), a shingle is made of k consecutive samples
+        (not frames) and its frame index is the source frame of its first sample
+        (see `Fingerprints.frames_ids`): the query has to be sampled the same way, and its frames
+        indices passed to `candidate_offsets`.
+
+        :param fingerprints_path:
+        :param kwargs: see `from_imghashes`
+        :return:
+        """
+        fingerprints = load_fingerprints(fingerprints_path)
+        return cls.from_imghashes(fingerprints.imghashes, fingerprints.frames_ids, **kwargs)
+
+    @classmethod
+    def from_important_frames(cls, important_frames: Iterable[Tuple], **kwargs) -> 'ShingleIndex':
+        """
+        Index of the sequence of important frames: shingles of k consecutive important frames.
+
+        :param important_frames: (imghash, id_frame, ...) of `ImportantFrameFingerprints`,
+            `important_frames_generator` or `important_frames_images_generator`
+        :param kwargs: see `from_imghashes`
+        :return:
+        """
+        imghashes, frame_ids = important_frames_arrays(important_frames)
+        return cls.from_imghashes(imghashes, frame_ids, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def lookup(self, key: int) -> np.ndarray:
+        """ frames indices (first frame) of the shingles of `key` """
+        key = np.uint64(key)
+        return self.frame_ids[np.searchsorted(self.keys, key, 'left'):np.searchsorted(self.keys, key, 'right')]
+
+    def to_dict(self) -> Dict[int, np.ndarray]:
+        """ key -> frames indices, O(1) lookups """
+        if not len(self.keys):
+            return {}
+        boundaries = np.flatnonzero(self.keys[1:] != self.keys[:-1]) + 1
+        return dict(zip(self.keys[np.append(0, boundaries)].tolist(), np.split(self.frame_ids, boundaries)))
+
+    def candidate_offsets(
+            self,
+            query_imghashes: np.ndarray,
+            query_frame_ids: np.ndarray = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Candidate offsets of a query clip: each query shingle found in the index votes for
+        (reference frame index - query frame index).
+
+        :param query_imghashes: uint64 imghashes of the query
+        :param query_frame_ids: frames indices of the query imghashes (ex: important frames).
+            Default to None: positions in `query_imghashes`
+        :return: offsets and their number of votes, most voted first
+        """
+        query_keys = shingle_keys(query_imghashes, self.k, self.quantize_bits)
+        if query_frame_ids is None:
+            query_frame_ids = np.arange(len(query_keys), dtype=np.int64)
+        else:
+            query_frame_ids = np.asarray(query_frame_ids, dtype=np.int64)[:len(query_keys)]
+        starts = np.searchsorted(self.keys, query_keys, 'left')
+        counts = np.searchsorted(self.keys, query_keys, 'right') - starts
+        positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        offsets, votes = np.unique(self.frame_ids[positions] - np.repeat(query_frame_ids, counts),
+                                   return_counts=True)
+        order = np.argsort(-votes, kind='stable')
+        return offsets[order], votes[order]
+
+
+def important_frames_arrays(important_frames: Iterable[Tuple]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    uint64 imghashes and frames indices of important frames (ImageHash or uint64 imghashes).
+
+    >>> important_frames_arrays([(np.uint64(7), 1), (np.uint64(9), 5, 'image')])
+    (array([7, 9], dtype=uint64), array([1, 5]))
+    """
+    imghashes, frame_ids = [], []
+    for important_frame in important_frames:
+        imghash, id_frame = important_frame[:2]
+        imghashes.append(int(imghash) if isinstance(imghash, (int, np.integer)) else imghash_to_uint64(imghash))
+        frame_ids.append(id_frame)
+    return np.array(imghashes, dtype=np.uint64), np.array(frame_ids, dtype=np.int64)
+
+
+def locate_clip_shingles(
+        query: np.ndarray,
+        reference: np.ndarray,
+        index: ShingleIndex,
+        k: int = 5,
+        nb_candidates: int = 64,
+) -> List[ClipMatch]:
+    """
+    Top-k offsets of a query clip in a reference: candidate offsets from the shingles index (exact
+    lookups), verified (summed hamming distances, see `pydbsrt.tools.cliplocalization`).
+
+    :param query: uint64 imghashes of the clip
+    :param reference: uint64 imghashes of the media (indexed by `index`, frame index: position)
+    :param index: frame index: position in `reference` (not a sampled export)
+    :param k: number of matches
+    :param nb_candidates: number of (most voted) candidate offsets verified
+    :return: matches, best first (empty if no shingle of the query is found)
+    """
+    query = np.asarray(query, dtype=np.uint64)
+    offsets, _ = index.candidate_offsets(query)
+    offsets = offsets[(offsets >= 0) & (offsets <= len(reference) - len(query))][:nb_candidates]
+    if not len(query) or not len(offsets):
+        return []
+    distances = offsets_distances(query, reference, offsets) / len(query)
+    return [
+        ClipMatch(int(offsets[id_offset]), float(distances[id_offset]),
+                  max(0.0, 1.0 - float(distances[id_offset]) / UNRELATED_DISTANCE))
+        for id_offset in np.argsort(distances, kind='stable')[:k].tolist()
+    ]
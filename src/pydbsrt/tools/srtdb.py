@@ -0,0 +1,297 @@
+"""
+"SRT in DB" store (embedded SQLite): medias, subtitles cues and per cue fingerprints ranges.
+
+Tables:
+- `medias`: name, fps, number of frames,
+- `cues`: subtitles of a media: index, times (ms), frames range, text,
+- `fingerprints`: runs of consecutive frames of a cue with the same imghash:
+  (cue, first frame, last frame, imghash). Static scenes give long runs: far fewer rows than frames.
+
+Imghashes are stored as (signed 64 bits) INTEGER: the uint64 bits viewed as int64.
+The 4 (16 bits) substrings of an imghash are stored and indexed: a hamming radius query
+probes the substrings within radius // 4 (multi-index hashing, see `pydbsrt.tools.mihindex`), the
+candidates are checked with a `hamming` SQL function.
+
+Bulk loading: `executemany` in large transactions (WAL journal), indexes created after the load.
+"""
+import attr
+from collections import Counter
+import numpy as np
+from pathlib import Path
+import sqlite3
+from typing import Iterable, List, Tuple
+#
+from pydbsrt.tools.mihindex import flip_masks, substrings_keys, substrings_layout
+from pydbsrt.tools.subfingerprint import SubFingerprintsArray
+from pydbsrt.tools.subreader import SubReader
+
+NB_SUBSTRINGS = 4
+SUBSTRINGS_COLUMNS = tuple(f'h{id_substring}' for id_substring in range(NB_SUBSTRINGS))
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS medias (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    fps REAL,
+    nb_frames INTEGER
+);
+CREATE TABLE IF NOT EXISTS cues (
+    id INTEGER PRIMARY KEY,
+    media_id INTEGER NOT NULL REFERENCES medias(id),
+    cue_index INTEGER,
+    start_ms INTEGER,
+    end_ms INTEGER,
+    first_frame INTEGER,
+    last_frame INTEGER,
+    text TEXT
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    cue_id INTEGER NOT NULL REFERENCES cues(id),
+    first_frame INTEGER,
+    last_frame INTEGER,
+    hash INTEGER,
+    {', '.join(f'{column} INTEGER' for column in SUBSTRINGS_COLUMNS)}
+);
+"""
+INDEXES = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS medias_name ON medias (name)',
+    'CREATE INDEX IF NOT EXISTS cues_media ON cues (media_id, cue_index)',
+    'CREATE INDEX IF NOT EXISTS fingerprints_cue ON fingerprints (cue_id, first_frame)',
+) + tuple(
+    f'CREATE INDEX IF NOT EXISTS fingerprints_{column} ON fingerprints ({column})' for column in SUBSTRINGS_COLUMNS
+)
+
+
+def uint64_to_int64(imghashes: np.ndarray) -> np.ndarray:
+    """
+    >>> uint64_to_int64(np.array([1, 2**64 - 1], dtype=np.uint64)).tolist()
+    [1, -1]
+    """
+    return np.asarray(imghashes, dtype=np.uint64).view(np.int64)
+
+
+def int64_to_uint64(imghashes: Iterable[int]) -> np.ndarray:
+    return np.fromiter(imghashes, dtype=np.int64).view(np.uint64)
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+def fingerprints_runs(
+        subfingerprints: SubFingerprintsArray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Runs of consecutive frames of a cue with the same imghash.
+
+    :param subfingerprints:
+    :return: cues positions (in the subreader order), first frames, last frames, uint64 imghashes
+    """
+    _, frames_ids, imghashes = subfingerprints.frames_table()
+    cues_positions = np.repeat(np.arange(len(subfingerprints.indices)), subfingerprints.nb_frames)
+    if not len(frames_ids):
+        return cues_positions, frames_ids, frames_ids, imghashes
+    new_runs = np.ones(len(frames_ids), dtype=bool)
+    new_runs[1:] = (cues_positions[1:] != cues_positions[:-1]) | (imghashes[1:] != imghashes[:-1])
+    runs_starts = np.flatnonzero(new_runs)
+    runs_ends = np.append(runs_starts[1:], len(frames_ids)) - 1
+    return cues_positions[runs_starts], frames_ids[runs_starts], frames_ids[runs_ends], imghashes[runs_starts]
+
+
+@attr.s()
+class CueMatch:
+    media = attr.ib(type=str)
+    cue_id = attr.ib(type=int)
+    cue_index = attr.ib(type=int)
+    start_ms = attr.ib(type=int)
+    end_ms = attr.ib(type=int)
+    text = attr.ib(type=str)
+    # frames (of the media) with the matching imghash
+    first_frame = attr.ib(type=int)
+    last_frame = attr.ib(type=int)
+    distance = attr.ib(type=int)
+
+
+@attr.s()
+class SrtDB:
+    """
+    >>> import tempfile
+    >>> tmp_dir = Path(tempfile.mkdtemp())
+    >>> _ = tmp_dir.joinpath('media.srt').write_text(
+    ...     '1\\n00:00:00,000 --> 00:00:00,200\\nHello\\n\\n2\\n00:00:00,400 --> 00:00:00,600\\nWorld\\n')
+    >>> imghashes = np.array([1, 1, 1, 2**63, 7, 2**64 - 1, 2**64 - 1, 3], dtype=np.uint64)
+    >>> with SrtDB(tmp_dir.joinpath('srt.db')) as db:
+    ...     media_id = db.add_media(
+    ...         'media', SubFingerprintsArray(SubReader(tmp_dir.joinpath('media.srt'), columnar=True), imghashes, 10))
+    ...     db.create_indexes()
+    ...     [(m.cue_index, m.text, m.first_frame, m.last_frame) for m in db.cues_near_hash(2**64 - 2, radius=1)]
+    ...     db.cue_hashes(1).tolist()
+    ...     # a (non columnar) pysrt stream
+    ...     _ = db.add_media('media (pysrt)', SubFingerprintsArray(SubReader(tmp_dir.joinpath('media.srt')), imghashes, 10))
+    ...     [(m.media, m.cue_index, m.text) for m in db.cues_near_hash(2**64 - 1)]
+    [(2, 'World', 5, 6)]
+    [1, 1, 1]
+    [('media', 2, 'World'), ('media (pysrt)', 2, 'World')]
+    """
+    path = attr.ib(type=Path)
+
+    connection = attr.ib(init=False, type=sqlite3.Connection, default=None)
+
+    def __attrs_post_init__(self):
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA temp_store=MEMORY')
+        self.connection.create_function('hamming', 2, _hamming)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self) -> 'SrtDB':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def create_indexes(self):
+        """ (after a bulk load) """
+        with self.connection:
+            for index in INDEXES:
+                self.connection.execute(index)
+            self.connection.execute('ANALYZE')
+
+    def add_media(self, name: str, subfingerprints: SubFingerprintsArray, commit: bool = True) -> int:
+        """
+        Insert a media, its cues and their fingerprints runs.
+
+        :param name: media name
+        :param subfingerprints: subtitles of the media joined against its imghashes
+        :param commit: commit the transaction (rolled back on error). Otherwise the caller commits
+            (ex: every N medias) or rolls back
+        :return: media id
+        """
+        if self.connection.execute('SELECT 1 FROM medias WHERE name = ?', (name,)).fetchone():
+            raise ValueError('Media [{}] already in the database.'.format(name))
+        try:
+            media_id = self._insert_media(name, subfingerprints)
+        except BaseException:
+            if commit:
+                self.connection.rollback()
+            raise
+        if commit:
+            self.connection.commit()
+        return media_id
+
+    def _insert_media(self, name: str, subfingerprints: SubFingerprintsArray) -> int:
+        texts = subfingerprints.texts
+        if len(texts) != len(subfingerprints.indices):
+            raise ValueError('Media [{0}]: {1} subtitles texts for {2} cues.'.format(
+                name, len(texts), len(subfingerprints.indices)))
+
+        cursor = self.connection.execute(
+            'INSERT INTO medias (name, fps, nb_frames) VALUES (?, ?, ?)',
+            (name, subfingerprints.frame_rate, len(subfingerprints.imghashes)),
+        )
+        media_id = cursor.lastrowid
+        first_cue_id = self.connection.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM cues').fetchone()[0]
+        self.connection.executemany(
+            'INSERT INTO cues (id, media_id, cue_index, start_ms, end_ms, first_frame, last_frame, text) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            zip(
+                range(first_cue_id, first_cue_id + len(texts)), [media_id] * len(texts),
+                subfingerprints.indices.tolist(), subfingerprints.starts_ms.tolist(), subfingerprints.ends_ms.tolist(),
+                subfingerprints.frames_starts.tolist(), subfingerprints.frames_ends.tolist(), texts,
+            ),
+        )
+        cues_positions, first_frames, last_frames, imghashes = fingerprints_runs(subfingerprints)
+        self.connection.executemany(
+            f'INSERT INTO fingerprints (cue_id, first_frame, last_frame, hash, {", ".join(SUBSTRINGS_COLUMNS)}) '
+            f'VALUES (?, ?, ?, ?, {", ".join("?" * NB_SUBSTRINGS)})',
+            zip(
+                (cues_positions + first_cue_id).tolist(), first_frames.tolist(), last_frames.tolist(),
+                uint64_to_int64(imghashes).tolist(),
+                *(substrings_keys(imghashes, shift, nb_bits).tolist()
+                  for shift, nb_bits in substrings_layout(NB_SUBSTRINGS)),
+            ),
+        )
+        return media_id
+
+    def ingest(self, catalog: Iterable[Tuple[str, Path, Path]], medias_per_transaction: int = 100) -> int:
+        """
+        Bulk load of a catalog, then creation of the indexes.
+        The medias names are checked (unique in the catalog, not in the database) before any insert.
+        On error, the medias of the current transaction are rolled back (the previous transactions,
+        of complete medias, stay committed).
+
+        :param catalog: (media name, SRT path, exported fingerprints path) of the medias
+        :param medias_per_transaction:
+        :return: number of medias loaded
+        """
+        catalog = list(catalog)
+        names = Counter(name for name, _, _ in catalog)
+        existing_names = {name for name, in self.connection.execute('SELECT name FROM medias')}
+        invalid_names = sorted(name for name, count in names.items() if count > 1 or name in existing_names)
+        if invalid_names:
+            raise ValueError('Medias names [{}] duplicated or already in the database.'.format(
+                ', '.join(invalid_names)))
+        nb_medias = 0
+        try:
+            for name, srt_path, fingerprints_path in catalog:
+                self.add_media(name, SubFingerprintsArray.from_fingerprints_file(
+                    SubReader(srt_path, columnar=True), fingerprints_path), commit=False)
+                nb_medias += 1
+                if nb_medias % medias_per_transaction == 0:
+                    self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+        self.create_indexes()
+        return nb_medias
+
+    def cues_near_hash(self, imghash: int, radius: int = 0) -> List[CueMatch]:
+        """
+        Cues with a frame within `radius` of `imghash`.
+
+        :param imghash: uint64 imghash
+        :param radius: hamming radius
+        :return: matches, sorted by distance
+        """
+        imghash = np.uint64(imghash)
+        signed_imghash = int(uint64_to_int64(imghash))
+        if not radius:
+            # the substring index, no (redundant) full imghash index
+            condition = 'f.h0 = ? AND f.hash = ?'
+            params = [int(substrings_keys(imghash, *substrings_layout(NB_SUBSTRINGS)[0])), signed_imghash]
+        else:
+            conditions, params = [], []
+            for column, (shift, nb_bits) in zip(SUBSTRINGS_COLUMNS, substrings_layout(NB_SUBSTRINGS)):
+                keys = (substrings_keys(imghash, shift, nb_bits).astype(np.uint64) ^
+                        flip_masks(nb_bits, radius // NB_SUBSTRINGS)).tolist()
+                conditions.append(f'f.{column} IN ({", ".join("?" * len(keys))})')
+                params.extend(keys)
+            condition = f'({" OR ".join(conditions)}) AND hamming(f.hash, ?) <= ?'
+            params.extend((signed_imghash, radius))
+        rows = self.connection.execute(
+            'SELECT m.name, c.id, c.cue_index, c.start_ms, c.end_ms, c.text, f.first_frame, f.last_frame, '
+            'hamming(f.hash, ?) AS distance '
+            'FROM fingerprints f JOIN cues c ON c.id = f.cue_id JOIN medias m ON m.id = c.media_id '
+            f'WHERE {condition} ORDER BY distance, m.id, c.id, f.first_frame',
+            [signed_imghash] + params,
+        )
+        return [CueMatch(*row) for row in rows]
+
+    def cue_hashes(self, cue_id: int) -> np.ndarray:
+        """
+        :param cue_id:
+        :return: uint64 imghashes of all the frames of the cue
+        """
+        runs = self.connection.execute(
+            'SELECT first_frame, last_frame, hash FROM fingerprints WHERE cue_id = ? ORDER BY first_frame',
+            (cue_id,),
+        ).fetchall()
+        if not runs:
+            return np.empty(0, dtype=np.uint64)
+        first_frames, last_frames, imghashes = zip(*runs)
+        return np.repeat(int64_to_uint64(imghashes), np.array(last_frames) - np.array(first_frames) + 1)
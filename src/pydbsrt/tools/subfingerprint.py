@@ -2,26 +2,96 @@
 
 """
 import attr
+import numpy as np
+from pathlib import Path
 from pysrt.srtitem import SubRipTime
+from typing import Generator, Iterable, List, Tuple
 #
+from pydbsrt.tools.fingerprintfile import load_fingerprints
+from pydbsrt.tools.imghash import uint64_to_imghash
 from pydbsrt.tools.videofingerprint import VideoFingerprint
 from pydbsrt.tools.subreader import SubReader
 
 
-def subriptime_to_frame(srt: SubRipTime) -> int:
+def subriptime_to_frame(srt: SubRipTime, frame_rate: float = 25) -> int:
+    """
+
+    :param srt:
+    :param frame_rate:
+    :return:
+
+    >>> subriptime_to_frame(SubRipTime(minutes=1, seconds=2, milliseconds=500), 24000 / 1001)
+    1498
+    """
     total_seconds = srt.hours * 60 * 60 + srt.minutes * 60 + srt.seconds + srt.milliseconds / 1000.0
-    return int(total_seconds * 25)
+    return int(total_seconds * frame_rate)
+
+
+def subriptimes_to_frames(ordinals: np.ndarray, frame_rate: float = 25) -> np.ndarray:
+    """
+    Vectorized `subriptime_to_frame` (same rounding), on SubRipTime ordinals (milliseconds).
+
+    :param ordinals:
+    :param frame_rate:
+    :return: int64 frames indices
+
+    >>> subriptimes_to_frames(np.array([62500, 0, 3599999]), 24000 / 1001).tolist()
+    [1498, 0, 86313]
+    """
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    total_seconds = (ordinals // 1000) + (ordinals % 1000) / 1000.0
+    return (total_seconds * frame_rate).astype(np.int64)
+
+
+def merge_frames_ranges(frames_ranges: Iterable[Tuple[int, int]], max_gap: int = 0) -> List[Tuple[int, int]]:
+    """
+    Merge (inclusive) frames ranges overlapping or separated by at most `max_gap` frames.
+
+    :param frames_ranges:
+    :param max_gap:
+    :return: sorted merged ranges
+
+    >>> merge_frames_ranges([(100, 150), (10, 20), (25, 40), (145, 160)], max_gap=3)
+    [(10, 20), (25, 40), (100, 160)]
+    >>> merge_frames_ranges([(10, 20), (25, 40)], max_gap=4)
+    [(10, 40)]
+    """
+    merged = []
+    for first_frame, last_frame in sorted(frames_ranges):
+        if merged and first_frame <= merged[-1][1] + max_gap + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last_frame))
+        else:
+            merged.append((first_frame, last_frame))
+    return merged
 
 
 @attr.s()
 class SubFingerprints:
     """
+    With `seek`, only the frames under the subtitles are decoded: subtitles timecodes are converted
+    with the real frame rate of the media, the nearby subtitles ranges (at most `max_gap` frames apart)
+    are merged, and each merged range is read by random access (`VideoFingerprint.__getitem__`:
+    cached fingerprints or ffmpeg input seeking). Each subtitle yields its frames [start, end].
+    Random access always hashes (32, 32) gray frames with pHash: seeking needs a `vectorized`
+    `VideoFingerprint`, so that its imghashes are the ones of the sequential path (ValueError otherwise).
 
+    Each seek decodes from the keyframe before its range: when the merged ranges cover more than
+    `max_coverage` of the frames up to the last subtitle, one sequential range is decoded instead.
     """
     subreader = attr.ib(type=SubReader)
     vfp = attr.ib(type=VideoFingerprint)
+    seek = attr.ib(type=bool, default=False)
+    # Default to None: frame rate of the media
+    frame_rate = attr.ib(type=float, default=None)
+    # gaps shorter than a (typical) GOP: decoding them is cheaper than seeking again
+    max_gap = attr.ib(type=int, default=250)
+    max_coverage = attr.ib(type=float, default=0.5)
 
     def __iter__(self):
+        if self.seek:
+            yield from self._iter_seek()
+            return
+
         # we suppose subtitles generator in order
 
         fp = next(self.vfp)
@@ -51,3 +121,142 @@ class SubFingerprints:
 
             except StopIteration:
                 break
+
+    def _iter_seek(self):
+        if not self.vfp.vectorized:
+            raise ValueError('Seeking needs a (32, 32) gray decode side video reader and pHash (see `VideoFingerprint.vectorized`).')
+        frame_rate = self.frame_rate or self.vfp.frame_rate
+        subtitles_ranges = sorted(
+            (subriptime_to_frame(subtitle.start, frame_rate), subriptime_to_frame(subtitle.end, frame_rate),
+             subtitle.index)
+            for subtitle in self.subreader
+        )
+        frames_ranges = merge_frames_ranges([r[:2] for r in subtitles_ranges], self.max_gap)
+        nb_covered_frames = sum(last_frame - first_frame + 1 for first_frame, last_frame in frames_ranges)
+        if frames_ranges and nb_covered_frames > self.max_coverage * (frames_ranges[-1][1] + 1):
+            frames_ranges = [(frames_ranges[0][0], frames_ranges[-1][1])]
+        id_subtitle = 0
+        for first_frame, last_frame in frames_ranges:
+            imghashes = self.vfp[first_frame:last_frame + 1]
+            # subtitles (sorted) of the merged range
+            while id_subtitle < len(subtitles_ranges) and subtitles_ranges[id_subtitle][0] <= last_frame:
+                frame_start, frame_end, index = subtitles_ranges[id_subtitle]
+                for id_frame in range(frame_start, frame_end + 1):
+                    if id_frame - first_frame >= len(imghashes):
+                        # end of the media
+                        return
+                    yield index, id_frame, uint64_to_imghash(int(imghashes[id_frame - first_frame]))
+                id_subtitle += 1
+
+
+@attr.s()
+class SubFingerprintsArray:
+    """
+    Subtitles joined against precomputed imghashes (ex: the memory-mapped column of an exported
+    fingerprints file): nothing is decoded.
+
+    All the subtitles timecodes are converted to frames indices in one vectorized pass
+    (same rounding as `subriptime_to_frame`), the imghashes of a subtitle are a slice (view)
+    of the imghashes array.
+    Subtitles (partly) after the end of the imghashes are truncated.
+    With a columnar `SubReader`, its arrays are used as is (no subtitle object at all).
+    A (non columnar) pysrt stream can only be read once: its subtitles times and texts are kept.
+    """
+    subreader = attr.ib(type=SubReader)
+    imghashes = attr.ib(type=np.ndarray)
+    frame_rate = attr.ib(type=float)
+
+    # subtitles (in the subreader order): index, times (ms), first frame, last frame (inclusive, -1 if empty)
+    indices = attr.ib(init=False, type=np.ndarray)
+    starts_ms = attr.ib(init=False, type=np.ndarray)
+    ends_ms = attr.ib(init=False, type=np.ndarray)
+    frames_starts = attr.ib(init=False, type=np.ndarray)
+    frames_ends = attr.ib(init=False, type=np.ndarray)
+    # texts of a non columnar subreader
+    _texts = attr.ib(init=False, type=List[str], default=None)
+
+    def __attrs_post_init__(self):
+        if self.subreader.columnar:
+            indices, starts, ends = self.subreader.indices, self.subreader.starts_ms, self.subreader.ends_ms
+        else:
+            subtitles = list(self.subreader)
+            indices, starts, ends = np.array(
+                [(subtitle.index, subtitle.start.ordinal, subtitle.end.ordinal) for subtitle in subtitles],
+                dtype=np.int64,
+            ).reshape(-1, 3).T
+            self._texts = [subtitle.text for subtitle in subtitles]
+        self.indices, self.starts_ms, self.ends_ms = indices, starts, ends
+        self.frames_starts = subriptimes_to_frames(starts, self.frame_rate)
+        self.frames_ends = np.minimum(subriptimes_to_frames(ends, self.frame_rate), len(self.imghashes) - 1)
+
+    @classmethod
+    def from_fingerprints_file(
+            cls,
+            subreader: SubReader,
+            fingerprints_path: Path,
+            frame_rate: float = None,
+    ) -> 'SubFingerprintsArray':
+        """
+        :param subreader:
+        :param fingerprints_path: exported fingerprints file (memory-mapped)
+        :param frame_rate: Default to the frame rate of the fingerprints file header
+        :return:
+        """
+        fingerprints = load_fingerprints(fingerprints_path)
+        frame_rate = frame_rate or fingerprints.header.fps
+        if not frame_rate:
+            raise ValueError('Unknown frame rate: the fingerprints file does not store it.')
+        return cls(subreader, fingerprints.imghashes, frame_rate)
+
+    @property
+    def texts(self) -> List[str]:
+        """ texts of the subtitles (in the subreader order) """
+        if self._texts is None:
+            return [self.subreader.text(id_subtitle) for id_subtitle in range(len(self.indices))]
+        return self._texts
+
+    @property
+    def nb_frames(self) -> np.ndarray:
+        """ number of frames of each subtitle """
+        return np.maximum(self.frames_ends - self.frames_starts + 1, 0)
+
+    def subtitles_imghashes(self) -> Generator[Tuple[int, int, np.ndarray], None, None]:
+        """
+        :return: (subtitle index, first frame, imghashes (view) of the subtitle frames)
+        """
+        for index, frame_start, frame_end in zip(self.indices.tolist(), self.frames_starts.tolist(),
+                                                 self.frames_ends.tolist()):
+            yield index, frame_start, self.imghashes[frame_start:frame_end + 1]
+
+    def frames_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Columnar (subtitle index, frame index, imghash) rows of all the subtitles frames (ex: bulk
+        insert in a database), built without a python loop on the frames.
+
+        :return: int64 subtitles indices, int64 frames indices, uint64 imghashes
+        """
+        nb_frames = self.nb_frames
+        subtitles_indices = np.repeat(self.indices, nb_frames)
+        # frames indices: start of its subtitle + offset in its subtitle
+        offsets = np.arange(nb_frames.sum()) - np.repeat(np.cumsum(nb_frames) - nb_frames, nb_frames)
+        frames_ids = np.repeat(self.frames_starts, nb_frames) + offsets
+        return subtitles_indices, frames_ids, np.asarray(self.imghashes[frames_ids], dtype=np.uint64)
+
+    def frame_to_subtitle(self) -> np.ndarray:
+        """
+        Lookup table frame index -> subtitle index (-1: no subtitle). On overlapping subtitles,
+        the last one (in the subreader order) wins.
+
+        :return: int64 array of len(imghashes)
+        """
+        subtitles_indices, frames_ids, _ = self.frames_table()
+        lookup = np.full(len(self.imghashes), -1, dtype=np.int64)
+        lookup[frames_ids] = subtitles_indices
+        return lookup
+
+    def __iter__(self) -> Generator[Tuple[int, int, int], None, None]:
+        """
+        Same rows as `SubFingerprints`: (subtitle index, frame index, imghash), but the imghash is
+        its uint64 value as an int (not an `imagehash.ImageHash`, see `uint64_to_imghash`).
+        """
+        yield from zip(*(column.tolist() for column in self.frames_table()))
@@ -3,24 +3,154 @@
 """
 import attr
 import codecs
+import io
+from itertools import chain
+import numpy as np
 from pathlib import Path
 import pysrt
+from pysrt.srtitem import SubRipItem, SubRipTime
+import re
+from typing import Generator, List
+
+# index line, then timecodes line
+SRT_CUE_RE = re.compile(
+    r'^[ \t]*(\d+)[ \t]*\n'
+    r'[ \t]*(\d+):(\d+):(\d+)[,.](\d+)[ \t]*-->[ \t]*(\d+):(\d+):(\d+)[,.](\d+)[^\n]*\n',
+    re.MULTILINE,
+)
+# (h, m, s, ms) -> ms
+TIMECODE_FIELDS_MS = np.array([3600000, 60000, 1000, 1], dtype=np.int64)
+
+
+def detect_encoding(data: bytes) -> str:
+    """
+    Encoding of a subtitles file: BOM, else utf-8 if it decodes, else cp1252/latin-1
+    (ex: french DVD subtitles).
+
+    :param data:
+    :return:
+
+    >>> detect_encoding('Déjà vu'.encode('utf-8')), detect_encoding('Déjà vu'.encode('latin-1'))
+    ('utf-8', 'cp1252')
+    >>> detect_encoding(codecs.BOM_UTF8 + b'1'), detect_encoding(b'\\x81')
+    ('utf-8-sig', 'latin-1')
+    """
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'),
+                          (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if data.startswith(bom):
+            return encoding
+    for encoding in ('utf-8', 'cp1252'):
+        try:
+            data.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            pass
+    # decodes anything
+    return 'latin-1'
+
+
+def ms_to_timecodes(times_ms: np.ndarray) -> List[str]:
+    """
+    SRT timecodes of times (ms, negative times are clipped to 0).
+
+    >>> ms_to_timecodes(np.array([62500, 7893760, -40]))
+    ['00:01:02,500', '02:11:33,760', '00:00:00,000']
+    """
+    times_ms = np.maximum(np.asarray(times_ms, dtype=np.int64), 0)
+    fields = (times_ms[:, np.newaxis] // TIMECODE_FIELDS_MS) % np.array([100, 60, 60, 1000])
+    return ['{0:02d}:{1:02d}:{2:02d},{3:03d}'.format(*row) for row in fields.tolist()]
 
 
 @attr.s
 class SubReader:
+    """
+    With `columnar`, the whole file is parsed in one pass into columnar arrays: `indices`,
+    `starts_ms`, `ends_ms` and `texts_offsets` ((start, end) of each text in the `texts` buffer).
+    No per subtitle object is built; iterating is a view building pysrt items from the arrays.
+
+    Without `encoding`, it is detected (see `detect_encoding`).
+    """
     path = attr.ib(type=Path)
 
-    file = attr.ib(init=False, type=codecs.StreamReaderWriter)
-    encoding = attr.ib(type=str, default='utf-8')
+    file = attr.ib(init=False, type=io.StringIO)
+    encoding = attr.ib(type=str, default=None)
+    columnar = attr.ib(type=bool, default=False)
 
     stream = attr.ib(init=False, type=pysrt.SubRipFile)
 
+    indices = attr.ib(init=False, type=np.ndarray, default=None)
+    starts_ms = attr.ib(init=False, type=np.ndarray, default=None)
+    ends_ms = attr.ib(init=False, type=np.ndarray, default=None)
+    texts_offsets = attr.ib(init=False, type=np.ndarray, default=None)
+    texts = attr.ib(init=False, type=str, default=None)
+
     def __attrs_post_init__(self):
-        self.file = codecs.open(str(self.path), encoding=self.encoding)
+        data = Path(self.path).read_bytes()
+        self.encoding = self.encoding or detect_encoding(data)
+        if self.columnar:
+            self._parse(data.decode(self.encoding))
+            return
+        self.file = io.StringIO(data.decode(self.encoding))
         self.stream = pysrt.stream(self.file)
 
-    def __iter__(self):
+    def _parse(self, content: str):
+        self.texts = content.replace('\r\n', '\n').replace('\r', '\n').lstrip('\ufeff')
+        matches = list(SRT_CUE_RE.finditer(self.texts))
+        # one C level conversion of all the numbers (no int object per field)
+        fields = np.fromstring(
+            ' '.join(chain.from_iterable(match.groups() for match in matches)), dtype=np.int64, sep=' '
+        ).reshape(-1, 9)
+        self.indices = fields[:, 0]
+        self.starts_ms = fields[:, 1:5] @ TIMECODE_FIELDS_MS
+        self.ends_ms = fields[:, 5:9] @ TIMECODE_FIELDS_MS
+        # text: from the end of the timecodes line to the next cue (trailing blank lines stripped)
+        texts_starts = [match.end() for match in matches]
+        texts_ends = [match.start() for match in matches[1:]] + [len(self.texts)]
+        self.texts_offsets = np.array([
+            (start, start + len(self.texts[start:end].rstrip()))
+            for start, end in zip(texts_starts, texts_ends)
+        ], dtype=np.int64).reshape(-1, 2)
+
+    def __len__(self) -> int:
+        if not self.columnar:
+            raise TypeError('Only columnar subreaders have a length.')
+        return len(self.indices)
+
+    def text(self, id_subtitle: int) -> str:
+        """ Text of the `id_subtitle`th subtitle (columnar mode) """
+        start, end = self.texts_offsets[id_subtitle].tolist()
+        return self.texts[start:end]
+
+    def write(self, path: Path, starts_ms: np.ndarray = None, ends_ms: np.ndarray = None,
+              encoding: str = 'utf-8'):
+        """
+        Write the subtitles as a SRT file (columnar mode), optionally retimed.
+
+        :param path:
+        :param starts_ms: new start times (ms). Default to None: `starts_ms`
+        :param ends_ms: new end times (ms). Default to None: `ends_ms`
+        :param encoding:
+        :return:
+        """
+        if not self.columnar:
+            raise TypeError('Only columnar subreaders can be written.')
+        starts_ms = self.starts_ms if starts_ms is None else np.round(starts_ms).astype(np.int64)
+        ends_ms = self.ends_ms if ends_ms is None else np.round(ends_ms).astype(np.int64)
+        cues = (
+            '{0}\n{1} --> {2}\n{3}\n'.format(index, start, end, self.text(id_subtitle))
+            for id_subtitle, (index, start, end) in enumerate(zip(
+                self.indices.tolist(), ms_to_timecodes(starts_ms), ms_to_timecodes(ends_ms)))
+        )
+        Path(path).write_text('\n'.join(cues), encoding=encoding)
+
+    def __iter__(self) -> Generator[SubRipItem, None, None]:
+        if self.columnar:
+            for id_subtitle, (index, start_ms, end_ms) in enumerate(zip(
+                    self.indices.tolist(), self.starts_ms.tolist(), self.ends_ms.tolist())):
+                yield SubRipItem(index, SubRipTime.from_ordinal(start_ms), SubRipTime.from_ordinal(end_ms),
+                                 self.text(id_subtitle))
+            return
         for sub in self.stream:
             yield sub
         return
@@ -0,0 +1,281 @@
+"""
+Subtitles re-synchronization between two releases of a media (ex: DVD PAL 25 fps -> 1080p 23.976 fps),
+from their fingerprints only (no text matching).
+
+- anchors: the frames following a cut (distinctive imghashes) of the reference are looked up in a
+  MIH index of the frames following a cut of the target (a cut matches a cut, not every frame of a
+  static scene), each match is a (reference time, target time) anchor,
+- time map: a linear map (target = speed * reference + offset) is fitted on the anchors with RANSAC.
+  Different cuts (scenes added/removed) give a piecewise map: lines are fitted one after the other on
+  the anchors not yet explained, each line keeps its longest run of consecutive inliers,
+- the subtitles timings are mapped and written as a SRT (see `SubReader.write`).
+"""
+import attr
+import numpy as np
+from pathlib import Path
+from typing import List, Tuple
+#
+from pydbsrt.tools.fingerprintfile import Fingerprints, load_fingerprints
+from pydbsrt.tools.imghash import imghashes_popcount
+from pydbsrt.tools.mihindex import MIHIndex
+from pydbsrt.tools.subreader import SubReader
+
+
+@attr.s()
+class TimeSegment:
+    # reference times (s) covered by the segment
+    start = attr.ib(type=float)
+    end = attr.ib(type=float)
+    # target time = speed * reference time + offset
+    speed = attr.ib(type=float)
+    offset = attr.ib(type=float)
+    nb_inliers = attr.ib(type=int, default=0)
+
+
+@attr.s()
+class TimeMap:
+    """
+    Piecewise linear map of reference times to target times.
+    A time between (or outside) the segments is mapped by the previous (first) segment.
+
+    >>> time_map = TimeMap([TimeSegment(0, 600, 25 / 23.976, 1.5), TimeSegment(600, 5400, 25 / 23.976, -40.0)])
+    >>> time_map(np.array([10.0, 1000.0])).round(3).tolist()
+    [11.927, 1002.709]
+    """
+    segments = attr.ib(type=List[TimeSegment], default=attr.Factory(list))
+
+    def __call__(self, times: np.ndarray) -> np.ndarray:
+        if not self.segments:
+            raise ValueError('Empty time map.')
+        times = np.asarray(times, dtype=np.float64)
+        starts = np.array([segment.start for segment in self.segments])
+        ids_segments = np.clip(np.searchsorted(starts, times, 'right') - 1, 0, len(self.segments) - 1)
+        speeds = np.array([segment.speed for segment in self.segments])[ids_segments]
+        offsets = np.array([segment.offset for segment in self.segments])[ids_segments]
+        return speeds * times + offsets
+
+
+def cut_frames(imghashes: np.ndarray, cut_distance: int = 20) -> np.ndarray:
+    """
+    Indices of the frames following a cut (hamming distance to the previous frame >= `cut_distance`)
+    whose imghash is unique in the media. Runs of identical consecutive imghashes (static shots)
+    count once: the frames of the shot following a cut don't make its imghash ambiguous.
+
+    >>> cut_frames(np.array([0, 0, 2**64 - 1, 2**64 - 2, 0, 255], dtype=np.uint64), cut_distance=8)
+    array([2, 5])
+    >>> cut_frames(np.array([0, 0, 2**64 - 1, 2**64 - 1, 2**64 - 1, 0, 255], dtype=np.uint64), cut_distance=8)
+    array([2, 6])
+    """
+    imghashes = np.asarray(imghashes, dtype=np.uint64)
+    ids_frames = np.nonzero(imghashes_popcount(imghashes[1:] ^ imghashes[:-1]) >= cut_distance)[0] + 1
+    if not len(ids_frames):
+        return ids_frames
+    runs_starts = np.flatnonzero(np.append(True, imghashes[1:] != imghashes[:-1]))
+    _, inverse, counts = np.unique(imghashes[runs_starts], return_inverse=True, return_counts=True)
+    ids_runs = np.searchsorted(runs_starts, ids_frames, 'right') - 1
+    return ids_frames[counts[inverse[ids_runs]] == 1]
+
+
+def find_anchors(
+        reference: np.ndarray,
+        target: np.ndarray,
+        radius: int = 8,
+        cut_distance: int = 20,
+        max_matches: int = 4,
+        nb_substrings: int = 4,
+) -> np.ndarray:
+    """
+    Anchors (matching cut frames, see `cut_frames`) between a reference and a target.
+
+    :param reference: uint64 imghashes of the reference
+    :param target: uint64 imghashes of the target
+    :param radius: hamming radius of a match
+    :param cut_distance: see `cut_frames`
+    :param max_matches: reference frames with more matches are ambiguous (skipped)
+    :param nb_substrings: see `MIHIndex`
+    :return: (N, 2) (reference frame, target frame) anchors, sorted
+    """
+    target_cuts = cut_frames(target, cut_distance)
+    index = MIHIndex(nb_substrings)
+    index.add(target[target_cuts], 'target')
+    anchors = []
+    for id_frame in cut_frames(reference, cut_distance).tolist():
+        _, ids_cuts, _ = index.search(reference[id_frame], radius)
+        if 0 < len(ids_cuts) <= max_matches:
+            anchors.extend((id_frame, target_frame) for target_frame in target_cuts[ids_cuts].tolist())
+    return np.array(sorted(anchors), dtype=np.int64).reshape(-1, 2)
+
+
+def ransac_line(
+        x: np.ndarray,
+        y: np.ndarray,
+        tolerance: float = 0.1,
+        nb_iterations: int = 1000,
+        speed_range: Tuple[float, float] = (0.8, 1.25),
+        seed: int = 0,
+) -> Tuple[float, float, np.ndarray]:
+    """
+    Robust fit of y = speed * x + offset.
+
+    :param x:
+    :param y:
+    :param tolerance: maximum residual of an inlier
+    :param nb_iterations: number of random (pairs of points) hypotheses
+    :param speed_range: admissible speeds
+    :param seed:
+    :return: speed, offset (least squares on the inliers) and inliers mask
+
+    >>> x = np.arange(100, dtype=np.float64)
+    >>> y = 25 / 23.976 * x + 3.0
+    >>> y[::10] += 50  # outliers
+    >>> speed, offset, inliers = ransac_line(x, y)
+    >>> round(speed * 23.976, 3), round(offset, 3), int(inliers.sum())
+    (25.0, 3.0, 90)
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) < 2:
+        return 1.0, 0.0, np.zeros(len(x), dtype=bool)
+    rng = np.random.RandomState(seed)
+    pairs = rng.randint(0, len(x), (nb_iterations, 2))
+    dx = x[pairs[:, 1]] - x[pairs[:, 0]]
+    valid = dx != 0
+    speeds = (y[pairs[valid, 1]] - y[pairs[valid, 0]]) / dx[valid]
+    valid_speeds = (speed_range[0] <= speeds) & (speeds <= speed_range[1])
+    speeds = speeds[valid_speeds]
+    offsets = y[pairs[valid, 0]][valid_speeds] - speeds * x[pairs[valid, 0]][valid_speeds]
+    if not len(speeds):
+        return 1.0, 0.0, np.zeros(len(x), dtype=bool)
+    nb_inliers = np.zeros(len(speeds), dtype=np.int64)
+    # hypotheses by chunks: bounded (hypotheses, points) residuals matrices
+    chunk_size = max(1, (1 << 22) // len(x))
+    for start in range(0, len(speeds), chunk_size):
+        residuals = y - (speeds[start:start + chunk_size, np.newaxis] * x + offsets[start:start + chunk_size, np.newaxis])
+        nb_inliers[start:start + chunk_size] = (np.abs(residuals) <= tolerance).sum(axis=1)
+    best = int(np.argmax(nb_inliers))
+    inliers = np.abs(y - (speeds[best] * x + offsets[best])) <= tolerance
+    speed, offset = np.polyfit(x[inliers], y[inliers], 1)
+    return float(speed), float(offset), inliers
+
+
+def _longest_inliers_run(inliers: np.ndarray, max_outliers: int) -> Tuple[int, int, int]:
+    # (first, last, number of inliers) of the longest run of inliers with less than `max_outliers`
+    # consecutive outliers
+    best, run_start, run_inliers, nb_outliers, last_inlier = (0, -1, 0), None, 0, 0, None
+    for position, inlier in enumerate(inliers.tolist()):
+        if inlier:
+            if run_start is None:
+                run_start, run_inliers = position, 0
+            run_inliers += 1
+            nb_outliers, last_inlier = 0, position
+            if run_inliers > best[2]:
+                best = (run_start, last_inlier, run_inliers)
+        elif run_start is not None:
+            nb_outliers += 1
+            if nb_outliers >= max_outliers:
+                run_start = None
+    return best
+
+
+def fit_time_map(
+        anchors_times: np.ndarray,
+        tolerance: float = 0.1,
+        min_inliers: int = 20,
+        max_outliers: int = 16,
+        max_segments: int = 16,
+) -> TimeMap:
+    """
+    Piecewise linear time map from anchors.
+
+    :param anchors_times: (N, 2) (reference time, target time) anchors, sorted
+    :param tolerance: see `ransac_line`
+    :param min_inliers: minimum number of inliers of a segment
+    :param max_outliers: a segment stops after this number of consecutive outliers
+    :param max_segments:
+    :return:
+
+    >>> reference_times = np.arange(0, 3000, 2.0)
+    >>> target_times = np.where(reference_times < 1000, 1.0427 * reference_times + 2, 1.0427 * reference_times - 58)
+    >>> time_map = fit_time_map(np.stack([reference_times, target_times], axis=1))
+    >>> [(segment.start, segment.end, round(segment.offset, 3)) for segment in time_map.segments]
+    [(0.0, 998.0, 2.0), (1000.0, 2998.0, -58.0)]
+    """
+    anchors_times = np.asarray(anchors_times, dtype=np.float64).reshape(-1, 2)
+    remaining = np.ones(len(anchors_times), dtype=bool)
+    segments = []
+    while remaining.sum() >= min_inliers and len(segments) < max_segments:
+        ids_remaining = np.nonzero(remaining)[0]
+        x, y = anchors_times[ids_remaining].T
+        speed, offset, inliers = ransac_line(x, y, tolerance, seed=len(segments))
+        first, last, nb_inliers = _longest_inliers_run(inliers, max_outliers)
+        if nb_inliers < min_inliers:
+            break
+        run_inliers = np.zeros_like(inliers)
+        run_inliers[first:last + 1] = inliers[first:last + 1]
+        speed, offset = np.polyfit(x[run_inliers], y[run_inliers], 1)
+        segments.append(TimeSegment(float(x[first]), float(x[last]), float(speed), float(offset), int(nb_inliers)))
+        # the anchors in the segment span are explained (or outliers)
+        remaining &= ~((anchors_times[:, 0] >= x[first]) & (anchors_times[:, 0] <= x[last]))
+    return TimeMap(sorted(segments, key=lambda segment: segment.start))
+
+
+@attr.s()
+class SubtitlesSynchronizer:
+    """
+    Retiming of the subtitles of a reference media for a target media, from their (exported)
+    fingerprints files.
+    """
+    reference = attr.ib(type=Fingerprints)
+    target = attr.ib(type=Fingerprints)
+    # hamming radius of a matching frame
+    radius = attr.ib(type=int, default=8)
+    # maximum residual (s) of an anchor on the time map
+    tolerance = attr.ib(type=float, default=0.1)
+    min_inliers = attr.ib(type=int, default=20)
+
+    time_map = attr.ib(init=False, type=TimeMap, default=None)
+
+    @classmethod
+    def from_fingerprints_files(cls, reference_path: Path, target_path: Path, **kwargs) -> 'SubtitlesSynchronizer':
+        return cls(load_fingerprints(reference_path), load_fingerprints(target_path), **kwargs)
+
+    def anchors_times(self) -> np.ndarray:
+        """
+        (N, 2) (reference time, target time) anchors (s).
+        Rows of sampled exports (stride, fps, keyframes) are mapped to their source frames indices
+        ('.ids' file, see `Fingerprints.frames_ids`).
+        """
+        frame_rates = np.array([self.reference.header.fps, self.target.header.fps])
+        if not frame_rates.all():
+            raise ValueError('Unknown frame rate: the fingerprints file does not store it.')
+        anchors = find_anchors(
+            np.asarray(self.reference.imghashes, dtype=np.uint64),
+            np.asarray(self.target.imghashes, dtype=np.uint64),
+            radius=self.radius,
+        )
+        for column, fingerprints in enumerate((self.reference, self.target)):
+            frames_ids = fingerprints.frames_ids
+            if frames_ids is not None:
+                anchors[:, column] = frames_ids[anchors[:, column]]
+        return anchors / frame_rates
+
+    def fit(self) -> TimeMap:
+        self.time_map = fit_time_map(self.anchors_times(), self.tolerance, self.min_inliers)
+        if not self.time_map.segments:
+            raise ValueError('No time map: not enough matching frames between the medias.')
+        return self.time_map
+
+    def retime(self, subreader: SubReader, output_path: Path) -> SubReader:
+        """
+        Write the retimed subtitles of `subreader` (columnar) to `output_path`.
+
+        :param subreader: subtitles synchronized with the reference
+        :param output_path: SRT synchronized with the target
+        :return: subtitles reader of the written SRT
+        """
+        time_map = self.time_map or self.fit()
+        subreader.write(
+            output_path,
+            starts_ms=time_map(subreader.starts_ms / 1000.0) * 1000.0,
+            ends_ms=time_map(subreader.ends_ms / 1000.0) * 1000.0,
+        )
+        return SubReader(output_path, encoding='utf-8', columnar=True)
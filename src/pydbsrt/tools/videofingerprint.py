@@ -6,36 +6,164 @@ import imagehash
 import imageio
 import numpy as np
 from PIL import Image
+from typing import Generator, Optional, Union
 #
+from pydbsrt.tools.ffmpeg_tools.ffmeg_extract_frame import ffmpeg_imghash_block_generator, pipelined_imghashes_blocks
+from pydbsrt.tools.fingerprintcache import FingerprintCache, export_cache_key, media_content_id
+from pydbsrt.tools.fingerprintfile import Fingerprints, load_fingerprints
+from pydbsrt.tools.imghash import imghashes_phash, uint64_to_imghash
 from pydbsrt.tools.videoreader import VideoReader
 
 
 @attr.s()
 class VideoFingerprint:
     """
+    With a decode side (32, 32) 'gray' `VideoReader` and the default (pHash) hash function,
+    the frames are hashed by blocks with the vectorized pHash (no per frame conversion nor copy).
+    With `nb_workers`, decoding and hashing are pipelined (see `pipelined_imghashes_blocks`).
 
+    Random access: `vfp[a:b]` (frames indices) and `vfp.at_time(t0, t1)` (seconds) return the uint64
+    pHash imghashes of the (32x32 gray) frames of a range, as exported by `export_fingerprints`.
+    They are read from the cached fingerprints file of the media if it exists, otherwise ffmpeg
+    seeks to the range and decodes only its frames.
     """
     vreader = attr.ib(type=VideoReader)
-    #
-    func_for_hash = attr.ib(default=lambda f: imagehash.phash(f))
+    # Default to None: imagehash.phash
+    func_for_hash = attr.ib(default=None)
+    # Number of hashing workers (vectorized mode). Default to None: decoding and hashing alternate
+    nb_workers = attr.ib(type=int, default=None)
+    # Fingerprints cache (random access). Default to None: default cache
+    cache = attr.ib(type=FingerprintCache, default=None)
 
     frame_reader = attr.ib(init=False)
+    _fingerprints = attr.ib(init=False, type=Fingerprints, default=None)
+    # the cache is looked up once (a miss hashes the media content)
+    _fingerprints_looked_up = attr.ib(init=False, type=bool, default=False)
 
     def __attrs_post_init__(self):
-        self.frame_reader = iter(self.vreader.reader)
+        self.frame_reader = self._imghashes()
 
     def __iter__(self):
-        self.frame_reader = iter(self.vreader.reader)
+        self.frame_reader = self._imghashes()
         return self
 
     def __next__(self):
+        return next(self.frame_reader)
+
+    @property
+    def vectorized(self) -> bool:
+        return (
+            self.func_for_hash is None and
+            self.vreader.frame_size is not None and tuple(self.vreader.frame_size) == (32, 32) and
+            self.vreader.pix_fmt == 'gray'
+        )
+
+    def imghashes_blocks(self, block_size: int = 512) -> Generator[np.ndarray, None, None]:
+        """
+        Blocks of uint64 (pHash) imghashes, hashed by the vectorized pHash
+        (needs a decode side (32, 32) 'gray' `VideoReader`, see `vectorized`).
+
+        :param block_size:
+        :return:
+        """
+        if not self.vectorized:
+            raise ValueError('Vectorized imghashes need a (32, 32) gray decode side video reader and pHash.')
+        frames_blocks = self.vreader.frame_blocks(block_size)
+        if self.nb_workers:
+            yield from pipelined_imghashes_blocks(frames_blocks, imghashes_phash, self.nb_workers)
+            return
+        for frames in frames_blocks:
+            yield imghashes_phash(frames)
+
+    def _imghashes(self) -> Generator[imagehash.ImageHash, None, None]:
+        if self.vectorized:
+            for imghashes in self.imghashes_blocks():
+                yield from map(uint64_to_imghash, imghashes.tolist())
+            return
+        func_for_hash = self.func_for_hash or imagehash.phash
         try:
-            cur_frame = next(self.frame_reader)
-            try:
-                frame = cur_frame
-                img = Image.fromarray(np.uint8(frame))
-                return self.func_for_hash(img)
-            except imageio.core.format.CannotReadFrameError as e:
-                raise StopIteration
-        except StopIteration:
-            raise StopIteration
+            for frame in self.vreader.frames():
+                yield func_for_hash(Image.fromarray(frame))
+        except imageio.core.format.CannotReadFrameError:
+            return
+
+    @property
+    def frame_rate(self) -> float:
+        return self.vreader.metadatas['fps']
+
+    def cached_fingerprints(self) -> Optional[Fingerprints]:
+        """ (memory-mapped) cached fingerprints of the media, None if it has not been exported """
+        if not self._fingerprints_looked_up:
+            cache = self.cache or FingerprintCache()
+            export_fp = cache.get(export_cache_key(media_content_id(self.vreader.media_path)))
+            if export_fp is not None:
+                self._fingerprints = load_fingerprints(export_fp)
+            self._fingerprints_looked_up = True
+        return self._fingerprints
+
+    def __len__(self) -> int:
+        fingerprints = self.cached_fingerprints()
+        if fingerprints is not None:
+            return len(fingerprints)
+        nb_frames = self.vreader.metadatas['nframes']
+        if not np.isfinite(nb_frames):
+            raise TypeError('Unknown number of frames: the media metadatas do not store it.')
+        return int(nb_frames)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[np.uint64, np.ndarray]:
+        """
+        pHash imghash of a frame, or uint64 pHash imghashes of a range of frames.
+        Negative indices (and reversed slices without start) need the number of frames of the media
+        (TypeError if the metadatas do not store it, see `__len__`).
+
+        :param key: frame index or slice of frames indices
+        :return:
+        """
+        fingerprints = self.cached_fingerprints()
+        if fingerprints is not None:
+            imghashes = fingerprints.column('phash')[key]
+            return np.uint64(imghashes) if np.ndim(imghashes) == 0 else np.array(imghashes, dtype=np.uint64)
+
+        if not isinstance(key, slice):
+            id_frame = key + len(self) if key < 0 else key
+            imghashes = self._decode_imghashes(id_frame, id_frame + 1)
+            if not len(imghashes):
+                raise IndexError('Frame index out of range.')
+            return imghashes[0]
+
+        step = key.step or 1
+        if step < 0 and key.start is not None and key.start >= 0 and (key.stop is None or key.stop >= 0):
+            # reversed slice: decode ]stop, start], then pick the frames backward (no len needed)
+            return self._decode_imghashes(0 if key.stop is None else key.stop + 1, key.start + 1)[::step]
+
+        if step < 0 or any(i is not None and i < 0 for i in (key.start, key.stop)):
+            # relative slices: decode the covered range, then pick the frames
+            ids_frames = np.arange(*key.indices(len(self)))
+            if not len(ids_frames):
+                return np.empty(0, dtype=np.uint64)
+            first_frame = ids_frames.min()
+            imghashes = self._decode_imghashes(first_frame, ids_frames.max() + 1)
+            return imghashes[ids_frames - first_frame]
+
+        return self._decode_imghashes(key.start or 0, key.stop)[::key.step]
+
+    def at_time(self, t0: float, t1: float = None) -> np.ndarray:
+        """
+        uint64 pHash imghashes of the frames between `t0` and `t1` (seconds, None: end of the media).
+
+        :param t0:
+        :param t1:
+        :return:
+        """
+        frame_rate = self.frame_rate
+        return self[int(round(t0 * frame_rate)):None if t1 is None else int(round(t1 * frame_rate))]
+
+    def _decode_imghashes(self, start_frame: int, stop_frame: int = None) -> np.ndarray:
+        # frames [start_frame, stop_frame): ffmpeg input seeking and selection (inclusive stop)
+        if stop_frame is not None and stop_frame <= start_frame:
+            return np.empty(0, dtype=np.uint64)
+        imghashes = list(ffmpeg_imghash_block_generator(
+            str(self.vreader.media_path), start_frame, None if stop_frame is None else stop_frame - 1,
+            seek=True, frame_rate=self.frame_rate,
+        ))
+        return np.concatenate(imghashes) if imghashes else np.empty(0, dtype=np.uint64)
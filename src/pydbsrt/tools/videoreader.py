@@ -2,18 +2,202 @@
 
 """
 import attr
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import imageio
 from imageio.core.format import Format
+import logging
+import numpy as np
+import os
 from pathlib import Path
+from typing import Dict, Generator, Iterable, Tuple
+#
+from pydbsrt.tools.ffmpeg_tools.ffmeg_extract_frame import ffmpeg_frame_block_generator
+from pydbsrt.tools.ffmpeg_wrapper import FFException
+from pydbsrt.tools.ffmpeg_wrapper import FFprobe
+
+logger = logging.getLogger(__name__)
+
+
+def ffprobe_to_metadatas(probe: dict) -> dict:
+    """
+    Media metadatas (same keys as the imageio ffmpeg reader metadatas) of the first video stream,
+    from a FFprobe streams and format JSON.
+
+    :param probe: see `FFprobe.probe`
+    :return:
+
+    >>> metadatas = ffprobe_to_metadatas({
+    ...     'streams': [
+    ...         {'codec_type': 'audio', 'codec_name': 'aac'},
+    ...         {'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 804,
+    ...          'r_frame_rate': '24000/1001', 'nb_frames': '189292'},
+    ...     ],
+    ...     'format': {'duration': '7893.760000'},
+    ... })
+    >>> sorted(metadatas.items())  # doctest: +NORMALIZE_WHITESPACE
+    [('codec', 'h264'), ('duration', 7893.76), ('fps', 23.976023976023978), ('nframes', 189292),
+     ('plugin', 'ffprobe'), ('size', (1920, 804)), ('source_size', (1920, 804))]
+    """
+    try:
+        stream = next(s for s in probe.get('streams', []) if s.get('codec_type') == 'video')
+    except StopIteration:
+        raise FFException.StreamIndexOutOfBound
+    media_format = probe.get('format', {})
+
+    def _float(entry):
+        try:
+            return float(entry)
+        except (TypeError, ValueError):
+            return None
+
+    num, _, den = stream.get('r_frame_rate', '0/1').partition('/')
+    fps = int(num) / int(den or 1) if int(den or 1) else 0.0
+    duration = _float(media_format.get('duration')) or _float(stream.get('duration'))
+    try:
+        nframes = int(stream['nb_frames'])
+    except (KeyError, ValueError):
+        nframes = int(round(duration * fps)) if duration and fps else float('inf')
+    size = (int(stream['width']), int(stream['height']))
+    return {
+        'plugin': 'ffprobe',
+        'codec': stream.get('codec_name'),
+        'fps': fps,
+        'nframes': nframes,
+        'duration': duration,
+        'source_size': size,
+        'size': size,
+    }
+
+
+def exact_frame_rate(fps: float) -> float:
+    """
+    Exact frame rate of a rounded one: NTSC rates (ex: imageio metadatas 23.98) are
+    N * 1000 / 1001 frames per second (ex: 24000/1001), about 17 frames off at frame 100000 otherwise.
+
+    :param fps:
+    :return:
+
+    >>> exact_frame_rate(23.98) == 24000 / 1001, exact_frame_rate(29.97) == 30000 / 1001
+    (True, True)
+    >>> exact_frame_rate(25.0), exact_frame_rate(12.5)
+    (25.0, 12.5)
+    """
+    ntsc_fps = round(fps * 1.001) * 1000 / 1001
+    if abs(fps - round(fps)) > 0.005 >= abs(fps - ntsc_fps):
+        return ntsc_fps
+    return fps
+
+
+@lru_cache(maxsize=1 << 14)
+def _probe_media_metadatas(media_path: str, file_size: int, mtime_ns: int) -> dict:
+    # (file_size, mtime_ns) are part of the cache key: a modified media is probed again
+    if FFprobe.binary_path is None:
+        FFprobe.initialize()
+    try:
+        return ffprobe_to_metadatas(FFprobe.probe(media_path))
+    except (FFException.BinaryCallFailed, FFException.StreamIndexOutOfBound, KeyError, ValueError):
+        raise FFException.InvalidMedia(media_path)
+
+
+def probe_media_metadatas(media_path: Path) -> dict:
+    """
+    Media metadatas from a single (cached) FFprobe call: no decoder is opened.
+
+    :param media_path:
+    :return: see `ffprobe_to_metadatas`
+    """
+    stat = os.stat(str(media_path))
+    return dict(_probe_media_metadatas(str(media_path), stat.st_size, stat.st_mtime_ns))
+
+
+def scan_medias_metadatas(medias_paths: Iterable[Path], nb_workers: int = None) -> Dict[Path, dict]:
+    """
+    Metadatas of a library of medias: FFprobe calls run concurrently (threads waiting on processes),
+    invalid medias are skipped (logged).
+
+    :param medias_paths:
+    :param nb_workers: Number of concurrent FFprobe calls. Default to 4 * os.cpu_count()
+    :return: metadatas by media path
+    """
+    def _probe(media_path):
+        try:
+            return media_path, probe_media_metadatas(media_path)
+        except (FFException.InvalidMedia, OSError):
+            logger.warning("Invalid media [{}].".format(media_path))
+            return media_path, None
+
+    with ThreadPoolExecutor(max_workers=nb_workers or 4 * (os.cpu_count() or 1)) as executor:
+        return {
+            media_path: metadatas
+            for media_path, metadatas in executor.map(_probe, medias_paths)
+            if metadatas is not None
+        }
 
 
 @attr.s()
 class VideoReader:
+    """
+    Metadatas come from a single (cached) FFprobe call, the (imageio) decoder is only opened
+    when frames are read: building readers (ex: to list or validate medias) decodes nothing.
+
+    With `frame_size` and/or `pix_fmt`, the frames are scaled and converted inside ffmpeg
+    (decode side, see `ffmpeg_frame_block_generator`): ex (32, 32) 'gray' frames for the
+    fingerprints, instead of full resolution rgb frames.
+    """
     media_path = attr.ib(type=Path)
+    # decode side (ffmpeg) output frame (width, height) and pixel format. Default to None: source frames
+    frame_size = attr.ib(type=Tuple[int, int], default=None)
+    pix_fmt = attr.ib(type=str, default=None)
+
+    _reader = attr.ib(init=False, type=Format, default=None)
+    _metadatas = attr.ib(init=False, type=dict, default=None)
+
+    @property
+    def reader(self) -> Format.Reader:
+        """ imageio reader, opened on first use """
+        if self._reader is None:
+            self._reader = imageio.get_reader(self.media_path, 'ffmpeg')
+        return self._reader
+
+    @property
+    def metadatas(self) -> dict:
+        """ fps, nframes, size, duration ... (see `ffprobe_to_metadatas`) """
+        if self._metadatas is None:
+            try:
+                self._metadatas = probe_media_metadatas(self.media_path)
+            except FFException.BinaryNotFound:
+                # no ffprobe: metadatas of the imageio reader (opens the decoder), rounded fps
+                self._metadatas = dict(self.reader.get_meta_data())
+                self._metadatas['fps'] = exact_frame_rate(self._metadatas['fps'])
+        return self._metadatas
+
+    @property
+    def decode_side(self) -> bool:
+        """ Frames scaled/converted inside ffmpeg """
+        return self.frame_size is not None or self.pix_fmt is not None
+
+    def frame_blocks(self, block_size: int = 512) -> Generator[np.ndarray, None, None]:
+        """
+        Blocks of decode side scaled/converted frames: zero-copy views on a ring buffer,
+        see `ffmpeg_frame_block_generator`.
 
-    reader = attr.ib(init=False, type=Format)
-    metadatas = attr.ib(init=False)
+        :param block_size:
+        :return: (k, height, width) gray frames or (k, height, width, 3) rgb24 frames
+        """
+        frame_width, frame_height = self.frame_size or self.metadatas['size']
+        yield from ffmpeg_frame_block_generator(
+            str(self.media_path), frame_width=frame_width, frame_height=frame_height,
+            block_size=block_size, pix_fmt=self.pix_fmt or 'rgb24',
+        )
 
-    def __attrs_post_init__(self):
-        self.reader = imageio.get_reader(self.media_path, 'ffmpeg')
-        self.metadatas = self.reader.get_meta_data()
+    def frames(self) -> Generator[np.ndarray, None, None]:
+        """
+        Frames of the media: decode side scaled/converted frames (views, valid until the next block)
+        or the imageio reader frames.
+        """
+        if not self.decode_side:
+            yield from self.reader
+            return
+        for frames in self.frame_blocks():
+            yield from frames